@@ -3,16 +3,29 @@ import threading
 import asyncio
 
 try:
-    from services.stt_vad import record_vad, transcribe_vad
-    from services.llm import generate_response, USER_NAME
-    from services.tts_silero import speak_text
+    from services.stt_vad import record_vad, transcribe_vad, get_whisper_model
+    from services.stt_filter import is_garbage_text
+    from services.llm import generate_response, generate_structured_response, USER_NAME
+    from services.tts_silero import preload_fallback_voices, speak_text, vts_client
+    from services.chat_sessions import ChannelQueueFull, ChannelSession, FairScheduler
+    from services.speech_queue import SpeechQueue
+    from services.runtime_config import start_control_server
+    from services.profiler import install_hotkey as install_profiler_hotkey
+    from services.model_lifecycle import start_lifecycle_manager
+    from services.session_recorder import recorder, start_recorder
 except ImportError:
-    from stt_vad import record_vad, transcribe_vad  # type: ignore
-    from llm import generate_response, USER_NAME  # type: ignore
-    from tts_silero import speak_text  # type: ignore
+    from stt_vad import record_vad, transcribe_vad, get_whisper_model  # type: ignore
+    from stt_filter import is_garbage_text  # type: ignore
+    from llm import generate_response, generate_structured_response, USER_NAME  # type: ignore
+    from tts_silero import preload_fallback_voices, speak_text, vts_client  # type: ignore
+    from chat_sessions import ChannelQueueFull, ChannelSession, FairScheduler  # type: ignore
+    from speech_queue import SpeechQueue  # type: ignore
+    from runtime_config import start_control_server  # type: ignore
+    from profiler import install_hotkey as install_profiler_hotkey  # type: ignore
+    from model_lifecycle import start_lifecycle_manager  # type: ignore
+    from session_recorder import recorder, start_recorder  # type: ignore
 
 from twitchio.ext import commands
-import re
 import torch
 
 CLIENT_ID = 'wytz41znebdbonzo66ospr4knl39j7'
@@ -22,16 +35,60 @@ TWITCH_NICK = 'kakoitochelikhihi'
 TWITCH_CHANNEL = 'kakoitochelikhihi'
 BOT_ID = '76417315'
 
+# Каналы, в которых сидит бот. Голосом Элейн отвечает только в основном
+# канале, в остальных — только текстом.
+PRIMARY_CHANNEL = TWITCH_CHANNEL
+TWITCH_CHANNELS = [TWITCH_CHANNEL]
+# Собственный характер для отдельных каналов: {"канал": "текст persona"}
+CHANNEL_PERSONAS: dict[str, str] = {}
+# Сколько запросов к LLM из чата обрабатывается одновременно
+LLM_WORKERS = 1
+
+# Голосовые ответы генерируются по грамматике: законченные предложения
+# и эмоция для выражения лица модели в VTube Studio
+STRUCTURED_OUTPUT = True
+
+# Сколько секунд можно ждать начала озвучки, по источнику реплики. По
+# бюджету выбирается движок TTS: чат — быстрый Piper/Silero, голосовые
+# ответы (без бюджета) — XTTS.
+SPEECH_LATENCY_BUDGETS: dict[str, float] = {"chat": 0.5}
+
+
+def speak_queued(text: str, source: str) -> str:
+    return speak_text(text, latency_budget=SPEECH_LATENCY_BUDGETS.get(source))
+
+
+# Вся озвучка идёт через одну очередь. Когда отставание озвучки растёт,
+# ответы в чат становятся короче, затем — только текстовыми.
+speech_queue = SpeechQueue(speak_queued, short_budget=6.0, budget=12.0)
+
 class ElaineTwitchBot(commands.Bot):
-    def __init__(self):
+    def __init__(self, channels: list[str] | None = None):
+        channels = channels or TWITCH_CHANNELS
         super().__init__(
             token=TWITCH_TOKEN,
             client_id=CLIENT_ID,
             client_secret=CLIENT_SECRET,
             bot_id=BOT_ID,
             prefix='!',
-            initial_channels=[TWITCH_CHANNEL],
+            initial_channels=channels,
         )
+        self._init_chat(channels)
+
+    def _init_chat(self, channels: list[str], max_pending: int = 5) -> None:
+        # Отдельно от __init__, чтобы обработку чата можно было проверить без Twitch
+        self.sessions = {name.lower(): self._new_session(name) for name in channels}
+        self.scheduler = FairScheduler(workers=LLM_WORKERS, max_pending=max_pending)
+
+    @staticmethod
+    def _new_session(channel: str) -> ChannelSession:
+        return ChannelSession(channel=channel, persona=CHANNEL_PERSONAS.get(channel.lower()))
+
+    def get_session(self, channel: str) -> ChannelSession:
+        key = channel.lower()
+        if key not in self.sessions:
+            self.sessions[key] = self._new_session(channel)
+        return self.sessions[key]
 
     async def event_ready(self):
         print("🟣 Twitch-бот готов к приёму сообщений.")
@@ -42,16 +99,43 @@ class ElaineTwitchBot(commands.Bot):
         if message.echo:
             return
 
+        channel = message.channel.name
         author = message.author.name
         content = message.content
-        print(f"{author}: {content}")
+        print(f"[{channel}] {author}: {content}")
+        recorder.record_event("chat", {"channel": channel, "author": author, "content": content})
+
+        session = self.get_session(channel)
+        if not session.allow():
+            print(f"⏳ [{channel}] Лимит ответов — пропускаю сообщение.")
+            return
 
         prompt = f"{USER_NAME}, в чате Twitch {author} написал: {content}. Ответь коротко и дружелюбно."
-        response = generate_response(prompt, [])
+        is_primary = channel.lower() == PRIMARY_CHANNEL.lower()
+        mode = speech_queue.chat_mode() if is_primary else "text_only"
+        try:
+            response = await self.scheduler.submit(
+                channel,
+                generate_response,
+                prompt,
+                max_tokens=speech_queue.chat_max_tokens(),
+                cache_key=content,
+                cache_scope=channel.lower(),
+                cache_author=author,
+                persona=session.persona,
+                session=f"chat:{channel.lower()}",
+            )
+        except ChannelQueueFull:
+            print(f"🗑 [{channel}] Очередь канала переполнена — сообщение отброшено.")
+            return
+        if not response.strip():
+            return
 
         await message.channel.send(response)
-        print(f"Элейн-Сама (чат): {response}")
-        speak_text(response)
+        print(f"Элейн-Сама (чат {channel}): {response}")
+        if is_primary:
+            if mode == "text_only" or not speech_queue.submit(response, source="chat"):
+                print(f"💬 Очередь озвучки перегружена ({speech_queue.backlog_seconds():.1f} с) — отвечаю только текстом.")
 
 
 def run_twitch_bot():
@@ -59,16 +143,24 @@ def run_twitch_bot():
     bot.run(with_adapter=True)
 
 
-def is_garbage_text(text: str) -> bool:
-    latin_words = re.findall(r"[a-zA-Z]{3,}", text)
-    has_cyrillic = bool(re.search(r"[а-яА-ЯёЁ]", text))
-    return len(latin_words) >= 3 and not has_cyrillic
-
-
 def main():
     last_text = None
     last_response = None
-    chat_history = []
+
+    # Загружаем Whisper заранее, чтобы первая фраза не ждала модель
+    get_whisper_model()
+    preload_fallback_voices()
+    # Локальный API для смены настроек и перезагрузки движков на лету
+    # (там же POST /profile — снять профиль всех потоков)
+    start_control_server()
+    install_profiler_hotkey()
+    # Редко нужные модели (BLIP, запасные голоса) выгружаются при простое
+    # и нехватке памяти и загружаются снова по требованию
+    start_lifecycle_manager()
+    # Запись сеанса для воспроизведения (секция "recorder" или POST /record)
+    start_recorder()
+    # Подключение к VTube Studio поднимается в фоне и не задерживает старт
+    vts_client.start()
 
     twitch_thread = threading.Thread(target=run_twitch_bot, daemon=True)
     twitch_thread.start()
@@ -95,7 +187,18 @@ def main():
             print("🔁 Похоже на повтор (вопрос) — пропускаю...")
             continue
 
-        response = generate_response(user_text, chat_history)
+        # История диалога живёт в KV-кэше сессии "voice": модель считает
+        # только новую реплику, а старые ходы вытесняются сдвигом кэша
+        emotion = None
+        if STRUCTURED_OUTPUT:
+            result = generate_structured_response(user_text, session="voice")
+            response = result["reply"]
+            emotion = result["emotion"]
+        else:
+            response = generate_response(user_text, session="voice")
+        if not response.strip():
+            print("😶 Модель ничего не ответила.")
+            continue
 
         if user_text.strip()[-1] not in ".!?…»":
             print("🟡 Похоже, ты не договорил — не добавляю запрос в историю.")
@@ -108,13 +211,9 @@ def main():
             continue
 
         print(f"Elaine-Сама: {response}")
-        threading.Thread(target=speak_text, args=(response,), daemon=True).start()
-
-        entry = f"{USER_NAME}: {user_text}\nЭлейн-Сама: {response}"
-        if entry not in chat_history:
-            chat_history.append(entry)
-        if len(chat_history) > 4:
-            chat_history = chat_history[-4:]
+        if emotion:
+            vts_client.set_emotion(emotion)
+        speech_queue.submit(response, source="voice")
 
         last_text = user_text
         last_response = response
@@ -0,0 +1,119 @@
+"""
+Воспроизведение синтезированной речи с синхронизацией мимики VTube Studio.
+
+Вынесено из `tts_silero.py`, чтобы синтез и проигрывание можно было
+разделить: аудио можно отрендерить заранее (например, AutoThinker готовит
+следующую реплику в тишине) и проиграть позже. Мимика включается только
+при старте воспроизведения, рот гарантированно закрывается в конце.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+import numpy as np  # type: ignore
+import sounddevice as sd  # type: ignore
+import soundfile as sf  # type: ignore
+
+from vtube_controller import VTubeStudioClient
+
+try:
+    from .runtime_config import register_handler  # type: ignore
+except ImportError:
+    from runtime_config import register_handler  # type: ignore
+
+SAMPLE_RATE = 24000
+OUTPUT_PATH = "output/xtts_streamed.wav"
+
+
+_last_vts_error: str | None = None
+
+
+def _log_vts_health(state: str, error: str | None) -> None:
+    global _last_vts_error
+    if state == "connected":
+        _last_vts_error = None
+        print("🟢 VTube Studio подключена.")
+    elif state == "backoff" and error and error != _last_vts_error:
+        # Одна и та же ошибка на каждой попытке переподключения печатается один раз
+        _last_vts_error = error
+        print(f"🟠 VTube Studio недоступна ({error}), переподключение в фоне.")
+
+
+# Соединение с VTube Studio поднимается и восстанавливается в фоне; пока
+# его нет, кадры мимики отбрасываются без задержек для воспроизведения.
+# Подключение запускает main (или первый кадр мимики), а не импорт модуля
+vts_client = VTubeStudioClient(health_callback=_log_vts_health)
+register_handler("GET", "/vts", lambda body: vts_client.health())
+
+# Одновременно звучит только одна реплика. Блокировка реентерабельная:
+# реплика из нескольких фрагментов держит её целиком (playback_lease),
+# а play_audio внутри берёт её повторно
+_playback_lock = threading.RLock()
+
+
+@contextmanager
+def playback_lease() -> Iterator[None]:
+    """
+    Закрепляет вывод звука за одной репликой на всё время её
+    воспроизведения, чтобы фрагменты разных реплик не перемежались.
+    """
+    with _playback_lock:
+        yield
+
+
+def play_audio(audio: np.ndarray, samplerate: int = SAMPLE_RATE, out_path: str = OUTPUT_PATH) -> str:
+    """
+    Сохраняет аудио в WAV, проигрывает его и двигает рот модели по
+    громкости сигнала. Блокирует до окончания воспроизведения.
+    Возвращает путь к сохранённому файлу.
+    """
+    if audio is None or len(audio) == 0:
+        print("⚠️ Нет сгенерированных аудиоданных.")
+        return ""
+
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    sf.write(out_path, audio, samplerate)
+
+    stream_finished_flag = threading.Event()
+    current_chunk = np.zeros(1, dtype=np.float32)
+
+    def mimics_loop():
+        last_volume = 0.0
+        smoothing = 0.7
+        smoothed_volume = 0.0
+        while not stream_finished_flag.is_set():
+            rms = np.sqrt(np.mean(np.square(current_chunk)))
+            raw_volume = float(np.clip(rms * 4.2, 0.0, 1.0))
+            smoothed_volume = smoothing * smoothed_volume + (1 - smoothing) * raw_volume
+            if abs(smoothed_volume - last_volume) > 0.01:
+                vts_client.set_mouth_open(smoothed_volume)
+                last_volume = smoothed_volume
+            time.sleep(1 / 60.0)
+        vts_client.set_mouth_open(0.0)
+
+    with _playback_lock:
+        sd.default.samplerate = samplerate
+        sd.default.channels = 1
+        mimics_thread = threading.Thread(target=mimics_loop, daemon=True)
+        mimics_thread.start()
+        try:
+            current_chunk[:] = 0.0
+            sd.play(audio, samplerate=samplerate)
+            for i in range(0, len(audio), 512):
+                current_chunk = audio[i:i+512]
+                time.sleep(512 / samplerate)
+            sd.wait()
+        except Exception as e:
+            print(f"⚠️ Ошибка воспроизведения: {e}")
+        finally:
+            stream_finished_flag.set()
+            current_chunk = np.zeros(1, dtype=np.float32)
+            vts_client.set_mouth_open(0.0)
+            mimics_thread.join(timeout=1.0)
+
+    return out_path
@@ -1,17 +1,18 @@
 import asyncio
 import random
 import time
-from typing import Optional
+from dataclasses import dataclass
+from typing import Any, Optional
 
 # Импорт генератора ответа, TTS и описания экрана
 try:
-    from .llm import generate_response, USER_NAME  # type: ignore
-    from .tts_silero import speak_text  # type: ignore
-    from .screen_capture import describe_screen  # type: ignore
+    from .llm import generate_response, remember_turn, USER_NAME  # type: ignore
+    from .tts_silero import render_speech, play_speech, speak_text  # type: ignore
+    from .screen_capture import describe_screen, preload_caption_model  # type: ignore
 except ImportError:
-    from llm import generate_response, USER_NAME  # type: ignore
-    from tts_silero import speak_text  # type: ignore
-    from screen_capture import describe_screen  # type: ignore
+    from llm import generate_response, remember_turn, USER_NAME  # type: ignore
+    from tts_silero import render_speech, play_speech, speak_text  # type: ignore
+    from screen_capture import describe_screen, preload_caption_model  # type: ignore
 
 try:
     import mss  # type: ignore
@@ -20,6 +21,20 @@ except ImportError:
     mss = None  # type: ignore
     Image = None  # type: ignore
 
+# Диалоговая сессия размышлений в KV-кэше LLM (отдельно от голоса и чата)
+THINKER_SESSION = "thinker"
+
+
+@dataclass
+class Thought:
+    """Заранее подготовленная мысль: промпт, текст и (если успели) аудио."""
+
+    generation: int
+    prompt: str
+    text: str
+    audio: Any = None
+    in_session: bool = False     # ход уже записан в сессию "thinker"
+
 
 class AutoThinker:
     """
@@ -28,53 +43,160 @@ class AutoThinker:
     дополнительно анализирует содержимое экрана: делает одиночный
     скриншот и включает его описание в подсказку для LLM.
 
+    Следующая мысль готовится заранее: спустя prepare_after секунд тишины
+    в фоне строится промпт, генерируется текст и синтезируется аудио.
+    Фоновая работа уступает LLM и TTS основным запросам, а любая
+    голосовая или чат-активность делает подготовленную мысль устаревшей.
+    Когда наступает silent_timeout, готовая реплика проигрывается сразу.
+    Вместо опроса по таймеру цикл просыпается по событиям активности.
+
     chat_history – общая история диалога, которая может использоваться
     при генерации ответов. silent_timeout – сколько секунд после
     последней активности должно пройти, чтобы ассистент заговорил сам.
     """
 
-    def __init__(self, chat_history: list[str], silent_timeout: float = 15.0):
+    def __init__(
+        self,
+        chat_history: list[str],
+        silent_timeout: float = 15.0,
+        prepare_after: Optional[float] = None,
+    ):
         self.chat_history = chat_history
         self.silent_timeout = silent_timeout
-        self.last_voice_time = asyncio.get_event_loop().time()
+        self.prepare_after = silent_timeout / 3 if prepare_after is None else prepare_after
+        self.last_voice_time = time.monotonic()
         self.enabled = True
         self.chat_messages: list[str] = []
+        # Поколение контекста: увеличивается при любой активности и
+        # инвалидирует мысли, подготовленные для старого контекста
+        self._generation = 0
+        self._thought: Optional[Thought] = None
+        self._prepare_task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        # Модель подписи грузится заранее, чтобы первый describe_screen не ждал её
+        preload_caption_model()
 
     def notify_voice_activity(self) -> None:
-        """Вызывается при голосовой активности пользователя"""
-        self.last_voice_time = asyncio.get_event_loop().time()
+        """Вызывается при голосовой активности пользователя (из любого потока)"""
+        self.last_voice_time = time.monotonic()
+        self._invalidate()
 
     def push_chat(self, message: str) -> None:
-        """Добавляет новое сообщение из чата Twitch"""
+        """Добавляет новое сообщение из чата Twitch (из любого потока)"""
         if message:
             self.chat_messages.append(message)
             if len(self.chat_messages) > 20:
                 self.chat_messages = self.chat_messages[-20:]
+            # Подготовка начнётся заново, только когда чат затихнет на prepare_after
+            self.last_voice_time = time.monotonic()
+            self._invalidate()
+
+    def stop(self) -> None:
+        """Останавливает фоновую задачу."""
+        self.enabled = False
+        self._invalidate()
+
+    def _invalidate(self) -> None:
+        self._generation += 1
+        self._thought = None
+        if self._loop is not None and self._wake is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def _is_stale(self, generation: int) -> bool:
+        return generation != self._generation or not self.enabled
 
     async def run(self) -> None:
         """Фоновая задача, генерирующая мысли в тишине"""
-        loop = asyncio.get_event_loop()
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
         while self.enabled:
-            await asyncio.sleep(2.0)
-            now = loop.time()
-            if now - self.last_voice_time < self.silent_timeout:
-                continue  # голос недавно был — ждём
-
-            prompt = self.build_prompt()
-            print(" Тишина... Думаю сама:", prompt)
-
-            response = await loop.run_in_executor(None, generate_response, prompt, self.chat_history)
-            if response.strip():
-                await loop.run_in_executor(None, speak_text, response)
-
-                # Обновляем историю
-                entry = f"Элейн-Сама: {response}"
-                self.chat_history.append(entry)
-                if len(self.chat_history) > 6:
-                    self.chat_history[:] = self.chat_history[-6:]
-
-                # Сброс таймера, чтобы не говорить подряд
-                self.last_voice_time = loop.time()
+            idle = time.monotonic() - self.last_voice_time
+
+            if idle >= self.prepare_after and self._thought is None and not self._preparing():
+                self._prepare_task = asyncio.ensure_future(self._prepare(self._generation))
+
+            if idle >= self.silent_timeout:
+                print(" Тишина... Думаю сама.")
+                await self._speak(await self._take_thought())
+                continue
+
+            # Спим до следующего рубежа (подготовка или реплика) или до активности
+            deadline = self.prepare_after if idle < self.prepare_after else self.silent_timeout
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(0.05, deadline - idle))
+            except asyncio.TimeoutError:
+                pass
+
+    def _preparing(self) -> bool:
+        return self._prepare_task is not None and not self._prepare_task.done()
+
+    async def _prepare(self, generation: int) -> None:
+        """Спекулятивно готовит мысль в фоне с низким приоритетом."""
+        loop = asyncio.get_running_loop()
+        prompt = await loop.run_in_executor(None, self.build_prompt)
+        if self._is_stale(generation):
+            return
+        # Та же сессия, что и у мысли без подготовки: контекст одинаковый, а
+        # KV-кэш сессии "thinker" переиспользуется. Ход попадёт в сессию,
+        # только если мысль прозвучит (см. _speak)
+        text = await loop.run_in_executor(
+            None,
+            lambda: generate_response(prompt, background=True, session=THINKER_SESSION, remember=False),
+        )
+        if self._is_stale(generation) or not text.strip():
+            return
+        print(" Мысль подготовлена заранее:", prompt)
+        self._thought = Thought(generation, prompt, text)
+        audio = await loop.run_in_executor(
+            None,
+            lambda: render_speech(text, background=True, cancel=lambda: self._is_stale(generation)),
+        )
+        if not self._is_stale(generation) and self._thought is not None:
+            self._thought.audio = audio
+
+    async def _take_thought(self) -> Optional[Thought]:
+        """Забирает готовую мысль; если её нет, готовит сразу."""
+        generation = self._generation
+        if self._preparing():
+            try:
+                await asyncio.shield(self._prepare_task)  # type: ignore[arg-type]
+            except Exception:
+                pass
+        thought = self._thought
+        if thought is not None and thought.generation == generation:
+            return thought
+        loop = asyncio.get_running_loop()
+        prompt = await loop.run_in_executor(None, self.build_prompt)
+        print(" Тишина... Думаю сама:", prompt)
+        text = await loop.run_in_executor(
+            None,
+            lambda: generate_response(prompt, session=THINKER_SESSION),
+        )
+        return Thought(generation, prompt, text, in_session=True)
+
+    async def _speak(self, thought: Optional[Thought]) -> None:
+        loop = asyncio.get_running_loop()
+        if thought is not None and thought.text.strip() and not self._is_stale(thought.generation):
+            if thought.audio is not None:
+                await loop.run_in_executor(None, play_speech, thought.audio)
+            else:
+                await loop.run_in_executor(None, speak_text, thought.text)
+            if not thought.in_session:
+                # Подготовленная в фоне мысль попадает в сессию, только когда прозвучала
+                await loop.run_in_executor(None, remember_turn, THINKER_SESSION, thought.prompt, thought.text)
+
+            # Обновляем историю
+            entry = f"Элейн-Сама: {thought.text}"
+            self.chat_history.append(entry)
+            if len(self.chat_history) > 6:
+                self.chat_history[:] = self.chat_history[-6:]
+
+        # Сброс таймера, чтобы не говорить подряд
+        self.last_voice_time = time.monotonic()
+        self._generation += 1
+        self._thought = None
 
     def get_screen_summary(self) -> str:
         """
@@ -0,0 +1,144 @@
+"""
+Сессии каналов Twitch и справедливое распределение запросов к LLM.
+
+Один процесс Элейн может сидеть в нескольких каналах. У каждого канала
+своя сессия: ограничение частоты ответов и, при желании, собственный
+характер (persona). История диалога канала живёт в KV-кэше LLM
+(сессия "chat:<канал>", см. llm.ConversationSession). Запросы к модели из всех
+каналов попадают в общий планировщик, который раздаёт их общим
+рабочим потокам по кругу (round‑robin), поэтому шумный канал не может
+занять модель и оставить остальные без ответов.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+
+class ChannelQueueFull(RuntimeError):
+    """Запрос вытеснен из переполненной очереди канала более новым."""
+
+    def __init__(self, channel: str) -> None:
+        super().__init__(f"очередь канала {channel} переполнена")
+        self.channel = channel
+
+
+@dataclass
+class ChannelSession:
+    """
+    Состояние одного канала.
+
+    rate_per_minute и burst задают «ведро токенов»: не больше burst ответов
+    подряд и в среднем не больше rate_per_minute в минуту. persona, если
+    задана, заменяет системный промпт для этого канала.
+    """
+
+    channel: str
+    persona: Optional[str] = None
+    rate_per_minute: float = 6.0
+    burst: int = 3
+    _tokens: float = field(default=-1.0, repr=False)
+    _updated: float = field(default_factory=time.monotonic, repr=False)
+
+    def allow(self) -> bool:
+        """Можно ли ответить сейчас. Расходует токен при успехе."""
+        now = time.monotonic()
+        if self._tokens < 0:
+            self._tokens = float(self.burst)
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate_per_minute / 60.0)
+        self._updated = now
+        if self._tokens < 1.0:
+            return False
+        self._tokens -= 1.0
+        return True
+
+
+class FairScheduler:
+    """
+    Планировщик запросов к общим рабочим потокам модели.
+
+    У каждого канала своя очередь (не длиннее max_pending — при
+    переполнении самые старые запросы отбрасываются, их future
+    завершаются исключением ChannelQueueFull). Освободившийся
+    рабочий поток берёт следующий запрос из очереди следующего по кругу
+    канала.
+    """
+
+    def __init__(self, workers: int = 1, max_pending: int = 5) -> None:
+        self.max_pending = max_pending
+        self._queues: dict[str, deque] = {}
+        self._order: deque[str] = deque()
+        self._cond = threading.Condition()
+        self._workers = [
+            threading.Thread(target=self._worker_loop, name=f"llm-worker-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for w in self._workers:
+            w.start()
+
+    def submit(self, channel: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> "asyncio.Future[Any]":
+        """
+        Ставит вызов fn(*args, **kwargs) в очередь канала и возвращает
+        asyncio.Future текущего цикла событий с его результатом.
+        """
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future = loop.create_future()
+        with self._cond:
+            queue = self._queues.get(channel)
+            if queue is None:
+                queue = self._queues[channel] = deque()
+                self._order.append(channel)
+            queue.append((loop, future, fn, args, kwargs))
+            while len(queue) > self.max_pending:
+                old_loop, old_future, *_ = queue.popleft()
+                old_loop.call_soon_threadsafe(_set_exception, old_future, ChannelQueueFull(channel))
+            self._cond.notify()
+        return future
+
+    def pending(self, channel: Optional[str] = None) -> int:
+        """Число ожидающих запросов (по каналу или всего)."""
+        with self._cond:
+            if channel is not None:
+                return len(self._queues.get(channel, ()))
+            return sum(len(q) for q in self._queues.values())
+
+    def _next_job(self):
+        # Ищем следующий по кругу канал с непустой очередью
+        for _ in range(len(self._order)):
+            channel = self._order[0]
+            self._order.rotate(-1)
+            queue = self._queues[channel]
+            if queue:
+                return queue.popleft()
+        return None
+
+    def _worker_loop(self) -> None:
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+            loop, future, fn, args, kwargs = job
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                loop.call_soon_threadsafe(_set_exception, future, e)
+            else:
+                loop.call_soon_threadsafe(_set_result, future, result)
+
+
+def _set_result(future: asyncio.Future, result: Any) -> None:
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, exc: BaseException) -> None:
+    if not future.done():
+        future.set_exception(exc)
+
@@ -1,19 +1,76 @@
+import json
 import os
-from llama_cpp import Llama
+import re
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import Any
+import llama_cpp
+from llama_cpp import Llama, LlamaGrammar
+
+try:
+    from .priority import PriorityGate  # type: ignore
+    from .resource_arbiter import arbiter  # type: ignore
+    from .response_cache import ResponseCache  # type: ignore
+    from .runtime_config import EngineSlot, register_handler, section  # type: ignore
+    from .session_recorder import recorded  # type: ignore
+except ImportError:
+    from priority import PriorityGate  # type: ignore
+    from resource_arbiter import arbiter  # type: ignore
+    from response_cache import ResponseCache  # type: ignore
+    from runtime_config import EngineSlot, register_handler, section  # type: ignore
+    from session_recorder import recorded  # type: ignore
 
 # Путь к модели GigaChat v1.5 q4_K_M
 MODEL_PATH = "E:/ElaineRus/models/gigachat/GigaChat-20B-A3B-instruct-v1.5-q4_K_M.gguf"
 
-llm = Llama(
-    model_path=MODEL_PATH,
-    n_ctx=8192,
-    n_threads=32,             # все потоки CPU
-    n_gpu_layers=100,         # часть слоёв на GPU
-    rope_freq_base=10000.0,   # ускоренное позиционное кодирование
-    repeat_last_n=256,        # контроль повторов
-    use_mmap=True,
-    verbose=False
-)
+# Настройки модели (секция "llm" в elaine_config.json). Параметры загрузки
+# меняются через llm_slot.reload(...), параметры генерации — на лету.
+LLM_SETTINGS = section("llm", {
+    "model_path": MODEL_PATH,
+    "n_ctx": 8192,
+    "n_threads": 0,           # 0 — потоки раздаёт resource_arbiter
+    "n_threads_batch": 0,
+    "n_gpu_layers": 100,      # сколько слоёв на GPU (урезается по свободной VRAM)
+    "temperature": 0.88,
+    "session_tokens": 2048,   # окно диалоговой сессии в KV-кэше (см. ConversationSession)
+    "parked_states": 2,       # сколько сохранённых состояний сессий держать в RAM
+})
+
+def _build_llm(settings: dict) -> Llama:
+    n_threads = settings["n_threads"] or arbiter.threads_for("llm")
+    return Llama(
+        model_path=settings["model_path"],
+        n_ctx=settings["n_ctx"],
+        n_threads=n_threads,
+        n_threads_batch=settings["n_threads_batch"] or n_threads,
+        n_gpu_layers=arbiter.gpu_layers("llm", settings["n_gpu_layers"], settings["model_path"]),
+        rope_freq_base=10000.0,   # ускоренное позиционное кодирование
+        repeat_last_n=256,        # контроль повторов
+        use_mmap=True,
+        verbose=False
+    )
+
+def _set_llama_threads(n_threads: int) -> None:
+    """Меняет число потоков загруженной модели без перезагрузки."""
+    if LLM_SETTINGS["n_threads"] or not llm_slot.loaded:
+        return  # потоки заданы в конфиге явно
+    llm = llm_slot.get()
+    n_batch = LLM_SETTINGS["n_threads_batch"] or n_threads
+    ctx = getattr(getattr(llm, "_ctx", None), "ctx", None)
+    if ctx is not None and hasattr(llama_cpp, "llama_set_n_threads"):
+        llama_cpp.llama_set_n_threads(ctx, n_threads, n_batch)
+    llm.n_threads = n_threads
+    llm.n_threads_batch = n_batch
+
+llm_slot = EngineSlot("llm", _build_llm, LLM_SETTINGS, closer=lambda llm: arbiter.release("llm"))
+arbiter.register("llm", kind="llama", apply=_set_llama_threads)
+llm_slot.get()
+
+# Llama не потокобезопасна: вызовы сериализуются, ответы на голос и чат
+# имеют приоритет над фоновыми (спекулятивными) генерациями
+llm_gate = PriorityGate()
 
 # Имя пользователя
 USER_NAME = "Ваня"
@@ -36,6 +93,238 @@ SYSTEM_PERSONA = """
 Общайся с пользователем по имени Ваня, как будто вы друзья с богатой историей общения. Отвечай от первого лица и не продолжай диалог за пользователя.
 """
 
+# Кэш ответов на повторяющиеся вопросы из чата
+response_cache = ResponseCache(
+    max_entries=256,
+    ttl=900.0,
+    similarity_threshold=0.82,
+    max_variants=4,
+    variation_probability=0.35,
+)
+
+def get_cache_stats() -> dict[str, float]:
+    """Статистика попаданий и промахов кэша ответов."""
+    return response_cache.stats()
+
+
+register_handler("GET", "/cache", lambda body: get_cache_stats())
+
+# ----------------------------------------------------------------------
+# Диалоговые сессии в KV-кэше
+@dataclass
+class ConversationSession:
+    """
+    Диалог, живущий в KV-кэше llama.cpp. Вместо того чтобы каждый ход
+    собирать промпт из истории заново и прогонять его целиком, сессия
+    хранит токены, уже посчитанные моделью: заголовок (persona), затем
+    ходы «реплика — ответ». Новый ход дописывает в конец только свои
+    токены, а llama-cpp-python сам находит общий префикс с кэшем, поэтому
+    prompt eval стоит O(новых токенов), а не O(истории).
+
+    Когда окно (session_tokens) заполняется, самые старые ходы
+    удаляются из KV-кэша, а оставшиеся сдвигаются по позициям
+    (`llama_kv_cache_seq_rm` + `llama_kv_cache_seq_add`) — без
+    повторного prefill. Сессий несколько (голос, чаты, размышления);
+    KV-кэш у модели один, поэтому при переключении состояние уходящей
+    сессии сохраняется (`save_state`), а приходящей — восстанавливается.
+    Состояние весит десятки мегабайт, поэтому в RAM держатся только
+    parked_states последних; у остальных сессий остаются токены, и при
+    возвращении они посчитаются заново одним prefill.
+    """
+
+    name: str
+    header: str
+    tokens: list[int] = field(default_factory=list)
+    turns: list[int] = field(default_factory=list)     # длины ходов в токенах, по порядку
+    header_len: int = 0
+    state: Any = None                                  # LlamaState, пока сессия не в KV-кэше
+    parked_at: float = 0.0                             # когда состояние сохранено
+    loaded_at: float | None = None                     # модель, для которой посчитаны токены
+    last_eval_tokens: int = 0
+    evicted_turns: int = 0
+    dropped_states: int = 0
+
+    def reset(self, llm: Llama) -> None:
+        self.tokens = llm.tokenize(self.header.encode("utf-8"), add_bos=True, special=True)
+        self.header_len = len(self.tokens)
+        self.turns = []
+        self.state = None
+        self.loaded_at = llm_slot.loaded_at
+
+    def append(self, tokens: list[int]) -> None:
+        self.tokens.extend(tokens)
+        self.turns.append(len(tokens))
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "tokens": len(self.tokens),
+            "turns": len(self.turns),
+            "in_kv": _kv_owner == self.name,
+            "saved_state": self.state is not None,
+            "saved_state_bytes": int(getattr(self.state, "llama_state_size", 0)) if self.state is not None else 0,
+            "dropped_states": self.dropped_states,
+            "last_eval_tokens": self.last_eval_tokens,
+            "evicted_turns": self.evicted_turns,
+        }
+
+
+_sessions: dict[str, ConversationSession] = {}
+_sessions_lock = threading.RLock()
+# Чьи токены сейчас лежат в KV-кэше модели (None — разовый запрос без сессии)
+_kv_owner: str | None = None
+
+
+def _kv_function(*names: str) -> Any:
+    for name in names:
+        fn = getattr(llama_cpp, name, None)
+        if fn is not None:
+            return fn
+    return None
+
+
+_kv_seq_rm = _kv_function("llama_kv_cache_seq_rm", "llama_kv_self_seq_rm")
+_kv_seq_add = _kv_function("llama_kv_cache_seq_add", "llama_kv_self_seq_add")
+
+
+def _kv_remove(llm: Llama, start: int, end: int) -> bool:
+    """
+    Удаляет из KV-кэша позиции [start, end) и сдвигает хвост на их место.
+    Возвращает False, если сдвиг недоступен — тогда хвост будет
+    пересчитан при следующем вызове.
+    """
+    ctx = getattr(getattr(llm, "_ctx", None), "ctx", None)
+    n = llm.n_tokens
+    if ctx is None or _kv_seq_rm is None or _kv_seq_add is None or end > n:
+        return False
+    count = end - start
+    _kv_seq_rm(ctx, 0, start, end)
+    _kv_seq_add(ctx, 0, end, n, -count)
+    llm.input_ids[start:n - count] = llm.input_ids[end:n]
+    llm.n_tokens = n - count
+    return True
+
+
+def _park(llm: Llama, session: ConversationSession) -> None:
+    """Сохраняет состояние уходящей сессии; лишние старые состояния отбрасывает."""
+    session.state = llm.save_state()
+    session.parked_at = time.monotonic()
+    parked = sorted((s for s in _sessions.values() if s.state is not None), key=lambda s: s.parked_at)
+    for stale in parked[:max(0, len(parked) - int(LLM_SETTINGS["parked_states"]))]:
+        stale.state = None
+        stale.dropped_states += 1
+
+
+def _activate(llm: Llama, session: ConversationSession | None) -> None:
+    """Переключает KV-кэш на сессию, сохранив состояние прежней."""
+    global _kv_owner
+    name = session.name if session is not None else None
+    if _kv_owner == name:
+        return
+    previous = _sessions.get(_kv_owner) if _kv_owner is not None else None
+    if previous is not None and previous.loaded_at == llm_slot.loaded_at:
+        _park(llm, previous)
+    if session is not None and session.state is not None:
+        llm.load_state(session.state)
+        session.state = None
+    _kv_owner = name
+
+
+def _get_session(llm: Llama, name: str, header: str) -> ConversationSession:
+    """Сессия по имени; при смене заголовка или модели начинается заново."""
+    global _kv_owner
+    session = _sessions.get(name)
+    if session is None:
+        session = _sessions[name] = ConversationSession(name, header)
+    if session.header != header or session.loaded_at != llm_slot.loaded_at:
+        if _kv_owner == name:
+            _kv_owner = None
+        session.header = header
+        session.reset(llm)
+    return session
+
+
+def _fit_window(llm: Llama, session: ConversationSession, incoming: int) -> None:
+    """Вытесняет самые старые ходы, пока в окно не поместятся incoming токенов."""
+    window = min(LLM_SETTINGS["session_tokens"], llm.n_ctx())
+    drop_turns, drop_tokens = 0, 0
+    while session.turns[drop_turns:] and len(session.tokens) - drop_tokens + incoming > window:
+        drop_tokens += session.turns[drop_turns]
+        drop_turns += 1
+    if not drop_turns:
+        return
+    _activate(llm, session)
+    start = session.header_len
+    end = start + drop_tokens
+    in_sync = _kv_owner == session.name and list(llm.input_ids[start:end]) == session.tokens[start:end]
+    # Если кэш не совпадает с сессией или сдвиг недоступен, хвост пересчитается при генерации
+    if in_sync and not _kv_remove(llm, start, end):
+        print(f"⚠️ Сессия {session.name}: сдвиг KV-кэша недоступен, история будет пересчитана.")
+    del session.tokens[start:end]
+    del session.turns[:drop_turns]
+    session.evicted_turns += drop_turns
+
+
+def _session_prompt(llm: Llama, session: ConversationSession, turn: str, max_tokens: int) -> list[int]:
+    """Готовит KV-кэш к ходу и возвращает токены промпта (сессия + новый ход)."""
+    new = llm.tokenize(turn.encode("utf-8"), add_bos=False, special=True)
+    _activate(llm, session)
+    _fit_window(llm, session, len(new) + max_tokens)
+    prompt = session.tokens + new
+    cached = 0
+    for a, b in zip(llm.input_ids[:llm.n_tokens], prompt[:-1]):
+        if a != b:
+            break
+        cached += 1
+    session.last_eval_tokens = len(prompt) - cached
+    return prompt
+
+
+def _turn_text(speaker: str, prompt: str) -> str:
+    return f"{speaker}: {prompt.strip()}\nЭлейн-Сама:"
+
+
+def remember_turn(session: str, prompt: str, reply: str, speaker: str = USER_NAME) -> None:
+    """
+    Дописывает в сессию ход, ответ на который получен без генерации
+    (из кэша ответов или заранее подготовленная мысль). Его токены
+    посчитаются вместе со следующим ходом, там же при необходимости
+    освободится окно. Токенизация не трогает KV-кэш, поэтому очередь
+    генерации не занимается.
+    """
+    if not reply.strip():
+        return
+    text = f"{_turn_text(speaker, prompt)} {reply.strip()}\n"
+    with llm_slot.use() as llm:
+        tokens = llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+        loaded_at = llm_slot.loaded_at
+    with _sessions_lock:
+        state = _sessions.get(session)
+        if state is None or state.loaded_at != loaded_at:
+            return
+        state.append(tokens)
+
+
+def _finish_turn(llm: Llama, session: ConversationSession, prompt: list[int], raw: str) -> None:
+    """Дописывает в сессию ход и сгенерированный ответ (они уже в KV-кэше)."""
+    reply = llm.tokenize((raw + "\n").encode("utf-8"), add_bos=False, special=True)
+    session.append(prompt[len(session.tokens):] + reply)
+
+
+def session_stats() -> dict[str, Any]:
+    return {name: session.status() for name, session in list(_sessions.items())}
+
+
+def reset_sessions() -> None:
+    """Забывает все диалоговые сессии: следующий ход каждой начнётся с пустой истории."""
+    global _kv_owner
+    with _sessions_lock:
+        _sessions.clear()
+        _kv_owner = None
+
+
+register_handler("GET", "/sessions", lambda body: session_stats())
+
+
 def clean_response(text: str) -> str:
     """Удаляет повторяющиеся фрагменты из ответа модели."""
     seen = set()
@@ -47,27 +336,208 @@ def clean_response(text: str) -> str:
             parts.append(part)
     return ", ".join(parts)
 
+@recorded("llm")
 def generate_response(
     prompt: str,
     history: list[str] | None = None,
-    temperature: float = 0.88,
+    temperature: float | None = None,
     max_tokens: int = 60,
+    cache_key: str | None = None,
+    background: bool = False,
+    persona: str | None = None,
+    seed: int | None = None,
+    session: str | None = None,
+    cache_scope: str = "",
+    cache_author: str | None = None,
+    remember: bool = True,
 ) -> str:
     """
     Генерирует ответ модели на заданный запрос с учётом истории.
     Стоп-фразы предотвращают продолжение своей же речи.
+
+    background=True — фоновая генерация: она ждёт, пока модель свободна,
+    и прерывается (возвращает пустую строку), как только появляется
+    основной запрос. persona заменяет SYSTEM_PERSONA (например, характер
+    для отдельного канала Twitch).
+
+    Кэш используется, только если вызывающий код передал cache_key —
+    текст, по которому искать похожие запросы (например, только сообщение
+    зрителя без обрамления промпта). Промпты из общего шаблона (экран,
+    размышления) похожи друг на друга по триграммам и в кэш не попадают.
+    cache_scope отделяет записи кэша (например, канал); характер добавляется
+    к нему автоматически. cache_author — имя зрителя: в кэше оно хранится
+    шаблоном, поэтому ответ на тот же вопрос достаётся и другим зрителям.
+
+    seed фиксирует выборку токенов (воспроизведение записанных сеансов).
+
+    session — имя диалоговой сессии в KV-кэше ("voice", "chat:<канал>",
+    "thinker"): history тогда не нужна, модель считает только новый ход
+    (см. ConversationSession). remember=False — ход не записывается в
+    сессию (спекулятивная мысль, которая может не прозвучать); его можно
+    дописать позже через remember_turn.
     """
+    use_cache = cache_key is not None
+    if use_cache and persona is not None:
+        cache_scope = f"{cache_scope}:{zlib.crc32(persona.encode('utf-8')):08x}"
+    if use_cache:
+        cached = response_cache.lookup(cache_key, cache_scope, cache_author)
+        if cached is not None:
+            if session is not None:
+                remember_turn(session, prompt, cached)
+            return cached
+
     history_prompt = "\n".join(history or [])
     full_prompt = (
-        f"{SYSTEM_PERSONA.strip()}\n\n{history_prompt}\n"
+        f"{(persona or SYSTEM_PERSONA).strip()}\n\n{history_prompt}\n"
         f"{USER_NAME}: {prompt.strip()}\nЭлейн-Сама:"
     )
     stop_words = [f"\n{USER_NAME}:", "\nТы:", "\nЭлейн-Сама:"]
+    if temperature is None:
+        temperature = LLM_SETTINGS["temperature"]
+
+    with llm_gate.acquire(background), llm_slot.use() as llm, arbiter.active("llm"), _sessions_lock:
+        state = None
+        llm_prompt: str | list[int] = full_prompt
+        if session is not None:
+            state = _get_session(llm, session, f"{(persona or SYSTEM_PERSONA).strip()}\n\n")
+            llm_prompt = _session_prompt(llm, state, _turn_text(USER_NAME, prompt), max_tokens)
+        else:
+            _activate(llm, None)
+        if background:
+            # Генерируем потоково, чтобы уступить модель основному запросу
+            pieces = []
+            for chunk in llm(
+                llm_prompt,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stop=stop_words,
+                stream=True,
+                seed=seed,
+            ):
+                if llm_gate.foreground_waiting():
+                    return ""
+                pieces.append(chunk["choices"][0]["text"])
+            raw = "".join(pieces)
+        else:
+            res = llm(
+                llm_prompt,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stop=stop_words,
+                seed=seed,
+            )
+            raw = res["choices"][0]["text"]
+        if state is not None and remember:
+            _finish_turn(llm, state, llm_prompt, raw)
+    text = clean_response(raw.strip())
+    if use_cache:
+        response_cache.store(cache_key, text, cache_scope, cache_author)
+    return text
+
+# Эмоции, которые модель может указать в структурированном ответе.
+# Каждая соответствует выражению в VTube Studio (см. vtube_controller).
+EMOTIONS = ("neutral", "happy", "smug", "angry", "sad", "surprised", "shy")
+SENTENCE_END = ".!?…"
+MAX_SENTENCES = 3
+
+# GBNF-грамматика ответа: реплика из 1–MAX_SENTENCES предложений, каждое
+# обязано заканчиваться знаком конца предложения, поэтому ответ не
+# обрывается на середине и не продолжается бесконечно.
+RESPONSE_GRAMMAR = r'''
+root ::= "{" ws "\"reply\":" ws reply "," ws "\"emotion\":" ws emotion "," ws "\"target_user\":" ws name ws "}"
+reply ::= "\"" sentence@MORE@ "\""
+sentence ::= [^"\\.!?…\n ] [^"\\.!?…\n]* [.!?…]+
+emotion ::= @EMOTIONS@
+name ::= "\"" [^"\\\n]{0,40} "\""
+ws ::= " "?
+'''.replace("@EMOTIONS@", " | ".join(f'"\\"{e}\\""' for e in EMOTIONS)).replace(
+    "@MORE@", ' (" " sentence)?' * (MAX_SENTENCES - 1)
+)
+
+_response_grammar: LlamaGrammar | None = None
+
+def _get_grammar() -> LlamaGrammar:
+    """Компилирует грамматику ответа при первом обращении."""
+    global _response_grammar
+    if _response_grammar is None:
+        _response_grammar = LlamaGrammar.from_string(RESPONSE_GRAMMAR, verbose=False)
+    return _response_grammar
 
-    res = llm(
-        full_prompt,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        stop=stop_words
+def _trim_to_sentence(text: str) -> str:
+    """Обрезает текст по последней границе предложения."""
+    text = text.strip()
+    if not text or text[-1] in SENTENCE_END:
+        return text
+    cut = max(text.rfind(ch) for ch in SENTENCE_END)
+    return text[:cut + 1] if cut > 0 else text + "."
+
+def _salvage_structured(raw: str) -> dict[str, str]:
+    """Разбирает оборванный по max_tokens JSON: берёт то, что успело сгенерироваться."""
+    reply = re.search(r'"reply"\s*:\s*"([^"]*)', raw)
+    emotion = re.search(r'"emotion"\s*:\s*"(\w+)"', raw)
+    target = re.search(r'"target_user"\s*:\s*"([^"]*)"', raw)
+    return {
+        "reply": reply.group(1) if reply else "",
+        "emotion": emotion.group(1) if emotion else "neutral",
+        "target_user": target.group(1) if target else "",
+    }
+
+@recorded("llm_structured")
+def generate_structured_response(
+    prompt: str,
+    history: list[str] | None = None,
+    temperature: float | None = None,
+    max_tokens: int = 120,
+    target_user: str = USER_NAME,
+    seed: int | None = None,
+    session: str | None = None,
+) -> dict[str, str]:
+    """
+    Генерирует ответ в структурированном виде
+    {"reply": ..., "emotion": ..., "target_user": ...}.
+
+    Вывод ограничен GBNF-грамматикой: реплика состоит не более чем из
+    MAX_SENTENCES законченных предложений, а эмоция — одна из EMOTIONS.
+    Если генерация всё же упёрлась в max_tokens, реплика обрезается по
+    последней границе предложения.
+
+    session — как в generate_response: история берётся из KV-кэша сессии,
+    прошлые ответы хранятся в ней в том же JSON-виде.
+    """
+    header = (
+        f"{SYSTEM_PERSONA.strip()}\n"
+        f"Отвечай в формате JSON: reply — твоя реплика, emotion — твоя эмоция "
+        f"({', '.join(EMOTIONS)}), target_user — кому ты отвечаешь.\n\n"
     )
-    return clean_response(res["choices"][0]["text"].strip())
\ No newline at end of file
+    history_prompt = "\n".join(history or [])
+    full_prompt = f"{header}{history_prompt}\n{_turn_text(target_user, prompt)}"
+    if temperature is None:
+        temperature = LLM_SETTINGS["temperature"]
+    with llm_gate.foreground(), llm_slot.use() as llm, arbiter.active("llm"), _sessions_lock:
+        state = None
+        llm_prompt: str | list[int] = full_prompt
+        if session is not None:
+            state = _get_session(llm, session, header)
+            llm_prompt = _session_prompt(llm, state, _turn_text(target_user, prompt), max_tokens)
+        else:
+            _activate(llm, None)
+        res = llm(
+            llm_prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            grammar=_get_grammar(),
+            seed=seed,
+        )
+        raw = res["choices"][0]["text"]
+        if state is not None:
+            _finish_turn(llm, state, llm_prompt, raw)
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        data = _salvage_structured(raw)
+    emotion = data.get("emotion", "neutral")
+    return {
+        "reply": _trim_to_sentence(clean_response(str(data.get("reply", "")))),
+        "emotion": emotion if emotion in EMOTIONS else "neutral",
+        "target_user": str(data.get("target_user") or target_user),
+    }
@@ -0,0 +1,334 @@
+"""
+Долговременная память ассистента в виде сегментированного журнала.
+
+Вместо одного растущего `memory.log` записи раскладываются по суточным
+сегментам в каталоге `memory/`:
+
+* `YYYY-MM-DD.dat` — тела записей (UTF‑8) подряд, только дозапись;
+* `YYYY-MM-DD.idx` — индекс фиксированного размера: время, смещение
+  и длина каждой записи.
+
+Чтение идёт через mmap, поэтому загрузка последних N записей стоит O(N),
+а не O(размер файла), а выборка по интервалу времени — бинарный поиск по
+индексу. Запись не блокирует вызывающий поток: записи копятся в очереди
+и сбрасываются на диск пачками фоновым потоком. Тот же поток раз в сутки
+компактизирует журнал (старые сегменты удаляются, повторы вычищаются);
+первый раз — при открытии хранилища.
+
+Использование:
+
+```python
+store = MemoryStore("memory")
+store.append("Экран: ...\\nЭлейн-Сама: ...")
+last = store.tail(4)
+today = store.query(start=time.time() - 3600)
+```
+"""
+
+from __future__ import annotations
+
+import atexit
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Iterator, Optional
+
+# Запись индекса: время (float64), смещение (uint64), длина (uint32)
+INDEX_RECORD = struct.Struct("<dQI")
+DATA_SUFFIX = ".dat"
+INDEX_SUFFIX = ".idx"
+LEGACY_MARKER = ".legacy_imported"
+
+
+class _Segment:
+    """Один суточный сегмент журнала (пара файлов .dat/.idx)."""
+
+    def __init__(self, directory: str, day: str) -> None:
+        self.day = day
+        self.data_path = os.path.join(directory, day + DATA_SUFFIX)
+        self.index_path = os.path.join(directory, day + INDEX_SUFFIX)
+
+    def count(self) -> int:
+        try:
+            return os.path.getsize(self.index_path) // INDEX_RECORD.size
+        except OSError:
+            return 0
+
+    def read(self, first: int = 0, last: Optional[int] = None) -> list[tuple[float, str]]:
+        """Читает записи с номерами [first, last) через mmap."""
+        n = self.count()
+        last = n if last is None else min(last, n)
+        if first >= last:
+            return []
+        with open(self.index_path, "rb") as fi, open(self.data_path, "rb") as fd:
+            if os.fstat(fd.fileno()).st_size == 0:
+                return []
+            with mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as idx, \
+                    mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                result = []
+                for i in range(first, last):
+                    ts, offset, length = INDEX_RECORD.unpack_from(idx, i * INDEX_RECORD.size)
+                    if offset + length > len(data):
+                        # Индекс опережает данные (обрыв записи) — дальше читать нечего
+                        break
+                    result.append((ts, data[offset:offset + length].decode("utf-8", "replace")))
+                return result
+
+    def bisect_time(self, ts: float) -> int:
+        """Номер первой записи со временем >= ts."""
+        n = self.count()
+        if n == 0:
+            return 0
+        with open(self.index_path, "rb") as fi:
+            with mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as idx:
+                lo, hi = 0, n
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if INDEX_RECORD.unpack_from(idx, mid * INDEX_RECORD.size)[0] < ts:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                return lo
+
+    def repair(self) -> None:
+        """Обрезает неполную запись индекса, оставшуюся после сбоя."""
+        try:
+            size = os.path.getsize(self.index_path)
+        except OSError:
+            return
+        tail = size % INDEX_RECORD.size
+        if tail:
+            with open(self.index_path, "r+b") as f:
+                f.truncate(size - tail)
+
+    def remove(self) -> None:
+        for path in (self.data_path, self.index_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class MemoryStore:
+    """
+    Сегментированное хранилище записей памяти.
+
+    directory – каталог с сегментами. flush_interval – как часто фоновый
+    поток сбрасывает накопленные записи на диск (секунды). retention_days –
+    сколько дней хранить сегменты при компактизации (0 — без ограничения).
+    compact_interval – как часто фоновый поток компактизирует журнал
+    (секунды, 0 — только при открытии).
+    """
+
+    def __init__(
+        self,
+        directory: str = "memory",
+        flush_interval: float = 1.0,
+        retention_days: int = 30,
+        compact_interval: float = 86400.0,
+    ) -> None:
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self.compact_interval = compact_interval
+        os.makedirs(directory, exist_ok=True)
+        self._queue: "queue.Queue[tuple[float, str]]" = queue.Queue()
+        self._io_lock = threading.Lock()
+        self._flushed = threading.Condition()
+        self._pending = 0
+        for day in self._days():
+            _Segment(directory, day).repair()
+        self._compact(retention_days)
+        self._writer = threading.Thread(target=self._writer_loop, name="memory-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.flush)
+
+    # ------------------------------------------------------------------
+    # Запись
+    def append(self, entry: str, ts: Optional[float] = None) -> None:
+        """Ставит запись в очередь на запись. Не блокирует вызывающий поток."""
+        if not entry:
+            return
+        with self._flushed:
+            self._pending += 1
+        self._queue.put((time.time() if ts is None else ts, entry))
+
+    def flush(self, timeout: float = 5.0) -> None:
+        """Ждёт, пока все поставленные записи окажутся на диске."""
+        deadline = time.monotonic() + timeout
+        with self._flushed:
+            while self._pending > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._flushed.wait(remaining)
+
+    def _writer_loop(self) -> None:
+        next_compact = time.monotonic() + self.compact_interval
+        while True:
+            timeout = max(0.0, next_compact - time.monotonic()) if self.compact_interval > 0 else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is not None:
+                self._write_pending(item)
+            if self.compact_interval > 0 and time.monotonic() >= next_compact:
+                try:
+                    self._compact(self.retention_days)
+                except Exception:
+                    pass
+                next_compact = time.monotonic() + self.compact_interval
+
+    def _write_pending(self, item: tuple[float, str]) -> None:
+        batch = [item]
+        # Собираем всё, что накопилось за интервал, в одну пачку
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            self._write_batch(batch)
+        except Exception:
+            # игнорируем ошибки записи, чтобы не мешать основному процессу
+            pass
+        with self._flushed:
+            self._pending -= len(batch)
+            self._flushed.notify_all()
+
+    def _write_batch(self, batch: list[tuple[float, str]]) -> None:
+        by_day: dict[str, list[tuple[float, bytes]]] = {}
+        for ts, entry in batch:
+            by_day.setdefault(self._day_of(ts), []).append((ts, entry.encode("utf-8")))
+        with self._io_lock:
+            for day, records in by_day.items():
+                seg = _Segment(self.directory, day)
+                # Сначала данные, затем индекс: индекс никогда не ссылается
+                # на незаписанные байты
+                with open(seg.data_path, "ab") as fd:
+                    offset = fd.tell()
+                    index = bytearray()
+                    for ts, payload in records:
+                        fd.write(payload)
+                        index += INDEX_RECORD.pack(ts, offset, len(payload))
+                        offset += len(payload)
+                with open(seg.index_path, "ab") as fi:
+                    fi.write(index)
+
+    # ------------------------------------------------------------------
+    # Чтение
+    def tail(self, n: int) -> list[str]:
+        """Возвращает последние n записей (от старых к новым)."""
+        if n <= 0:
+            return []
+        result: list[str] = []
+        with self._io_lock:
+            for day in reversed(self._days()):
+                seg = _Segment(self.directory, day)
+                need = n - len(result)
+                count = seg.count()
+                records = seg.read(max(0, count - need), count)
+                result = [entry for _, entry in records] + result
+                if len(result) >= n:
+                    break
+        return result[-n:]
+
+    def query(self, start: Optional[float] = None, end: Optional[float] = None) -> list[tuple[float, str]]:
+        """Возвращает записи с временем в интервале [start, end)."""
+        first_day = self._day_of(start) if start is not None else None
+        last_day = self._day_of(end) if end is not None else None
+        result: list[tuple[float, str]] = []
+        with self._io_lock:
+            for day in self._days():
+                if (first_day and day < first_day) or (last_day and day > last_day):
+                    continue
+                seg = _Segment(self.directory, day)
+                lo = seg.bisect_time(start) if start is not None else 0
+                hi = seg.bisect_time(end) if end is not None else None
+                result.extend(seg.read(lo, hi))
+        return result
+
+    def __iter__(self) -> Iterator[tuple[float, str]]:
+        return iter(self.query())
+
+    # ------------------------------------------------------------------
+    # Обслуживание
+    def compact(self, retention_days: Optional[int] = None) -> None:
+        """
+        Удаляет сегменты старше retention_days и переписывает закрытые
+        сегменты без подряд идущих повторов (наблюдатель экрана часто
+        сохраняет одно и то же описание несколько раз).
+        """
+        self.flush()
+        self._compact(self.retention_days if retention_days is None else retention_days)
+
+    def _compact(self, retention: int) -> None:
+        # Без flush(): вызывается и из фонового потока записи
+        today = self._day_of(time.time())
+        cutoff = (date.today() - timedelta(days=retention)).isoformat() if retention else ""
+        with self._io_lock:
+            for day in self._days():
+                seg = _Segment(self.directory, day)
+                if cutoff and day < cutoff:
+                    seg.remove()
+                    continue
+                if day == today:
+                    continue
+                records = seg.read()
+                kept = [r for i, r in enumerate(records) if i == 0 or r[1] != records[i - 1][1]]
+                if len(kept) == len(records):
+                    continue
+                tmp = _Segment(self.directory, day + ".tmp")
+                tmp.remove()
+                offset = 0
+                with open(tmp.data_path, "wb") as fd, open(tmp.index_path, "wb") as fi:
+                    for ts, entry in kept:
+                        payload = entry.encode("utf-8")
+                        fd.write(payload)
+                        fi.write(INDEX_RECORD.pack(ts, offset, len(payload)))
+                        offset += len(payload)
+                os.replace(tmp.data_path, seg.data_path)
+                os.replace(tmp.index_path, seg.index_path)
+
+    def import_legacy(self, path: str) -> int:
+        """
+        Однократно переносит записи из старого текстового `memory.log`.
+        Возвращает число перенесённых строк.
+        """
+        marker = os.path.join(self.directory, LEGACY_MARKER)
+        if os.path.exists(marker) or not os.path.exists(path):
+            return 0
+        try:
+            ts = os.path.getmtime(path)
+            with open(path, "r", encoding="utf-8") as f:
+                lines = [line.strip() for line in f if line.strip()]
+        except Exception:
+            return 0
+        for line in lines:
+            self.append(line, ts)
+        self.flush()
+        with open(marker, "w", encoding="utf-8") as f:
+            f.write(path)
+        return len(lines)
+
+    def _days(self) -> list[str]:
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        days = [n[:-len(INDEX_SUFFIX)] for n in names if n.endswith(INDEX_SUFFIX) and ".tmp" not in n]
+        days.sort()
+        return days
+
+    @staticmethod
+    def _day_of(ts: float) -> str:
+        return datetime.fromtimestamp(ts).date().isoformat()
@@ -0,0 +1,205 @@
+"""
+Выгрузка простаивающих моделей и реакция на нехватку памяти.
+
+Whisper, llama, XTTS, Silero, Piper и BLIP вместе не помещаются в
+память обычной стрим‑машины, а часть из них нужна редко: BLIP — только
+когда размышлятель смотрит на экран, запасные голоса — только на всплеск
+чата. Менеджер раз в check_interval секунд:
+
+* выгружает модель из списка idle_seconds, если к ней не обращались
+  дольше заданного времени;
+* если свободной RAM меньше min_available_ram_mb или свободной VRAM
+  меньше min_free_vram_mb, выгружает выгружаемые модели по давности
+  последнего использования, пока свободной памяти не станет больше
+  порога с запасом hysteresis_mb. При нехватке VRAM выгружаются только
+  модели, занимающие VRAM.
+
+После выгрузки по нехватке памяти следующая такая выгрузка возможна не
+раньше чем через eviction_backoff секунд; пока нехватка держится, пауза
+удваивается (до восьмикратной), чтобы не гонять модели туда‑обратно.
+
+Модели, занятые запросом, не трогаются. Следующее обращение загрузит
+модель снова: `EngineSlot.prefetch()` начинает загрузку в фоне, как
+только модель понадобится (подпись кадра, выбор голоса маршрутизатором),
+а веса GGUF и safetensors отображаются через mmap, поэтому повторная
+загрузка идёт из кэша страниц ОС.
+
+Состояние: `GET /lifecycle`; выгрузить вручную: `POST /evict/<движок>`.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any, Optional
+
+try:
+    import psutil  # type: ignore
+except ImportError:
+    psutil = None
+
+try:
+    from .resource_arbiter import arbiter  # type: ignore
+    from .runtime_config import SLOTS, EngineSlot, register_handler, section  # type: ignore
+except ImportError:
+    from resource_arbiter import arbiter  # type: ignore
+    from runtime_config import SLOTS, EngineSlot, register_handler, section  # type: ignore
+
+# Настройки (секция "lifecycle" в elaine_config.json). idle_seconds —
+# какие движки можно выгружать и через сколько секунд простоя.
+LIFECYCLE_SETTINGS = section("lifecycle", {
+    "check_interval": 30,
+    "idle_seconds": {"caption": 600, "silero": 900, "piper": 900},
+    "min_available_ram_mb": 2048,
+    "min_free_vram_mb": 768,
+    "hysteresis_mb": 512,
+    "eviction_backoff": 60,
+})
+
+
+def available_ram_mb() -> Optional[int]:
+    if psutil is None:
+        return None
+    return int(psutil.virtual_memory().available // (1024 * 1024))
+
+
+class ModelLifecycleManager:
+    """Следит за простоем и давлением на память и выгружает лишние модели."""
+
+    def __init__(self, settings: dict[str, Any]) -> None:
+        self.settings = settings
+        self.evictions: dict[str, int] = {}
+        self.last_check: Optional[float] = None
+        self._backoff = 0.0
+        self._quiet_until = 0.0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    # ------------------------------------------------------------------
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="model-lifecycle", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while not self._stop.wait(float(self.settings["check_interval"])):
+            try:
+                self.check()
+            except Exception as e:
+                print(f"⚠️ Ошибка менеджера моделей: {e}")
+
+    # ------------------------------------------------------------------
+    def _evictable(self) -> list[EngineSlot]:
+        """Загруженные и свободные выгружаемые слоты, давно не используемые — первыми."""
+        slots = [
+            SLOTS[name] for name in self.settings["idle_seconds"]
+            if name in SLOTS and SLOTS[name].loaded and not SLOTS[name].in_use
+        ]
+        return sorted(slots, key=lambda slot: slot.last_used)
+
+    def _pressure(self, margin: int = 0) -> Optional[str]:
+        """Какой памяти не хватает (с запасом margin МБ): "ram", "vram" или None."""
+        ram = available_ram_mb()
+        if ram is not None and ram < int(self.settings["min_available_ram_mb"]) + margin:
+            return "ram"
+        vram = arbiter.free_vram_mb()
+        if vram is not None and vram < int(self.settings["min_free_vram_mb"]) + margin:
+            return "vram"
+        return None
+
+    def check(self) -> list[str]:
+        """Один проход: выгрузка по простою, затем по нехватке памяти. Возвращает выгруженные."""
+        evicted: list[str] = []
+        with self._lock:
+            self.last_check = time.time()
+            now = time.monotonic()
+            for slot in self._evictable():
+                limit = float(self.settings["idle_seconds"][slot.name])
+                if now - slot.last_used >= limit and self._evict(slot, f"простой {now - slot.last_used:.0f} с"):
+                    evicted.append(slot.name)
+
+            pressure = self._pressure()
+            if pressure is None:
+                self._backoff = 0.0
+                return evicted
+            if now < self._quiet_until:
+                return evicted
+            freed = 0
+            while pressure is not None:
+                candidates = self._evictable()
+                if pressure == "vram":
+                    # Выгрузка CPU-моделей VRAM не освободит
+                    candidates = [s for s in candidates if s.footprint["vram_mb"] > 0]
+                if not candidates:
+                    break
+                slot = candidates[0]
+                if not self._evict(slot, f"не хватает {pressure.upper()}"):
+                    break
+                evicted.append(slot.name)
+                freed += 1
+                pressure = self._pressure(int(self.settings["hysteresis_mb"]))
+            if freed:
+                base = float(self.settings["eviction_backoff"])
+                self._backoff = min(max(base, self._backoff * 2), base * 8)
+                self._quiet_until = now + self._backoff
+        return evicted
+
+    def _evict(self, slot: EngineSlot, reason: str) -> bool:
+        if not slot.unload():
+            return False
+        self.evictions[slot.name] = self.evictions.get(slot.name, 0) + 1
+        freed = slot.footprint["rss_mb"] + slot.footprint["vram_mb"]
+        print(f"💤 Модель {slot.name} выгружена ({reason}), освобождено ~{freed:.0f} МБ.")
+        return True
+
+    def evict(self, name: str) -> bool:
+        """Выгружает движок по имени (дождавшись начатых запросов)."""
+        slot = SLOTS.get(name)
+        if slot is None:
+            raise ValueError(f"неизвестный движок: {name}")
+        with self._lock:
+            return self._evict(slot, "по запросу")
+
+    def status(self) -> dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "available_ram_mb": available_ram_mb(),
+            "free_vram_mb": arbiter.free_vram_mb(),
+            "pressure": self._pressure(),
+            "last_check": self.last_check,
+            "backoff_seconds": round(max(0.0, self._quiet_until - now), 1),
+            "engines": {
+                name: {
+                    "loaded": slot.loaded,
+                    "evictable": name in self.settings["idle_seconds"],
+                    "idle_seconds": round(now - slot.last_used, 1),
+                    "load_seconds": slot.load_seconds,
+                    "footprint": dict(slot.footprint),
+                    "evictions": self.evictions.get(name, 0),
+                }
+                for name, slot in SLOTS.items()
+            },
+        }
+
+
+lifecycle = ModelLifecycleManager(LIFECYCLE_SETTINGS)
+
+
+def start_lifecycle_manager() -> None:
+    """Запускает фоновую проверку простоя и памяти."""
+    lifecycle.start()
+
+
+def _evict_handler(body: dict[str, Any]) -> dict[str, Any]:
+    name = body.pop("_arg")
+    return {"evicted": lifecycle.evict(name), "engine": name}
+
+
+register_handler("GET", "/lifecycle", lambda body: lifecycle.status())
+register_handler("POST", "/evict/*", _evict_handler)
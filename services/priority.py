@@ -0,0 +1,63 @@
+"""
+Приоритетный доступ к общим движкам (LLM, TTS).
+
+Модели не потокобезопасны, поэтому вызовы к ним сериализуются. Запросы
+делятся на два класса: основные (ответ на голос и чат) и фоновые
+(спекулятивная подготовка мыслей AutoThinker). Фоновые запросы ждут,
+пока нет ни активного, ни ожидающего основного запроса, и могут
+проверять `foreground_waiting()`, чтобы прерваться и уступить движок.
+"""
+
+from __future__ import annotations
+
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class PriorityGate:
+    """Блокировка с приоритетом основных запросов над фоновыми."""
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._busy = False
+        self._foreground_waiting = 0
+
+    @contextmanager
+    def foreground(self) -> Iterator[None]:
+        with self._cond:
+            self._foreground_waiting += 1
+            try:
+                while self._busy:
+                    self._cond.wait()
+            finally:
+                self._foreground_waiting -= 1
+            self._busy = True
+        try:
+            yield
+        finally:
+            self._release()
+
+    @contextmanager
+    def background(self) -> Iterator[None]:
+        with self._cond:
+            while self._busy or self._foreground_waiting:
+                self._cond.wait()
+            self._busy = True
+        try:
+            yield
+        finally:
+            self._release()
+
+    def acquire(self, background: bool = False):
+        """Возвращает контекст нужного приоритета."""
+        return self.background() if background else self.foreground()
+
+    def foreground_waiting(self) -> bool:
+        """Есть ли основной запрос, которому стоит уступить движок."""
+        return self._foreground_waiting > 0
+
+    def _release(self) -> None:
+        with self._cond:
+            self._busy = False
+            self._cond.notify_all()
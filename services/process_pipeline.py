@@ -0,0 +1,407 @@
+"""
+Многопроцессный конвейер STT → LLM → TTS.
+
+В обычном режиме (`main.py`) Whisper, llama.cpp и XTTS живут в одном
+процессе и делят GIL, пул потоков torch и CUDA‑контекст. Здесь каждая
+стадия работает в своём процессе:
+
+* звук передаётся через кольцевые буферы в `multiprocessing.shared_memory`
+  (микрофон → STT и TTS → воспроизведение) без копирования через pickle;
+* текст и события идут по небольшим управляющим очередям;
+* для каждой стадии задаются привязка к ядрам CPU и число потоков;
+* если стадия упала, перезапускается только её процесс — остальные
+  модели не перезагружаются.
+
+Родительский процесс только пишет звук с микрофона и проигрывает
+готовую речь с мимикой VTube Studio.
+
+Запуск (из корня проекта):
+
+```bash
+python -m services.process_pipeline
+```
+"""
+
+from __future__ import annotations
+
+import multiprocessing as mp
+import os
+import queue
+import struct
+import threading
+import time
+from dataclasses import dataclass, field
+from multiprocessing import shared_memory
+from typing import Any, Optional
+
+import numpy as np  # type: ignore
+
+STT_RING = "elaine_stt_pcm"
+TTS_RING = "elaine_tts_pcm"
+STT_RATE = 16000
+TTS_RATE = 24000
+# Ёмкость буферов в секундах звука
+STT_RING_SECONDS = 30
+TTS_RING_SECONDS = 120
+# Как часто супервизор проверяет, живы ли стадии
+SUPERVISE_INTERVAL = 1.0
+
+
+@dataclass
+class StageConfig:
+    """
+    Настройки процесса стадии.
+
+    cpu_affinity – номера ядер, на которых разрешено работать процессу
+    (None — без ограничений). num_threads – число потоков torch/OpenMP
+    (None — значение по умолчанию).
+    """
+
+    name: str
+    cpu_affinity: Optional[list[int]] = None
+    num_threads: Optional[int] = None
+    env: dict[str, str] = field(default_factory=dict)
+
+
+def _default_stages() -> dict[str, StageConfig]:
+    """
+    Ядра делятся между процессами стадий по весам resource_arbiter.
+    План строится при запуске конвейера, а не при импорте модуля: дочерние
+    процессы (spawn) импортируют его заново, и им план не нужен.
+    """
+    from services.resource_arbiter import arbiter
+
+    plan = arbiter.affinity_plan(["stt", "llm", "tts"])
+    return {name: StageConfig(name, cpu_affinity=cpus, num_threads=len(cpus)) for name, cpus in plan.items()}
+
+
+# ----------------------------------------------------------------------
+# Кольцевой буфер в разделяемой памяти
+class SharedRingBuffer:
+    """
+    Кольцевой буфер float32‑сэмплов для одного писателя и одного читателя.
+
+    В заголовке хранятся монотонные счётчики записанных и прочитанных
+    сэмплов; писатель меняет только первый, читатель — только второй,
+    поэтому блокировки не нужны.
+    """
+
+    _HEADER = struct.Struct("<QQ")
+
+    def __init__(self, name: str, capacity: int = 0, create: bool = False) -> None:
+        if create:
+            try:
+                # Остаток от прошлого аварийного завершения
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+            except FileNotFoundError:
+                pass
+            size = self._HEADER.size + capacity * 4
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self._HEADER.pack_into(self.shm.buf, 0, 0, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.owner = create
+        self.capacity = (self.shm.size - self._HEADER.size) // 4
+        self.data = np.ndarray((self.capacity,), dtype=np.float32, buffer=self.shm.buf, offset=self._HEADER.size)
+
+    def _positions(self) -> tuple[int, int]:
+        return self._HEADER.unpack_from(self.shm.buf, 0)
+
+    def available(self) -> int:
+        written, read = self._positions()
+        return written - read
+
+    def write_position(self) -> int:
+        """Сколько сэмплов записано за всё время (позиция следующей записи)."""
+        return self._positions()[0]
+
+    def seek(self, position: int) -> None:
+        """
+        Переставляет позицию чтения на начало сообщения (вызывается
+        читателем). Хвосты прерванных сообщений, например после
+        перезапуска стадии, при этом отбрасываются.
+        """
+        _, read = self._positions()
+        if position > read:
+            struct.pack_into("<Q", self.shm.buf, 8, position)
+
+    def write(self, samples: np.ndarray, timeout: float = 5.0) -> bool:
+        """Записывает сэмплы, ожидая свободного места не дольше timeout."""
+        samples = np.asarray(samples, dtype=np.float32).ravel()
+        deadline = time.monotonic() + timeout
+        pos = 0
+        while pos < len(samples):
+            written, read = self._positions()
+            free = self.capacity - (written - read)
+            if free == 0:
+                if time.monotonic() > deadline:
+                    return False
+                time.sleep(0.005)
+                continue
+            n = min(free, len(samples) - pos)
+            start = written % self.capacity
+            first = min(n, self.capacity - start)
+            self.data[start:start + first] = samples[pos:pos + first]
+            if n > first:
+                self.data[:n - first] = samples[pos + first:pos + n]
+            pos += n
+            struct.pack_into("<Q", self.shm.buf, 0, written + n)
+        return True
+
+    def read(self, n: int, timeout: float = 5.0) -> np.ndarray:
+        """Читает ровно n сэмплов (или меньше, если истёк timeout)."""
+        out = np.empty(n, dtype=np.float32)
+        deadline = time.monotonic() + timeout
+        pos = 0
+        while pos < n:
+            written, read = self._positions()
+            ready = written - read
+            if ready == 0:
+                if time.monotonic() > deadline:
+                    return out[:pos]
+                time.sleep(0.005)
+                continue
+            k = min(ready, n - pos)
+            start = read % self.capacity
+            first = min(k, self.capacity - start)
+            out[pos:pos + first] = self.data[start:start + first]
+            if k > first:
+                out[pos + first:pos + k] = self.data[:k - first]
+            pos += k
+            struct.pack_into("<Q", self.shm.buf, 8, read + k)
+        return out
+
+    def close(self) -> None:
+        del self.data
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+# ----------------------------------------------------------------------
+# Процессы стадий
+def _apply_stage_config(cfg: StageConfig) -> None:
+    """Применяет привязку к ядрам и число потоков до импорта моделей."""
+    os.environ.update(cfg.env)
+    if cfg.num_threads:
+        for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+            os.environ[var] = str(cfg.num_threads)
+    if cfg.cpu_affinity:
+        try:
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, cfg.cpu_affinity)
+            else:
+                import psutil  # type: ignore
+                psutil.Process().cpu_affinity(cfg.cpu_affinity)
+        except Exception as e:
+            print(f"⚠️ [{cfg.name}] Не удалось задать привязку к ядрам: {e}")
+    if cfg.num_threads:
+        # Внутри процесса стадии арбитр делит только её собственные ядра
+        from services.resource_arbiter import arbiter
+
+        arbiter.limit_threads(cfg.num_threads)
+        try:
+            import torch  # type: ignore
+            torch.set_num_threads(cfg.num_threads)
+        except Exception:
+            pass
+
+
+def _stt_worker(cfg: StageConfig, ctrl_in: Any, ctrl_out: Any, events: Any) -> None:
+    _apply_stage_config(cfg)
+    from services.stt_vad import get_whisper_model, transcribe_vad
+
+    ring = SharedRingBuffer(STT_RING)
+    get_whisper_model()
+    events.put({"type": "ready", "stage": cfg.name})
+    while True:
+        msg = ctrl_in.get()
+        if msg is None:
+            break
+        if msg.get("type") != "audio":
+            continue
+        ring.seek(msg["offset"])
+        audio = ring.read(msg["samples"])
+        pcm = (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
+        text = transcribe_vad(pcm)
+        if text.strip():
+            events.put({"type": "text", "text": text})
+            ctrl_out.put({"type": "text", "text": text})
+
+
+def _llm_worker(cfg: StageConfig, ctrl_in: Any, ctrl_out: Any, events: Any) -> None:
+    _apply_stage_config(cfg)
+    from services.llm import generate_response
+
+    events.put({"type": "ready", "stage": cfg.name})
+    while True:
+        msg = ctrl_in.get()
+        if msg is None:
+            break
+        if msg.get("type") != "text":
+            continue
+        user_text = msg["text"]
+        # История живёт в KV-кэше сессии — модель считает только новую реплику
+        response = generate_response(user_text, session="voice")
+        if not response.strip():
+            continue
+        events.put({"type": "reply", "text": response})
+        ctrl_out.put({"type": "reply", "text": response})
+
+
+def _tts_worker(cfg: StageConfig, ctrl_in: Any, ctrl_out: Any, events: Any) -> None:
+    _apply_stage_config(cfg)
+    from services.tts_silero import iter_speech
+
+    ring = SharedRingBuffer(TTS_RING)
+    events.put({"type": "ready", "stage": cfg.name})
+    while True:
+        msg = ctrl_in.get()
+        if msg is None:
+            break
+        if msg.get("type") != "reply":
+            continue
+        # Каждый фрагмент уходит в буфер сразу после синтеза: воспроизведение
+        # начинается с первого предложения, не дожидаясь всей реплики.
+        # Сообщение отправляется только после успешной записи, иначе
+        # читатель ждал бы сэмплы, которых в буфере нет.
+        for audio in iter_speech(msg["text"]):
+            if len(audio) == 0:
+                continue
+            offset = ring.write_position()
+            if not ring.write(audio, timeout=60.0):
+                print(f"⚠️ [{cfg.name}] Буфер TTS переполнен — остаток реплики потерян.")
+                break
+            ctrl_out.put({"type": "speech", "offset": offset, "samples": len(audio), "rate": TTS_RATE})
+
+
+_WORKERS = {"stt": _stt_worker, "llm": _llm_worker, "tts": _tts_worker}
+
+
+# ----------------------------------------------------------------------
+# Супервизор
+class ProcessPipeline:
+    """Запускает стадии, следит за ними и перезапускает упавшие."""
+
+    def __init__(self, stages: Optional[dict[str, StageConfig]] = None) -> None:
+        # None — план по умолчанию, строится в start()
+        self.stages = stages
+        self.ctx = mp.get_context("spawn")
+        self.stt_ring = SharedRingBuffer(STT_RING, STT_RATE * STT_RING_SECONDS, create=True)
+        self.tts_ring = SharedRingBuffer(TTS_RING, TTS_RATE * TTS_RING_SECONDS, create=True)
+        self.events = self.ctx.Queue()
+        self.stt_in = self.ctx.Queue()
+        self.llm_in = self.ctx.Queue()
+        self.tts_in = self.ctx.Queue()
+        self.playback = self.ctx.Queue()
+        self._wiring = {
+            "stt": (self.stt_in, self.llm_in),
+            "llm": (self.llm_in, self.tts_in),
+            "tts": (self.tts_in, self.playback),
+        }
+        self.processes: dict[str, Any] = {}
+        self._running = False
+
+    def start(self) -> None:
+        if self.stages is None:
+            self.stages = _default_stages()
+        self._running = True
+        for name in self._wiring:
+            self._start_stage(name)
+        threading.Thread(target=self._supervise, name="pipeline-supervisor", daemon=True).start()
+        threading.Thread(target=self._playback_loop, name="pipeline-playback", daemon=True).start()
+        threading.Thread(target=self._events_loop, name="pipeline-events", daemon=True).start()
+
+    def _start_stage(self, name: str) -> None:
+        ctrl_in, ctrl_out = self._wiring[name]
+        proc = self.ctx.Process(
+            target=_WORKERS[name],
+            args=(self.stages[name], ctrl_in, ctrl_out, self.events),
+            name=f"elaine-{name}",
+            daemon=True,
+        )
+        proc.start()
+        self.processes[name] = proc
+        print(f"🚀 Стадия {name} запущена (pid {proc.pid}).")
+
+    def _supervise(self) -> None:
+        while self._running:
+            time.sleep(SUPERVISE_INTERVAL)
+            for name, proc in list(self.processes.items()):
+                if self._running and not proc.is_alive():
+                    print(f"💥 Стадия {name} завершилась (код {proc.exitcode}) — перезапускаю только её.")
+                    self._start_stage(name)
+
+    def _events_loop(self) -> None:
+        while self._running:
+            try:
+                msg = self.events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if msg["type"] == "ready":
+                print(f"✅ Стадия {msg['stage']} готова.")
+            elif msg["type"] == "text":
+                print(f"Вы сказали: {msg['text']}")
+            elif msg["type"] == "reply":
+                print(f"Elaine-Сама: {msg['text']}")
+
+    def _playback_loop(self) -> None:
+        from services.audio_output import play_audio
+
+        while self._running:
+            try:
+                msg = self.playback.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if msg.get("type") != "speech":
+                continue
+            self.tts_ring.seek(msg["offset"])
+            audio = self.tts_ring.read(msg["samples"], timeout=60.0)
+            play_audio(audio, samplerate=msg["rate"])
+
+    def submit_audio(self, pcm: np.ndarray) -> None:
+        """Передаёт записанный фрагмент (int16, 16 кГц) в стадию STT."""
+        audio = pcm.astype(np.float32) / 32768.0
+        offset = self.stt_ring.write_position()
+        if not self.stt_ring.write(audio):
+            print("⚠️ Буфер STT переполнен — фрагмент потерян.")
+            return
+        self.stt_in.put({"type": "audio", "offset": offset, "samples": len(audio)})
+
+    def stop(self) -> None:
+        self._running = False
+        for q in (self.stt_in, self.llm_in, self.tts_in):
+            q.put(None)
+        for proc in self.processes.values():
+            proc.join(timeout=3.0)
+            if proc.is_alive():
+                proc.terminate()
+        self.stt_ring.close()
+        self.tts_ring.close()
+
+
+def run_pipeline() -> None:
+    """Голосовой цикл поверх многопроцессного конвейера."""
+    from services.stt_vad import record_vad
+
+    pipeline = ProcessPipeline()
+    pipeline.start()
+    try:
+        while True:
+            audio = record_vad()
+            if getattr(audio, "size", 0) == 0:
+                continue
+            pipeline.submit_audio(audio)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pipeline.stop()
+
+
+if __name__ == "__main__":
+    run_pipeline()
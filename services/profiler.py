@@ -0,0 +1,302 @@
+"""
+Встроенный сэмплирующий профилировщик для работающего ассистента.
+
+Во время эфира к `main.py` не подключишь отладчик, а тормоза обычно
+складываются из нескольких потоков сразу: цикл микрофона, twitchio,
+цикл VTube Studio, рендер и воспроизведение речи. Профилировщик
+включается на лету и N секунд с заданным интервалом снимает стеки всех
+Python‑потоков (`sys._current_frames`), не останавливая их.
+
+Результат складывается в PROFILE_DIR:
+
+* `*.collapsed` — свёрнутые стеки для flamegraph.pl / inferno;
+* `*.speedscope.json` — файл для https://www.speedscope.app;
+* `*.summary.txt` — по каждому потоку: стены и CPU‑время, доля по стадиям.
+
+Каждый стек помечен стадией конвейера (stt, llm, tts, vision, playback,
+vts, twitch) по ближайшему к вершине кадру из известных модулей.
+
+Запуск: `POST /profile {"seconds": 10}` в управляющем API или горячая
+клавиша PROFILE_HOTKEY (нужен пакет `keyboard`). Длительность
+ограничена MAX_SECONDS, интервал — не меньше MIN_INTERVAL.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Any, Optional
+
+try:
+    import psutil  # type: ignore
+except ImportError:
+    psutil = None
+
+try:
+    import keyboard  # type: ignore
+except ImportError:
+    keyboard = None
+
+try:
+    from .runtime_config import register_handler  # type: ignore
+except ImportError:
+    from runtime_config import register_handler  # type: ignore
+
+PROFILE_DIR = "profiles"
+PROFILE_HOTKEY = "ctrl+alt+p"
+DEFAULT_SECONDS = 10.0
+DEFAULT_INTERVAL = 0.01       # 100 снимков в секунду
+MIN_INTERVAL = 0.001          # чаще 1 мс снимки сами становятся нагрузкой
+MAX_SECONDS = 120.0
+MAX_DEPTH = 128
+
+# Стадия по имени модуля или пакета в пути файла (целый сегмент пути,
+# без .py); проверяются от вершины стека вниз
+STAGE_RULES: dict[str, str] = {
+    "stt_vad": "stt", "stt_filter": "stt", "whisper": "stt", "faster_whisper": "stt",
+    "llm": "llm", "llama_cpp": "llm", "chat_sessions": "llm", "response_cache": "llm",
+    "tts_engines": "tts", "tts_silero": "tts", "text_normalizer": "tts", "TTS": "tts", "piper": "tts",
+    "screen_capture": "vision", "pytesseract": "vision", "blip": "vision", "mss": "vision",
+    "audio_output": "playback", "sounddevice": "playback", "speech_queue": "playback",
+    "vtube_controller": "vts", "websockets": "vts",
+    "twitchio": "twitch",
+}
+_PATH_SEPARATORS = re.compile(r"[\\/]")
+
+
+def stage_of(filenames: list[str]) -> str:
+    """Стадия по стеку (список файлов от вершины к основанию)."""
+    for filename in filenames:
+        segments = _PATH_SEPARATORS.split(filename)
+        segments[-1] = os.path.splitext(segments[-1])[0]
+        for segment in reversed(segments):
+            stage = STAGE_RULES.get(segment)
+            if stage is not None:
+                return stage
+    return "other"
+
+
+def _thread_cpu_times() -> dict[int, float]:
+    """CPU‑время (user+system) по native id потоков процесса."""
+    if psutil is not None:
+        try:
+            return {t.id: t.user_time + t.system_time for t in psutil.Process().threads()}
+        except Exception:
+            pass
+    times: dict[int, float] = {}
+    if hasattr(time, "pthread_getcpuclockid"):
+        for thread in threading.enumerate():
+            try:
+                clock = time.pthread_getcpuclockid(thread.ident)
+                times[thread.native_id] = time.clock_gettime(clock)
+            except Exception:
+                continue
+    return times
+
+
+class SamplingProfiler:
+    """Один сеанс сэмплирования всех потоков процесса."""
+
+    def __init__(self, seconds: float = DEFAULT_SECONDS, interval: float = DEFAULT_INTERVAL) -> None:
+        self.seconds = seconds
+        self.interval = interval
+        self.samples: dict[str, Counter] = defaultdict(Counter)   # поток -> стек -> число
+        self.stage_samples: dict[str, Counter] = defaultdict(Counter)
+        self.started = 0.0
+        self.wall = 0.0
+        self.ticks = 0
+        self.cpu: dict[str, float] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> threading.Thread:
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        native = {t.ident: t.native_id for t in threading.enumerate()}
+        cpu_before = _thread_cpu_times()
+        self.started = time.monotonic()
+        deadline = self.started + self.seconds
+        next_tick = self.started
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if ident not in names:
+                    # Поток появился во время сеанса
+                    for t in threading.enumerate():
+                        names.setdefault(t.ident, t.name)
+                        native.setdefault(t.ident, t.native_id)
+                stack: list[str] = []
+                files: list[str] = []
+                depth = 0
+                while frame is not None and depth < MAX_DEPTH:
+                    code = frame.f_code
+                    files.append(code.co_filename)
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                    depth += 1
+                stage = stage_of(files)
+                name = names.get(ident, str(ident))
+                self.samples[name][(f"[{stage}]",) + tuple(reversed(stack))] += 1
+                self.stage_samples[name][stage] += 1
+            del frame
+            self.ticks += 1
+            next_tick += self.interval
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+        self.wall = time.monotonic() - self.started
+        cpu_after = _thread_cpu_times()
+        for ident, name in names.items():
+            nid = native.get(ident)
+            if nid in cpu_before and nid in cpu_after:
+                self.cpu[name] = cpu_after[nid] - cpu_before[nid]
+
+    # ------------------------------------------------------------------
+    # Вывод
+    def collapsed(self) -> str:
+        lines = []
+        for thread, stacks in self.samples.items():
+            for stack, count in stacks.items():
+                frames = ";".join(f.replace(";", ":") for f in stack)
+                lines.append(f"{thread};{frames} {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self) -> dict[str, Any]:
+        frames: list[dict[str, Any]] = []
+        index: dict[str, int] = {}
+
+        def frame_id(name: str) -> int:
+            if name not in index:
+                index[name] = len(frames)
+                frames.append({"name": name})
+            return index[name]
+
+        profiles = []
+        for thread, stacks in self.samples.items():
+            samples, weights = [], []
+            for stack, count in stacks.items():
+                samples.append([frame_id(f) for f in stack])
+                weights.append(count * self.interval)
+            profiles.append({
+                "type": "sampled",
+                "name": thread,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": self.wall,
+                "samples": samples,
+                "weights": weights,
+            })
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"Elaine {time.strftime('%Y-%m-%d %H:%M:%S')}",
+            "exporter": "elaine-profiler",
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+    def summary(self) -> str:
+        lines = [f"Длительность {self.wall:.1f} с, снимков {self.ticks}, интервал {self.interval * 1000:.0f} мс", ""]
+        lines.append(f"{'поток':<28}{'снимков':>9}{'CPU, с':>9}{'CPU %':>8}  стадии")
+        rows = sorted(self.samples, key=lambda t: self.cpu.get(t, 0.0), reverse=True)
+        for thread in rows:
+            total = sum(self.stage_samples[thread].values())
+            cpu = self.cpu.get(thread)
+            stages = ", ".join(
+                f"{stage} {count * 100 // max(1, total)}%" for stage, count in self.stage_samples[thread].most_common(3)
+            )
+            cpu_text = f"{cpu:>9.2f}{cpu * 100 / max(self.wall, 1e-6):>7.0f}%" if cpu is not None else f"{'—':>9}{'—':>8}"
+            lines.append(f"{thread[:27]:<28}{total:>9}{cpu_text}  {stages}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory: str = PROFILE_DIR) -> dict[str, str]:
+        """Сохраняет все три формата и возвращает пути к файлам."""
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, "profile-" + time.strftime("%Y%m%d-%H%M%S"))
+        paths = {
+            "collapsed": base + ".collapsed",
+            "speedscope": base + ".speedscope.json",
+            "summary": base + ".summary.txt",
+        }
+        with open(paths["collapsed"], "w", encoding="utf-8") as f:
+            f.write(self.collapsed())
+        with open(paths["speedscope"], "w", encoding="utf-8") as f:
+            json.dump(self.speedscope(), f, ensure_ascii=False)
+        with open(paths["summary"], "w", encoding="utf-8") as f:
+            f.write(self.summary())
+        return paths
+
+
+# ----------------------------------------------------------------------
+_current: Optional[SamplingProfiler] = None
+_last_result: dict[str, Any] = {}
+_lock = threading.Lock()
+
+
+def start_capture(seconds: float = DEFAULT_SECONDS, interval: float = DEFAULT_INTERVAL) -> dict[str, Any]:
+    """
+    Запускает сеанс профилирования в фоне (если он ещё не идёт).
+    Результаты записываются в PROFILE_DIR по окончании. Интервал не
+    меньше MIN_INTERVAL, длительность — от интервала до MAX_SECONDS.
+    """
+    global _current
+    interval = max(MIN_INTERVAL, float(interval))
+    seconds = min(MAX_SECONDS, max(interval, float(seconds)))
+    with _lock:
+        if _current is not None:
+            return {"running": True, "seconds": _current.seconds}
+        profiler = _current = SamplingProfiler(seconds, interval)
+
+    def finish() -> None:
+        global _current
+        profiler.start().join()
+        try:
+            paths = profiler.write()
+            _last_result.clear()
+            _last_result.update({"paths": paths, "wall": profiler.wall, "ticks": profiler.ticks})
+            print(f"🔥 Профиль записан: {paths['speedscope']}")
+            print(profiler.summary())
+        except OSError as e:
+            print(f"⚠️ Не удалось записать профиль: {e}")
+        finally:
+            with _lock:
+                _current = None
+
+    threading.Thread(target=finish, name="profiler-writer", daemon=True).start()
+    print(f"🔥 Профилирование на {seconds:.0f} с…")
+    return {"running": True, "seconds": seconds}
+
+
+def status() -> dict[str, Any]:
+    return {"running": _current is not None, "last": dict(_last_result)}
+
+
+def install_hotkey(hotkey: str = PROFILE_HOTKEY, seconds: float = DEFAULT_SECONDS) -> bool:
+    """Включает профилирование по горячей клавише (если установлен keyboard)."""
+    if keyboard is None:
+        return False
+    try:
+        keyboard.add_hotkey(hotkey, lambda: start_capture(seconds))
+    except Exception as e:
+        print(f"⚠️ Горячая клавиша профилировщика не установлена: {e}")
+        return False
+    print(f"🔥 Профилировщик: {hotkey} — снять профиль на {seconds:.0f} с.")
+    return True
+
+
+register_handler(
+    "POST",
+    "/profile",
+    lambda body: start_capture(float(body.get("seconds", DEFAULT_SECONDS)), float(body.get("interval", DEFAULT_INTERVAL))),
+)
+register_handler("GET", "/profile", lambda body: status())
@@ -0,0 +1,355 @@
+"""
+Распределение ядер CPU и видеопамяти между движками.
+
+llama.cpp, Whisper, XTTS и BLIP живут в одном процессе. Каждый по
+умолчанию считает, что машина принадлежит только ему: llama берёт все
+потоки, torch — свой пул на все ядра, а модели занимают GPU, не глядя на
+остальных. В итоге потоки толкаются на одних ядрах, а VRAM
+заканчивается на последней загруженной модели.
+
+Арбитр решает:
+
+* сколько потоков получает каждый движок. Доли задаются весами, а
+  делятся только между стадиями, которые сейчас работают: пока LLM
+  генерирует одна, ей достаются все ядра, а когда параллельно идёт
+  синтез речи, ядра делятся. Потоки применяются через
+  `torch.set_num_threads` и `llama_set_n_threads` (n_threads /
+  n_threads_batch) при каждом входе и выходе стадии
+  (`with arbiter.active("tts"):`);
+* на какое устройство ставить модель. Перед переносом на CUDA он
+  проверяет свободную память (`torch.cuda.mem_get_info`) с учётом
+  запаса и резервов ещё не загруженных моделей. Если памяти не хватает,
+  модель остаётся на CPU, а llama получает столько слоёв на GPU, сколько
+  помещается;
+* привязку к ядрам. Её можно задать только процессу целиком, поэтому она
+  применяется в многопроцессном конвейере (process_pipeline), где у
+  каждой стадии свой процесс.
+
+Текущее распределение: `GET /resources` в управляющем API.
+"""
+
+from __future__ import annotations
+
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, Optional
+
+try:
+    import psutil  # type: ignore
+except ImportError:
+    psutil = None
+
+try:
+    from .runtime_config import register_handler, section  # type: ignore
+except ImportError:
+    from runtime_config import register_handler, section  # type: ignore
+
+# Настройки (секция "resources" в elaine_config.json). total_threads = 0 —
+# число физических ядер. weights — доли ядер; vram_mb — сколько VRAM
+# резервировать под модель (llama считает сама по размеру GGUF).
+RESOURCE_SETTINGS = section("resources", {
+    "total_threads": 0,
+    "vram_headroom_mb": 768,
+    "weights": {"llm": 4, "stt": 2, "tts": 2, "caption": 1},
+    "vram_mb": {"stt": 2600, "tts": 2300, "caption": 600},
+})
+
+MIN_THREADS = 1
+
+
+@dataclass
+class Engine:
+    """
+    Зарегистрированный движок: вид ("torch" или "llama"), функция
+    применения потоков и pinned() — число потоков, явно заданное в секции
+    настроек движка (0 — арбитр распределяет сам).
+    """
+
+    name: str
+    kind: str = "torch"
+    apply: Optional[Callable[[int], None]] = None
+    pinned: Optional[Callable[[], int]] = None
+    device: Optional[str] = None
+    reserved_mb: int = 0
+
+
+def physical_cores() -> int:
+    if psutil is not None:
+        count = psutil.cpu_count(logical=False)
+        if count:
+            return count
+    return os.cpu_count() or 1
+
+
+def gguf_block_count(path: str) -> Optional[int]:
+    """
+    Читает число слоёв (`<arch>.block_count`) из заголовка GGUF, не
+    загружая модель. Возвращает None, если прочитать не удалось.
+    """
+    # Размеры скалярных типов GGUF по коду типа
+    sizes = {0: 1, 1: 1, 2: 2, 3: 2, 4: 4, 5: 4, 6: 4, 7: 1, 10: 8, 11: 8, 12: 8}
+    try:
+        with open(path, "rb") as f:
+            if f.read(4) != b"GGUF":
+                return None
+            version, _tensors, kv_count = struct.unpack("<IQQ", f.read(20))
+            if version < 2:
+                return None
+
+            def read_str() -> str:
+                (length,) = struct.unpack("<Q", f.read(8))
+                return f.read(length).decode("utf-8", "replace")
+
+            def skip(kind: int) -> None:
+                if kind == 8:
+                    read_str()
+                elif kind == 9:
+                    item, count = struct.unpack("<IQ", f.read(12))
+                    if item in sizes:
+                        f.seek(sizes[item] * count, os.SEEK_CUR)
+                    else:
+                        for _ in range(count):
+                            skip(item)
+                else:
+                    f.seek(sizes[kind], os.SEEK_CUR)
+
+            for _ in range(kv_count):
+                key = read_str()
+                (kind,) = struct.unpack("<I", f.read(4))
+                if key.endswith(".block_count") and kind in (4, 5):
+                    return struct.unpack("<I", f.read(4))[0]
+                skip(kind)
+    except (OSError, struct.error, KeyError):
+        return None
+    return None
+
+
+class ResourceArbiter:
+    """Раздаёт потоки и VRAM зарегистрированным движкам."""
+
+    def __init__(self, settings: dict[str, Any]) -> None:
+        self.settings = settings
+        self._engines: dict[str, Engine] = {}
+        self._active: dict[str, int] = {}
+        self._lock = threading.RLock()
+        self._torch_threads = 0
+        self._thread_limit = 0
+        # Модели с известным резервом VRAM регистрируются сразу, чтобы
+        # первая загруженная (обычно llama) оставила им место
+        for name in settings["vram_mb"]:
+            self.register(name)
+
+    # ------------------------------------------------------------------
+    @property
+    def total_threads(self) -> int:
+        return int(self._thread_limit or self.settings.get("total_threads") or physical_cores())
+
+    def limit_threads(self, n: int) -> None:
+        """Ограничивает пул процесса n потоками (процесс стадии конвейера), не трогая конфиг."""
+        self._thread_limit = n
+
+    def _weight(self, name: str) -> float:
+        return float(self.settings["weights"].get(name, 1))
+
+    def register(
+        self,
+        name: str,
+        kind: str = "torch",
+        apply: Optional[Callable[[int], None]] = None,
+        pinned: Optional[Callable[[], int]] = None,
+    ) -> None:
+        """
+        Регистрирует движок. apply(n) применяет число потоков (для llama);
+        pinned() возвращает число потоков из конфига torch-движка, которое
+        арбитр не должен менять (как n_threads у llama).
+        """
+        with self._lock:
+            engine = self._engines.setdefault(name, Engine(name))
+            engine.kind = kind
+            if apply is not None:
+                engine.apply = apply
+            if pinned is not None:
+                engine.pinned = pinned
+
+    def _pinned_threads(self, engine: Optional[Engine]) -> int:
+        if engine is None or engine.pinned is None:
+            return 0
+        return max(0, int(engine.pinned() or 0))
+
+    def threads_for(self, name: str, active: Optional[set[str]] = None) -> int:
+        """
+        Потоки для движка: доля total_threads по весу среди активных
+        стадий (включая саму). Без активных стадий движок получает всё.
+        """
+        with self._lock:
+            group = set(self._active if active is None else active) | {name}
+            total_weight = sum(self._weight(n) for n in group)
+            share = self.total_threads * self._weight(name) / total_weight
+            return max(MIN_THREADS, int(share))
+
+    @contextmanager
+    def active(self, name: str) -> Iterator[int]:
+        """Отмечает стадию работающей на время блока и перераспределяет потоки."""
+        with self._lock:
+            self._active[name] = self._active.get(name, 0) + 1
+            self._rebalance()
+            threads = self.threads_for(name)
+        try:
+            yield threads
+        finally:
+            with self._lock:
+                self._active[name] -= 1
+                if not self._active[name]:
+                    del self._active[name]
+                self._rebalance()
+
+    def _rebalance(self) -> None:
+        active = set(self._active)
+        torch_threads = 0
+        pinned_threads = 0
+        for name in active:
+            engine = self._engines.get(name)
+            threads = self.threads_for(name, active)
+            if engine is not None and engine.kind == "llama":
+                if engine.apply is not None:
+                    try:
+                        engine.apply(threads)
+                    except Exception as e:
+                        print(f"⚠️ Не удалось задать потоки {name}: {e}")
+            else:
+                torch_threads += threads
+                pinned_threads = max(pinned_threads, self._pinned_threads(engine))
+        # Пока работает стадия с явно заданным num_threads, пул torch
+        # остаётся таким, как в её конфиге, а не долей арбитра
+        if pinned_threads:
+            torch_threads = pinned_threads
+        # torch-движки делят один пул потоков процесса
+        if torch_threads and torch_threads != self._torch_threads:
+            try:
+                import torch  # type: ignore
+                torch.set_num_threads(torch_threads)
+                self._torch_threads = torch_threads
+            except Exception:
+                pass
+
+    # ------------------------------------------------------------------
+    # VRAM
+    def free_vram_mb(self) -> Optional[int]:
+        try:
+            import torch  # type: ignore
+            if not torch.cuda.is_available():
+                return None
+            free, _total = torch.cuda.mem_get_info()
+            return int(free // (1024 * 1024))
+        except Exception:
+            return None
+
+    def _pending_reservations(self, exclude: str) -> int:
+        """VRAM, которую нужно оставить зарегистрированным, но ещё не размещённым моделям."""
+        return sum(
+            int(self.settings["vram_mb"].get(name, 0))
+            for name, engine in self._engines.items()
+            if name != exclude and engine.device is None and engine.kind == "torch"
+        )
+
+    def place(self, name: str, need_mb: Optional[int] = None) -> str:
+        """
+        Выбирает устройство для модели: "cuda", если после её загрузки
+        останется запас vram_headroom_mb, иначе "cpu".
+        """
+        with self._lock:
+            self.register(name)
+            engine = self._engines[name]
+            need = int(need_mb if need_mb is not None else self.settings["vram_mb"].get(name, 0))
+            free = self.free_vram_mb()
+            headroom = int(self.settings["vram_headroom_mb"])
+            device = "cuda" if free is not None and free - need >= headroom else "cpu"
+            if free is not None and device == "cpu":
+                print(f"⚠️ {name}: свободно {free} МБ VRAM, нужно {need} + {headroom} — модель остаётся на CPU.")
+            engine.device = device
+            engine.reserved_mb = need if device == "cuda" else 0
+            return device
+
+    def gpu_layers(self, name: str, requested: int, model_path: str) -> int:
+        """
+        Сколько слоёв GGUF-модели выгрузить на GPU: не больше requested и
+        не больше, чем помещается в свободную VRAM за вычетом запаса и
+        резервов других моделей.
+        """
+        with self._lock:
+            self.register(name, kind="llama")
+            engine = self._engines[name]
+            free = self.free_vram_mb()
+            if free is None or requested <= 0:
+                engine.device = "cpu"
+                return 0
+            budget = free - int(self.settings["vram_headroom_mb"]) - self._pending_reservations(name)
+            try:
+                model_mb = os.path.getsize(model_path) // (1024 * 1024)
+            except OSError:
+                model_mb = 0
+            layers = gguf_block_count(model_path)
+            if not model_mb or not layers:
+                engine.device = "cuda"
+                return requested
+            per_layer = model_mb / layers
+            fit = max(0, min(requested, layers, int(budget / per_layer)))
+            if fit < min(requested, layers):
+                print(f"⚠️ {name}: в VRAM помещается {fit} из {layers} слоёв (свободно {free} МБ).")
+            engine.device = "cuda" if fit else "cpu"
+            engine.reserved_mb = int(fit * per_layer)
+            return fit
+
+    def release(self, name: str) -> None:
+        """Снимает резерв модели после её выгрузки."""
+        with self._lock:
+            engine = self._engines.get(name)
+            if engine is not None:
+                engine.device = None
+                engine.reserved_mb = 0
+
+    # ------------------------------------------------------------------
+    def affinity_plan(self, names: list[str]) -> dict[str, list[int]]:
+        """
+        Делит логические ядра на непрерывные диапазоны по весам стадий
+        (соседние логические ядра обычно — один физический, поэтому
+        гиперпотоки одного ядра достаются одной стадии).
+        """
+        cpus = list(range(os.cpu_count() or 1))
+        total_weight = sum(self._weight(n) for n in names) or 1.0
+        plan: dict[str, list[int]] = {}
+        start = 0
+        for i, name in enumerate(names):
+            if i == len(names) - 1:
+                count = len(cpus) - start
+            else:
+                count = max(1, round(len(cpus) * self._weight(name) / total_weight))
+            plan[name] = cpus[start:start + count] or cpus[-1:]
+            start = min(start + count, len(cpus) - 1)
+        return plan
+
+    def status(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "total_threads": self.total_threads,
+                "active": sorted(self._active),
+                "torch_threads": self._torch_threads,
+                "free_vram_mb": self.free_vram_mb(),
+                "engines": {
+                    name: {
+                        "kind": e.kind,
+                        "device": e.device,
+                        "reserved_mb": e.reserved_mb,
+                        "threads": self._pinned_threads(e) or self.threads_for(name),
+                        "pinned": bool(self._pinned_threads(e)),
+                    }
+                    for name, e in self._engines.items()
+                },
+            }
+
+
+arbiter = ResourceArbiter(RESOURCE_SETTINGS)
+register_handler("GET", "/resources", lambda body: arbiter.status())
@@ -0,0 +1,205 @@
+"""
+Семантический кэш ответов LLM.
+
+Чат повторяет одни и те же вопросы («привет», «как дела», «что за игра»),
+и каждый из них — полноценная генерация большой модели. Кэш сопоставляет
+запрос с уже отвеченными в два шага:
+
+1. точное совпадение нормализованного текста (регистр, «ё», пунктуация,
+   лишние пробелы не учитываются);
+2. поиск ближайшего соседа по лёгкому эмбеддингу — хэшированным
+   символьным триграммам, косинусная близость не ниже порога.
+
+Для каждого запроса хранится несколько вариантов ответа, чтобы повторы
+не звучали заученно: при попадании иногда возвращается промах, и модель
+генерирует новый вариант, который добавляется к записи. Записи живут
+не дольше TTL, размер кэша ограничен (LRU).
+
+scope отделяет записи друг от друга: запрос ищется только среди записей
+с тем же scope (например, канал и характер, с которым отвечала модель).
+Ответы переиспользуются между зрителями: имя автора (author) в ответе
+хранится как AUTHOR_PLACEHOLDER и при выдаче заменяется именем того,
+кто спросил.
+"""
+
+from __future__ import annotations
+
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+_PUNCT_RE = re.compile(r"[^\w\s]+", re.UNICODE)
+_SPACE_RE = re.compile(r"\s+")
+
+AUTHOR_PLACEHOLDER = "{author}"
+
+
+def normalize_prompt(text: str) -> str:
+    """Приводит запрос к каноническому виду для сравнения."""
+    text = text.lower().replace("ё", "е")
+    text = _PUNCT_RE.sub(" ", text)
+    return _SPACE_RE.sub(" ", text).strip()
+
+
+def template_author(response: str, author: Optional[str]) -> str:
+    """Заменяет имя автора в ответе (в том числе после «@») на AUTHOR_PLACEHOLDER."""
+    if not author:
+        return response
+    pattern = r"(?<!\w)" + re.escape(author) + r"(?!\w)"
+    return re.sub(pattern, AUTHOR_PLACEHOLDER, response, flags=re.IGNORECASE)
+
+
+def fill_author(response: str, author: Optional[str]) -> str:
+    """Подставляет имя автора вместо AUTHOR_PLACEHOLDER."""
+    return response.replace(AUTHOR_PLACEHOLDER, author or "")
+
+
+def embed(text: str, dim: int = 512) -> dict[int, float]:
+    """
+    Лёгкий эмбеддинг: хэшированные символьные триграммы, нормированные
+    по L2. Возвращается разреженный вектор {индекс: вес}.
+    """
+    padded = f"  {text} "
+    vec: dict[int, float] = {}
+    for i in range(len(padded) - 2):
+        h = zlib.crc32(padded[i:i + 3].encode("utf-8")) % dim
+        vec[h] = vec.get(h, 0.0) + 1.0
+    norm = math.sqrt(sum(v * v for v in vec.values()))
+    if norm:
+        for k in vec:
+            vec[k] /= norm
+    return vec
+
+
+def _cosine(a: dict[int, float], b: dict[int, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(k, 0.0) for k, v in a.items())
+
+
+@dataclass
+class _Entry:
+    vector: dict[int, float]
+    created: float
+    scope: str = ""
+    variants: list[str] = field(default_factory=list)
+    last_served: int = -1
+
+
+class ResponseCache:
+    """
+    Кэш ответов с поиском по смыслу.
+
+    max_entries – сколько запросов хранить (LRU). ttl – время жизни записи
+    в секундах. similarity_threshold – минимальная косинусная близость для
+    нечёткого попадания. max_variants – сколько вариантов ответа копить на
+    запрос. variation_probability – вероятность при попадании всё же
+    сгенерировать новый вариант, пока их меньше max_variants.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        ttl: float = 900.0,
+        similarity_threshold: float = 0.82,
+        max_variants: int = 4,
+        variation_probability: float = 0.35,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.max_variants = max_variants
+        self.variation_probability = variation_probability
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "fuzzy_hits": 0, "misses": 0, "variations": 0, "expired": 0}
+
+    def lookup(self, prompt: str, scope: str = "", author: Optional[str] = None) -> Optional[str]:
+        """
+        Возвращает закэшированный ответ (с именем author вместо
+        AUTHOR_PLACEHOLDER) или None, если нужно генерировать.
+        """
+        text = normalize_prompt(prompt)
+        if not text:
+            return None
+        key = f"{scope}\x1f{text}"
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(key)
+            fuzzy = False
+            if entry is None:
+                entry_key = self._nearest(embed(text), scope)
+                if entry_key is not None:
+                    key, entry, fuzzy = entry_key, self._entries[entry_key], True
+            if entry is None or not entry.variants:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            if len(entry.variants) < self.max_variants and random.random() < self.variation_probability:
+                # Пусть модель придумает ещё один вариант ответа
+                self._stats["variations"] += 1
+                return None
+            self._stats["fuzzy_hits" if fuzzy else "hits"] += 1
+            choices = [i for i in range(len(entry.variants)) if i != entry.last_served] or [0]
+            entry.last_served = random.choice(choices)
+            return fill_author(entry.variants[entry.last_served], author)
+
+    def store(self, prompt: str, response: str, scope: str = "", author: Optional[str] = None) -> None:
+        """Добавляет ответ как ещё один вариант для запроса (имя author — шаблоном)."""
+        text = normalize_prompt(prompt)
+        if not text or not response.strip():
+            return
+        response = template_author(response, author)
+        key = f"{scope}\x1f{text}"
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # Новый вариант для близкого запроса кладём в его запись
+                near = self._nearest(embed(text), scope)
+                if near is not None:
+                    key, entry = near, self._entries[near]
+            if entry is None:
+                entry = _Entry(vector=embed(text), created=time.monotonic(), scope=scope)
+                self._entries[key] = entry
+            if response not in entry.variants:
+                entry.variants.append(response)
+                del entry.variants[:-self.max_variants]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, float]:
+        """Счётчики попаданий и промахов и текущий размер кэша."""
+        with self._lock:
+            stats: dict[str, float] = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        total = stats["hits"] + stats["fuzzy_hits"] + stats["misses"] + stats["variations"]
+        stats["hit_rate"] = (stats["hits"] + stats["fuzzy_hits"]) / total if total else 0.0
+        return stats
+
+    def _nearest(self, vector: dict[int, float], scope: str = "") -> Optional[str]:
+        best_key, best_score = None, self.similarity_threshold
+        for key, entry in self._entries.items():
+            if entry.scope != scope:
+                continue
+            score = _cosine(vector, entry.vector)
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    def _expire(self, now: float) -> None:
+        expired = [k for k, e in self._entries.items() if now - e.created > self.ttl]
+        for k in expired:
+            del self._entries[k]
+        self._stats["expired"] += len(expired)
@@ -0,0 +1,498 @@
+"""
+Конфигурация движков с горячей заменой без перезапуска процесса.
+
+Настройки (путь к GGUF, размер Whisper, число потоков, параметры XTTS
+и т.п.) читаются из `elaine_config.json`; значения в модулях остаются
+значениями по умолчанию. Каждый движок живёт в `EngineSlot`:
+
+* вызовы берут движок через `with slot.use() as engine:`;
+* `slot.reload(...)` собирает новый экземпляр в фоне, затем атомарно
+  подменяет ссылку — новые запросы сразу идут в новый движок, а старый
+  освобождается после завершения всех начатых на нём запросов.
+* слот помнит время последнего использования и сколько памяти заняла
+  загрузка — по ним model_lifecycle выгружает простаивающие модели, а
+  `slot.prefetch()` загружает их снова в фоне.
+
+Для управления на лету поднимается локальный HTTP‑сервер:
+
+```text
+GET  /config                 — текущая конфигурация
+GET  /engines                — состояние движков (простой, время загрузки, память)
+POST /config/<секция>        — изменить настройки без перезагрузки (speed, temperature…)
+POST /reload/<движок>        — изменить настройки и перезагрузить движок в фоне
+```
+
+Сервер слушает только localhost и принимает лишь запросы с общим
+токеном (секция "control" в elaine_config.json, создаётся при первом
+запуске) в заголовке X-Elaine-Token; POST — только с Content-Type
+application/json, а запросы с чужим Origin (страница в браузере)
+отклоняются. Например, сменить квантизацию GGUF:
+
+```bash
+curl -X POST localhost:8765/reload/llm -H "X-Elaine-Token: <токен>" \
+     -H "Content-Type: application/json" -d '{"model_path": "E:/models/q5_K_M.gguf"}'
+```
+"""
+
+from __future__ import annotations
+
+import gc
+import hmac
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Iterator, Optional
+
+try:
+    import psutil  # type: ignore
+except ImportError:
+    psutil = None
+
+CONFIG_FILE = "elaine_config.json"
+CONTROL_HOST = "127.0.0.1"
+CONTROL_PORT = 8765
+TOKEN_HEADER = "X-Elaine-Token"
+
+_config: dict[str, dict[str, Any]] = {}
+# Значения по умолчанию, объявленные модулями: по ним проверяются
+# изменения через POST /config/<секция>
+_defaults: dict[str, dict[str, Any]] = {}
+_config_lock = threading.Lock()
+_loaded = False
+
+
+def _load_file() -> None:
+    global _loaded
+    if _loaded:
+        return
+    _loaded = True
+    if not os.path.exists(CONFIG_FILE):
+        return
+    try:
+        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for name, values in data.items():
+            if isinstance(values, dict):
+                _config.setdefault(name, {}).update(values)
+    except Exception as e:
+        print(f"⚠️ Не удалось прочитать {CONFIG_FILE}: {e}")
+
+
+def section(name: str, defaults: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+    """
+    Возвращает живой словарь настроек секции: значения по умолчанию из
+    модуля, поверх которых наложены значения из файла. Словарь один и тот
+    же для всех вызовов, поэтому изменения через API видны сразу.
+    """
+    with _config_lock:
+        _load_file()
+        values = _config.setdefault(name, {})
+        _defaults.setdefault(name, {}).update(defaults or {})
+        for key, value in (defaults or {}).items():
+            values.setdefault(key, value)
+        return values
+
+
+def update_section(name: str, values: dict[str, Any], persist: bool = True) -> dict[str, Any]:
+    """Обновляет настройки секции и (по умолчанию) сохраняет их в файл."""
+    with _config_lock:
+        _load_file()
+        current = _config.setdefault(name, {})
+        current.update(values)
+        if persist:
+            _save_locked()
+        return current
+
+
+def _save_locked() -> None:
+    try:
+        tmp = CONFIG_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(_config, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, CONFIG_FILE)
+    except OSError as e:
+        print(f"⚠️ Не удалось сохранить {CONFIG_FILE}: {e}")
+
+
+# ----------------------------------------------------------------------
+# Слоты движков
+def memory_snapshot() -> tuple[float, float]:
+    """(RSS процесса, занятая torch VRAM) в мегабайтах; 0, если узнать нельзя."""
+    rss = psutil.Process().memory_info().rss / 2**20 if psutil is not None else 0.0
+    vram = 0.0
+    torch = sys.modules.get("torch")  # не импортируем torch ради замера
+    if torch is not None:
+        try:
+            if torch.cuda.is_available():
+                vram = torch.cuda.memory_allocated() / 2**20
+        except Exception:
+            pass
+    return rss, vram
+
+
+class EngineSlot:
+    """
+    Держатель загруженного движка с атомарной заменой.
+
+    builder(settings) создаёт движок по словарю настроек, closer(engine) —
+    освобождает ресурсы старого экземпляра (необязательно).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        builder: Callable[[dict[str, Any]], Any],
+        settings: dict[str, Any],
+        closer: Optional[Callable[[Any], None]] = None,
+    ) -> None:
+        self.name = name
+        self.builder = builder
+        self.settings = settings
+        self.closer = closer
+        self._engine: Any = None
+        self._generation = 0
+        self._in_flight: dict[int, int] = {}
+        self._cond = threading.Condition()
+        self._load_lock = threading.Lock()
+        self._reloading = False
+        self._prefetch: Optional[threading.Thread] = None
+        self.last_error: Optional[str] = None
+        self.loaded_at: Optional[float] = None
+        self.last_used = time.monotonic()
+        self.load_seconds: Optional[float] = None
+        # Прирост RSS и VRAM при последней загрузке (оценка «веса» движка)
+        self.footprint: dict[str, float] = {"rss_mb": 0.0, "vram_mb": 0.0}
+        SLOTS[name] = self
+
+    def _build(self, settings: dict[str, Any]) -> Any:
+        rss_before, vram_before = memory_snapshot()
+        started = time.monotonic()
+        engine = self.builder(settings)
+        self.load_seconds = time.monotonic() - started
+        rss_after, vram_after = memory_snapshot()
+        self.footprint = {
+            "rss_mb": round(max(0.0, rss_after - rss_before), 1),
+            "vram_mb": round(max(0.0, vram_after - vram_before), 1),
+        }
+        return engine
+
+    def get(self) -> Any:
+        """Возвращает текущий движок, загружая его при первом обращении."""
+        if self._engine is None:
+            with self._load_lock:
+                if self._engine is None:
+                    engine = self._build(dict(self.settings))
+                    with self._cond:
+                        self._engine = engine
+                        self._generation += 1
+                        self.loaded_at = time.time()
+                        self.last_used = time.monotonic()
+        return self._engine
+
+    @property
+    def loaded(self) -> bool:
+        return self._engine is not None
+
+    @property
+    def in_use(self) -> bool:
+        return bool(self._in_flight)
+
+    def prefetch(self, on_error: Optional[Callable[[Exception], None]] = None) -> None:
+        """
+        Загружает движок в фоне, если он не загружен (например, после
+        выгрузки). on_error вызывается в фоновом потоке, если загрузка не удалась.
+        """
+        if self._engine is not None or (self._prefetch is not None and self._prefetch.is_alive()):
+            return
+
+        def load() -> None:
+            try:
+                self.get()
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"⚠️ Движок {self.name} не загружен: {e}")
+                if on_error is not None:
+                    on_error(e)
+
+        self._prefetch = threading.Thread(target=load, name=f"prefetch-{self.name}", daemon=True)
+        self._prefetch.start()
+
+    @contextmanager
+    def use(self) -> Iterator[Any]:
+        """Берёт движок на время запроса; замена дождётся его завершения."""
+        while True:
+            self.get()
+            with self._cond:
+                # Движок могли выгрузить между get() и захватом блокировки
+                if self._engine is None:
+                    continue
+                engine, generation = self._engine, self._generation
+                self._in_flight[generation] = self._in_flight.get(generation, 0) + 1
+                self.last_used = time.monotonic()
+                break
+        try:
+            yield engine
+        finally:
+            with self._cond:
+                self.last_used = time.monotonic()
+                self._in_flight[generation] -= 1
+                if not self._in_flight[generation]:
+                    del self._in_flight[generation]
+                self._cond.notify_all()
+
+    def reload(self, changes: Optional[dict[str, Any]] = None, wait: bool = False) -> threading.Thread:
+        """
+        Собирает движок с новыми настройками в фоновом потоке и атомарно
+        подменяет им текущий. Если сборка не удалась, остаётся старый.
+        """
+        thread = threading.Thread(target=self._reload, args=(dict(changes or {}),), name=f"reload-{self.name}", daemon=True)
+        thread.start()
+        if wait:
+            thread.join()
+        return thread
+
+    def _reload(self, changes: dict[str, Any]) -> None:
+        with self._load_lock:
+            self._reloading = True
+            settings = {**self.settings, **changes}
+            print(f"🔄 Перезагрузка движка {self.name}: {changes}")
+            started = time.monotonic()
+            try:
+                engine = self._build(dict(settings))
+            except Exception as e:
+                self.last_error = str(e)
+                self._reloading = False
+                print(f"❌ Движок {self.name} не перезагружен, остаётся прежний: {e}")
+                return
+            with self._cond:
+                old, old_generation = self._engine, self._generation
+                self._engine = engine
+                self._generation += 1
+                self.loaded_at = time.time()
+                self.settings.update(changes)
+                # Ждём, пока завершатся запросы, начатые на старом движке
+                while self._in_flight.get(old_generation):
+                    self._cond.wait()
+            self._reloading = False
+            self.last_error = None
+            update_section(self.name, changes)
+            print(f"✅ Движок {self.name} заменён за {time.monotonic() - started:.1f} с.")
+        self._close(old)
+        # Последняя ссылка на старый движок — иначе сборщик и empty_cache его не освободят
+        del old
+        self._free_memory()
+
+    def unload(self) -> bool:
+        """
+        Выгружает движок (после завершения начатых запросов). Следующее
+        обращение загрузит его заново. Возвращает True, если было что выгружать.
+        """
+        with self._load_lock:
+            with self._cond:
+                old, old_generation = self._engine, self._generation
+                if old is None:
+                    return False
+                self._engine = None
+                self._generation += 1
+                while self._in_flight.get(old_generation):
+                    self._cond.wait()
+        self._close(old)
+        del old
+        self._free_memory()
+        return True
+
+    def _close(self, engine: Any) -> None:
+        if engine is not None and self.closer is not None:
+            try:
+                self.closer(engine)
+            except Exception:
+                pass
+
+    @staticmethod
+    def _free_memory() -> None:
+        # У torch-моделей бывают циклические ссылки — без сборки мусора RSS не вернётся
+        gc.collect()
+        try:
+            import torch  # type: ignore
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except Exception:
+            pass
+
+    def status(self) -> dict[str, Any]:
+        with self._cond:
+            return {
+                "loaded": self._engine is not None,
+                "reloading": self._reloading,
+                "in_flight": sum(self._in_flight.values()),
+                "loaded_at": self.loaded_at,
+                "idle_seconds": round(time.monotonic() - self.last_used, 1),
+                "load_seconds": self.load_seconds,
+                "footprint": dict(self.footprint),
+                "last_error": self.last_error,
+                "settings": dict(self.settings),
+            }
+
+
+SLOTS: dict[str, EngineSlot] = {}
+
+
+# ----------------------------------------------------------------------
+# Управляющий HTTP-сервер
+Handler = Callable[[dict[str, Any]], Any]
+_handlers: dict[tuple[str, str], Handler] = {}
+_server: Optional[ThreadingHTTPServer] = None
+
+
+def register_handler(method: str, path: str, handler: Handler) -> None:
+    """
+    Добавляет обработчик в управляющий API. handler получает тело запроса
+    (JSON‑объект, для GET — пустой словарь) и возвращает JSON‑совместимый ответ.
+    Путь может оканчиваться на "/*" — тогда хвост передаётся в ключе "_arg".
+    """
+    _handlers[(method.upper(), path)] = handler
+
+
+def _find_handler(method: str, path: str) -> tuple[Optional[Handler], Optional[str]]:
+    handler = _handlers.get((method, path))
+    if handler is not None:
+        return handler, None
+    prefix, _, arg = path.rpartition("/")
+    return _handlers.get((method, prefix + "/*")), arg
+
+
+def control_token() -> str:
+    """Общий токен управляющего API; при первом обращении создаётся и сохраняется в файл."""
+    settings = section("control", {"token": ""})
+    if not settings.get("token"):
+        update_section("control", {"token": secrets.token_urlsafe(24)})
+    return str(settings["token"])
+
+
+class _ControlRequestHandler(BaseHTTPRequestHandler):
+    def _rejection(self, method: str) -> Optional[tuple[int, str]]:
+        """Причина отказа в доступе или None, если запрос разрешён."""
+        origin = self.headers.get("Origin")
+        if origin is not None:
+            host, port = self.server.server_address[:2]
+            allowed = {f"http://{name}:{port}" for name in (host, "localhost", "127.0.0.1")}
+            if origin not in allowed:
+                return 403, "foreign origin"
+        token = self.headers.get(TOKEN_HEADER) or ""
+        if not hmac.compare_digest(token.encode("utf-8"), control_token().encode("utf-8")):
+            return 401, "missing or invalid token"
+        if method == "POST":
+            content_type = (self.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+            if content_type != "application/json":
+                return 415, "Content-Type must be application/json"
+        return None
+
+    def _handle(self, method: str) -> None:
+        rejection = self._rejection(method)
+        if rejection is not None:
+            self._reply(rejection[0], {"error": rejection[1]})
+            return
+        handler, arg = _find_handler(method, self.path.rstrip("/") or "/")
+        if handler is None:
+            self._reply(404, {"error": "unknown endpoint"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}") if length else {}
+            if arg is not None:
+                body["_arg"] = arg
+            self._reply(200, handler(body))
+        except Exception as e:
+            self._reply(400, {"error": str(e)})
+
+    def _reply(self, code: int, payload: Any) -> None:
+        data = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:  # noqa: N802
+        self._handle("GET")
+
+    def do_POST(self) -> None:  # noqa: N802
+        self._handle("POST")
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        pass
+
+
+def _reload_handler(body: dict[str, Any]) -> dict[str, Any]:
+    name = body.pop("_arg")
+    slot = SLOTS.get(name)
+    if slot is None:
+        raise ValueError(f"неизвестный движок: {name}")
+    # Настройки сохраняются в файл, только если новый движок собрался
+    slot.reload(body)
+    return {"reloading": name, "settings": body}
+
+
+def _check_values(name: str, values: dict[str, Any]) -> None:
+    """Отклоняет неизвестные секции и ключи и значения не того типа, что по умолчанию."""
+    defaults = _defaults.get(name)
+    if defaults is None:
+        raise ValueError(f"неизвестная секция: {name}")
+    for key, value in values.items():
+        if key not in defaults:
+            raise ValueError(f"неизвестный ключ {name}.{key}")
+        default = defaults[key]
+        if default is None:
+            continue
+        expected = type(default)
+        # Целое число подходит туда, где по умолчанию дробное, но bool — не число
+        if expected is float and type(value) is int:
+            continue
+        if type(value) is not expected:
+            raise ValueError(f"{name}.{key}: ожидается {expected.__name__}, получено {type(value).__name__}")
+
+
+def _masked(name: str, values: dict[str, Any]) -> dict[str, Any]:
+    # Токен управляющего API наружу не отдаём
+    view = dict(values)
+    if name == "control" and "token" in view:
+        view["token"] = "***"
+    return view
+
+
+def _config_handler(body: dict[str, Any]) -> dict[str, Any]:
+    name = body.pop("_arg")
+    _check_values(name, body)
+    return _masked(name, update_section(name, body))
+
+
+def _config_view(body: dict[str, Any]) -> dict[str, Any]:
+    with _config_lock:
+        return {name: _masked(name, values) for name, values in _config.items()}
+
+
+register_handler("GET", "/config", _config_view)
+register_handler("GET", "/engines", lambda body: {name: slot.status() for name, slot in SLOTS.items()})
+register_handler("POST", "/reload/*", _reload_handler)
+register_handler("POST", "/config/*", _config_handler)
+
+
+def start_control_server(host: str = CONTROL_HOST, port: int = CONTROL_PORT) -> Optional[ThreadingHTTPServer]:
+    """Запускает управляющий API в фоновом потоке (один раз на процесс)."""
+    global _server
+    if _server is not None:
+        return _server
+    try:
+        _server = ThreadingHTTPServer((host, port), _ControlRequestHandler)
+    except OSError as e:
+        print(f"⚠️ Управляющий API не запущен: {e}")
+        return None
+    control_token()
+    threading.Thread(target=_server.serve_forever, name="control-api", daemon=True).start()
+    print(f"🛠 Управляющий API: http://{host}:{port} (токен — control.token в {CONFIG_FILE})")
+    return _server
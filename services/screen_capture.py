@@ -7,17 +7,22 @@
 Для работы требует установленных библиотек `mss`, `Pillow` и `pytesseract`.
 В цикле с заданным интервалом делает снимок экрана, передаёт его в функцию
 описания и затем получает комментарий от модели. Озвучивает комментарий
-с помощью существующего модуля `tts_silero`. Также реализована простая
-персистентная память: каждое описание экрана и ответ сохраняются в файл
-`memory.log`, чтобы асинхронные процессы могли анализировать предыдущий
-контекст при генерации ответов.
+с помощью существующего модуля `tts_silero`. Также реализована
+персистентная память: каждое описание экрана и ответ сохраняются в
+сегментированный журнал `memory/` (см. `memory_store.py`), чтобы
+асинхронные процессы могли анализировать предыдущий контекст при
+генерации ответов.
 """
 
 from __future__ import annotations
 
+import hashlib
+import os
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
-import os
 
 # Модули для захвата экрана и обработки изображений. Если mss
 # недоступен, мы продолжаем работу, позволяя вызову describe_screen,
@@ -40,65 +45,194 @@ try:
 except ImportError:
     pytesseract = None  # type: ignore
 
-# Библиотеки для генерации описания изображения (BLIP). Используем
-# отложенную загрузку, чтобы не тратить время и память, если модель
-# не требуется. При отсутствии transformers модель не будет использована.
-caption_model = None  # type: ignore
-caption_processor = None  # type: ignore
+try:
+    from .resource_arbiter import arbiter  # type: ignore
+    from .runtime_config import EngineSlot, section  # type: ignore
+    from .session_recorder import recorded  # type: ignore
+except ImportError:
+    from resource_arbiter import arbiter  # type: ignore
+    from runtime_config import EngineSlot, section  # type: ignore
+    from session_recorder import recorded  # type: ignore
+
+# Модель подписи (BLIP) живёт в слоте: грузится лениво, при простое и
+# нехватке памяти выгружается менеджером model_lifecycle и загружается
+# снова при следующем обращении. При отсутствии transformers модель не
+# используется.
 caption_available = True
 
+# Режим модели подписи: "int8" — динамическая квантизация линейных слоёв
+# на CPU (на CUDA вместо неё используется fp16), "fp32" — исходные веса.
+CAPTION_SETTINGS = section("caption", {
+    "model_name": "Salesforce/blip-image-captioning-base",
+    "precision": "int8",
+})
+CAPTION_MAX_NEW_TOKENS = 32
+CAPTION_BATCH_SIZE = 8
+# Кадр без текста описывается целиком и по частям сетки CAPTION_GRID×CAPTION_GRID:
+# все подписи получаются одним батчем
+CAPTION_GRID = 2
+CAPTION_CACHE_SIZE = 64
+# Максимальное расстояние Хэмминга между dHash, при котором кадры
+# считаются одинаковыми и подпись берётся из кэша
+CAPTION_HASH_DISTANCE = 4
+
+_caption_lock = threading.Lock()
+_caption_cache: "OrderedDict[int, str]" = OrderedDict()
+
+
+def _build_caption(settings: dict) -> tuple:
+    """Загружает процессор и модель BLIP; возвращает (processor, model)."""
+    import torch  # type: ignore
+    from transformers import BlipProcessor, BlipForConditionalGeneration  # type: ignore
+    # Используем базовую версию модели для экономии ресурсов;
+    # safetensors‑веса читаются через mmap, повторная загрузка идёт из кэша ОС
+    processor = BlipProcessor.from_pretrained(settings["model_name"])
+    model = BlipForConditionalGeneration.from_pretrained(settings["model_name"])
+    model.eval()
+    if arbiter.place("caption") == "cuda":
+        # Переносим модель на GPU, если там хватает места
+        model = model.half() if settings["precision"] != "fp32" else model
+        model.to("cuda")
+    elif settings["precision"] == "int8":
+        model = torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return processor, model
+
+
+caption_slot = EngineSlot(
+    "caption", _build_caption, CAPTION_SETTINGS, closer=lambda engine: arbiter.release("caption")
+)
+
+
 def _load_caption_model() -> bool:
     """
-    Загружает модель и процессор для генерации описания изображения
-    (BLIP). Возвращает True, если загрузка успешна, иначе False. В случае
-    ошибки переводит caption_available в False, чтобы избегать повторных
-    попыток загрузки.
+    Загружает модель подписи в слот. Возвращает True, если модель готова.
+    При ошибке переводит caption_available в False, чтобы избегать
+    повторных попыток загрузки.
     """
-    global caption_model, caption_processor, caption_available
+    global caption_available
     if not caption_available:
         return False
-    if caption_model is not None and caption_processor is not None:
-        return True
     try:
-        from transformers import BlipProcessor, BlipForConditionalGeneration  # type: ignore
-        # Используем базовую версию модели для экономии ресурсов
-        model_name = "Salesforce/blip-image-captioning-base"
-        caption_processor = BlipProcessor.from_pretrained(model_name)
-        caption_model = BlipForConditionalGeneration.from_pretrained(model_name)
-        # Переносим модель на GPU, если доступна CUDA
-        try:
-            import torch  # type: ignore
-            if torch.cuda.is_available():
-                caption_model.to("cuda")
-        except Exception:
-            pass
+        caption_slot.get()
         return True
     except Exception:
         # Не удалось загрузить модель — отключаем captioning
         caption_available = False
         return False
 
-def generate_caption(image: Image.Image) -> str:
+
+def preload_caption_model() -> None:
+    """
+    Запускает загрузку модели подписи в фоновом потоке. Пока модель
+    грузится, generate_caption() не ждёт её и возвращает пустую строку.
+    """
+    if not caption_available or caption_slot.loaded:
+        return
+    caption_slot.prefetch(on_error=_disable_caption)
+
+
+def _disable_caption(error: Exception) -> None:
+    global caption_available
+    caption_available = False
+
+
+def _image_hash(image: Image.Image) -> int:
+    """Перцептивный хэш (dHash 8x8): устойчив к сжатию и мелким изменениям."""
+    small = image.convert("L").resize((9, 8))
+    px = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return bits
+
+
+def _cached_caption(key: int) -> Optional[str]:
+    """Ищет подпись для близкого по dHash кадра в LRU‑кэше."""
+    with _caption_lock:
+        for cached_key, caption in _caption_cache.items():
+            if bin(cached_key ^ key).count("1") <= CAPTION_HASH_DISTANCE:
+                _caption_cache.move_to_end(cached_key)
+                return caption
+    return None
+
+
+def _store_caption(key: int, caption: str) -> None:
+    with _caption_lock:
+        _caption_cache[key] = caption
+        _caption_cache.move_to_end(key)
+        while len(_caption_cache) > CAPTION_CACHE_SIZE:
+            _caption_cache.popitem(last=False)
+
+
+def generate_captions(images: list[Image.Image], wait: bool = False) -> list[str]:
+    """
+    Генерирует подписи для нескольких изображений (областей или кадров)
+    одним батчем. Кадры, похожие на уже описанные, берутся из кэша по
+    перцептивному хэшу, через модель проходят только новые.
+
+    :param images: список PIL.Image
+    :param wait: ждать ли загрузки модели, если она ещё не готова
+    :return: подписи в том же порядке (пустая строка при ошибке)
+    """
+    if not images:
+        return []
+    keys = [_image_hash(img) for img in images]
+    captions: list[Optional[str]] = [_cached_caption(k) for k in keys]
+    missing = [i for i, c in enumerate(captions) if c is None]
+    if not missing:
+        return [c or "" for c in captions]
+    if not caption_slot.loaded:
+        if not wait:
+            preload_caption_model()
+            return [c or "" for c in captions]
+        if not _load_caption_model():
+            return [c or "" for c in captions]
+    try:
+        import torch  # type: ignore
+        with caption_slot.use() as (caption_processor, caption_model):
+            for start in range(0, len(missing), CAPTION_BATCH_SIZE):
+                batch = missing[start:start + CAPTION_BATCH_SIZE]
+                # Преобразуем изображения в формат, понятный процессору
+                inputs = caption_processor(
+                    images=[images[i].convert("RGB") for i in batch], return_tensors="pt"
+                ).to(caption_model.device)
+                if caption_model.dtype == torch.float16:
+                    inputs["pixel_values"] = inputs["pixel_values"].half()
+                with torch.inference_mode(), arbiter.active("caption"):
+                    out = caption_model.generate(**inputs, max_new_tokens=CAPTION_MAX_NEW_TOKENS)
+                decoded = caption_processor.batch_decode(out, skip_special_tokens=True)
+                for i, caption in zip(batch, decoded):
+                    captions[i] = caption.strip()
+                    _store_caption(keys[i], captions[i])
+    except Exception:
+        pass
+    return [c or "" for c in captions]
+
+
+def generate_caption(image: Image.Image, wait: bool = False) -> str:
     """
     Генерирует подпись к изображению с помощью BLIP, если модель доступна.
     Если модель не загружена или произошла ошибка, возвращает пустую строку.
 
     :param image: PIL.Image
+    :param wait: ждать ли загрузки модели, если она ещё не готова
     :return: подпись к изображению
     """
-    if not _load_caption_model():
-        return ""
-    global caption_model, caption_processor
-    try:
-        import torch  # type: ignore
-        # Преобразуем изображение в формат, понятный процессору
-        inputs = caption_processor(images=image, return_tensors="pt").to(caption_model.device)
-        with torch.no_grad():
-            out = caption_model.generate(**inputs, max_new_tokens=64)
-        caption = caption_processor.decode(out[0], skip_special_tokens=True)
-        return caption.strip()
-    except Exception:
-        return ""
+    return generate_captions([image], wait=wait)[0]
+
+def _caption_regions(image: Image.Image) -> list[Image.Image]:
+    """Кадр целиком и его части по сетке CAPTION_GRID — не больше CAPTION_BATCH_SIZE изображений."""
+    regions = [image]
+    cell_w = image.width // CAPTION_GRID
+    cell_h = image.height // CAPTION_GRID
+    if cell_w and cell_h:
+        for row in range(CAPTION_GRID):
+            for col in range(CAPTION_GRID):
+                regions.append(image.crop((col * cell_w, row * cell_h, (col + 1) * cell_w, (row + 1) * cell_h)))
+    return regions[:CAPTION_BATCH_SIZE]
 
 # Импорт генератора ответа и TTS. Если модуль screen_capture входит в пакет
 # services, используем относительные импорты. В противном случае пробуем
@@ -110,39 +244,179 @@ except ImportError:
     from llm import generate_response, USER_NAME  # type: ignore
     from tts_silero import speak_text  # type: ignore
 
+try:
+    from .memory_store import MemoryStore  # type: ignore
+except ImportError:
+    from memory_store import MemoryStore  # type: ignore
+
+# Старый текстовый файл памяти: переносится в MEMORY_DIR при первом запуске
 MEMORY_FILE = "memory.log"
+MEMORY_DIR = "memory"
+# Сколько последних записей подгружать в историю при старте наблюдателя
+MEMORY_LOAD_LIMIT = 4
+
+_memory_store: MemoryStore | None = None
+
 
+def _get_memory_store() -> MemoryStore:
+    """Открывает хранилище памяти при первом обращении."""
+    global _memory_store
+    if _memory_store is None:
+        _memory_store = MemoryStore(MEMORY_DIR)
+        _memory_store.import_legacy(MEMORY_FILE)
+    return _memory_store
 
-def _load_memory() -> list[str]:
+
+def _load_memory(limit: int = MEMORY_LOAD_LIMIT) -> list[str]:
     """
-    Загружает накопленную память из файла. Если файл отсутствует, возвращает пустой список.
+    Загружает последние `limit` записей долговременной памяти. Если памяти
+    нет или она недоступна, возвращает пустой список.
     """
-    if not os.path.exists(MEMORY_FILE):
-        return []
     try:
-        with open(MEMORY_FILE, "r", encoding="utf-8") as f:
-            return [line.strip() for line in f if line.strip()]
+        return _get_memory_store().tail(limit)
     except Exception:
         return []
 
 
 def _save_memory(entry: str) -> None:
     """
-    Сохраняет новую запись в файл памяти. Каждая запись на новой строке.
+    Ставит новую запись в очередь на сохранение. Запись на диск выполняется
+    пачками в фоне и не задерживает цикл наблюдения.
     """
     try:
-        with open(MEMORY_FILE, "a", encoding="utf-8") as f:
-            f.write(entry + "\n")
+        _get_memory_store().append(entry)
     except Exception:
         # игнорируем ошибки записи, чтобы не мешать основному процессу
         pass
 
 
-def extract_text_from_image(image: Image.Image) -> str:
+# Параметры OCR. Распознаём только области, похожие на текст, и
+# останавливаемся, как только набрали OCR_CHAR_BUDGET символов: в промпт
+# всё равно попадает не больше этого объёма.
+OCR_CHAR_BUDGET = 200
+OCR_WORKERS = max(1, min(4, (os.cpu_count() or 2) // 2))
+OCR_CACHE_SIZE = 256
+# Параметры детектора текстовых областей (на уменьшенном кадре)
+DETECT_MAX_WIDTH = 640
+DETECT_CELL = 8             # размер ячейки сетки плотности границ, px
+DETECT_EDGE_DENSITY = 40    # средняя яркость карты границ в ячейке (0..255)
+DETECT_MIN_CELLS = 3        # отбрасываем одиночные «шумные» ячейки
+REGION_PADDING = 6          # запас вокруг области на полном разрешении, px
+MAX_REGIONS = 24
+
+_ocr_executor: ThreadPoolExecutor | None = None
+_ocr_cache: "OrderedDict[str, str]" = OrderedDict()
+_ocr_cache_lock = threading.Lock()
+
+
+def _get_ocr_executor() -> ThreadPoolExecutor:
+    """
+    Возвращает общий пул для OCR. pytesseract запускает отдельный процесс
+    tesseract на каждый вызов, поэтому потоки дают настоящую параллельность
+    и не требуют повторного импорта моделей в дочерних процессах.
+    """
+    global _ocr_executor
+    if _ocr_executor is None:
+        _ocr_executor = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="ocr")
+    return _ocr_executor
+
+
+def _detect_text_regions(gray: Image.Image) -> list[tuple[int, int, int, int]]:
+    """
+    Быстро находит области, похожие на текст, по плотности границ.
+
+    Кадр уменьшается до DETECT_MAX_WIDTH, по нему строится карта границ,
+    которая усредняется по ячейкам сетки. Плотные ячейки объединяются
+    в связные компоненты, а их рамки пересчитываются в координаты
+    исходного изображения. Области возвращаются в порядке чтения.
+
+    :param gray: изображение в оттенках серого (PIL.Image, режим "L")
+    :return: список рамок (left, top, right, bottom)
+    """
+    from PIL import ImageFilter  # late import, Pillow уже загружен
+
+    scale = min(1.0, DETECT_MAX_WIDTH / max(1, gray.width))
+    small = gray.resize((max(1, int(gray.width * scale)), max(1, int(gray.height * scale))))
+    edges = small.filter(ImageFilter.FIND_EDGES)
+    grid_w = max(1, small.width // DETECT_CELL)
+    grid_h = max(1, small.height // DETECT_CELL)
+    # BOX‑ресэмплинг усредняет каждую ячейку — получаем плотность границ
+    density = edges.resize((grid_w, grid_h), Image.BOX)
+    cells = density.load()
+    dense = [[cells[x, y] >= DETECT_EDGE_DENSITY for x in range(grid_w)] for y in range(grid_h)]
+
+    # Связные компоненты по 8 соседям. Текст обычно вытянут по горизонтали,
+    # поэтому соседние по строке ячейки дополнительно соединяем через одну.
+    seen = [[False] * grid_w for _ in range(grid_h)]
+    boxes: list[tuple[int, int, int, int]] = []
+    for y0 in range(grid_h):
+        for x0 in range(grid_w):
+            if not dense[y0][x0] or seen[y0][x0]:
+                continue
+            stack = [(x0, y0)]
+            seen[y0][x0] = True
+            min_x = max_x = x0
+            min_y = max_y = y0
+            count = 0
+            while stack:
+                x, y = stack.pop()
+                count += 1
+                min_x, max_x = min(min_x, x), max(max_x, x)
+                min_y, max_y = min(min_y, y), max(max_y, y)
+                for dx, dy in ((-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (1, -1), (-1, 1), (1, 1), (-2, 0), (2, 0)):
+                    nx, ny = x + dx, y + dy
+                    if 0 <= nx < grid_w and 0 <= ny < grid_h and dense[ny][nx] and not seen[ny][nx]:
+                        seen[ny][nx] = True
+                        stack.append((nx, ny))
+            if count < DETECT_MIN_CELLS:
+                continue
+            factor = DETECT_CELL / scale
+            boxes.append((
+                max(0, int(min_x * factor) - REGION_PADDING),
+                max(0, int(min_y * factor) - REGION_PADDING),
+                min(gray.width, int((max_x + 1) * factor) + REGION_PADDING),
+                min(gray.height, int((max_y + 1) * factor) + REGION_PADDING),
+            ))
+    # Порядок чтения: сверху вниз, слева направо
+    boxes.sort(key=lambda b: (b[1] // (DETECT_CELL * 4), b[0]))
+    return boxes[:MAX_REGIONS]
+
+
+def _region_key(region: Image.Image) -> str:
+    """Ключ кэша OCR — хэш пикселей области."""
+    return hashlib.blake2b(region.tobytes(), digest_size=16).hexdigest()
+
+
+def _ocr_region(region: Image.Image, key: str) -> str:
+    """Распознаёт одну область, используя кэш по хэшу пикселей."""
+    with _ocr_cache_lock:
+        cached = _ocr_cache.get(key)
+        if cached is not None:
+            _ocr_cache.move_to_end(key)
+            return cached
+    try:
+        text = pytesseract.image_to_string(region, lang="rus+eng").strip()
+    except Exception:
+        text = ""
+    with _ocr_cache_lock:
+        _ocr_cache[key] = text
+        _ocr_cache.move_to_end(key)
+        while len(_ocr_cache) > OCR_CACHE_SIZE:
+            _ocr_cache.popitem(last=False)
+    return text
+
+
+def extract_text_from_image(image: Image.Image, char_budget: int = OCR_CHAR_BUDGET) -> str:
     """
     Извлекает текст из изображения с помощью pytesseract, если библиотека доступна.
 
+    Вместо распознавания всего кадра сначала находятся области с текстом,
+    и OCR запускается параллельно только по ним. Результаты собираются
+    в порядке чтения; как только набрано `char_budget` символов, оставшиеся
+    задачи отменяются. Повторяющиеся области (панели, меню) берутся из кэша.
+
     :param image: снимок экрана (PIL.Image)
+    :param char_budget: сколько символов достаточно собрать (0 — без ограничения)
     :return: строка с распознанным текстом или пустая строка
     """
     if pytesseract is None:
@@ -150,12 +424,31 @@ def extract_text_from_image(image: Image.Image) -> str:
     try:
         # Преобразуем изображение в оттенки серого для лучшего качества распознавания
         gray = image.convert("L")
-        text = pytesseract.image_to_string(gray, lang="rus+eng")
-        return text.strip()
+        boxes = _detect_text_regions(gray)
+        if not boxes:
+            return ""
+        executor = _get_ocr_executor()
+        futures = []
+        for box in boxes:
+            region = gray.crop(box)
+            futures.append(executor.submit(_ocr_region, region, _region_key(region)))
+        parts: list[str] = []
+        collected = 0
+        for i, fut in enumerate(futures):
+            text = fut.result()
+            if text:
+                parts.append(text)
+                collected += len(text)
+            if char_budget and collected >= char_budget:
+                for rest in futures[i + 1:]:
+                    rest.cancel()
+                break
+        return "\n".join(parts).strip()
     except Exception:
         return ""
 
 
+@recorded("screen")
 def describe_screen(image: Image.Image) -> str:
     """
     Возвращает краткое описание содержимого скриншота.
@@ -163,7 +456,7 @@ def describe_screen(image: Image.Image) -> str:
     Функция анализирует среднюю яркость, преобладающий цвет изображения и
     извлекает видимый текст (если доступна библиотека OCR). Формирует
     простое описание, например "тёмный экран", "светлый экран с текстом" и
-    добавляет первые 200 символов распознанного текста, чтобы модель могла
+    добавляет первые OCR_CHAR_BUDGET символов распознанного текста, чтобы модель могла
     понять контекст кода или сайта.
 
     :param image: снимок экрана (PIL.Image)
@@ -206,13 +499,19 @@ def describe_screen(image: Image.Image) -> str:
     if extracted:
         # Укорачиваем длинный текст, чтобы не перегружать промпт
         short_text = extracted.replace("\n", " ")
-        short_text = short_text[:200] + ("…" if len(short_text) > 200 else "")
+        short_text = short_text[:OCR_CHAR_BUDGET] + ("…" if len(short_text) > OCR_CHAR_BUDGET else "")
         summary += f". Текст на экране: {short_text}"
         return summary
-    # Если текста на экране нет, пробуем сгенерировать общую подпись
-    caption = generate_caption(image)
-    if caption:
-        return caption
+    # Если текста на экране нет, подписываем кадр и его части одним батчем
+    overall, *parts = generate_captions(_caption_regions(image))
+    details = []
+    for caption in parts:
+        if caption and caption != overall and caption not in details:
+            details.append(caption)
+    if overall:
+        return overall + (f". Детали: {'; '.join(details)}" if details else "")
+    if details:
+        return "; ".join(details)
     return summary
 
 
@@ -229,6 +528,7 @@ def run_screen_observer(interval: float = 10.0, history: Optional[list[str]] = N
     """
     if history is None:
         history = _load_memory()
+    preload_caption_model()
     if mss is None:
         # Если mss не установлен, информируем пользователя и выходим
         print("⚠️ Библиотека mss не установлена, наблюдение за экраном недоступно.")
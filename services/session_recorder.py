@@ -0,0 +1,551 @@
+"""
+Запись сеанса и детерминированное воспроизведение для поиска регрессий.
+
+Медленный или сломанный ход на стриме потом не воспроизвести: звук с
+микрофона, сообщения чата, скриншоты и ответы модели нигде не остаются.
+Рекордер сохраняет входы стадий с отметками времени в один файл
+`sessions/session-YYYYmmdd-HHMMSS.elrec`:
+
+* `transcribe_vad` — аудио с микрофона (int16, дельта‑кодирование,
+  байты разложены по плоскостям и сжаты zlib — речь сжимается в 2–3 раза);
+* `describe_screen` — скриншот в PNG (без потерь, чтобы OCR видел то же);
+* `generate_response` / `generate_structured_response` — все аргументы
+  (промпт, история, persona…);
+* `event_message` — сообщение чата (канал, автор, текст).
+
+Для каждого вызова записываются результат и длительность — это базовая
+линия для сравнения.
+
+Формат — последовательность блоков после заголовка FILE_MAGIC:
+
+```text
+kind (4 байта) | t (float64, с от начала сеанса) | len(meta) (uint32) | len(blob) (uint32)
+meta (JSON, UTF-8) | blob (сжатые данные или пусто)
+```
+
+Оборванный при падении хвост файла при чтении просто пропускается.
+Запись идёт фоновым потоком: декорированная функция только кладёт
+аргументы в очередь, а пока запись выключена — проверяет один флаг.
+
+Воспроизведение прогоняет записанные входы через те же функции по
+порядку, в реальном темпе или ускоренно, с фиксированными сидами
+(random, numpy, torch и seed выборки llama), и сравнивает время стадий
+с базовой линией — записанной при живом прогоне или сохранённым отчётом
+прошлого воспроизведения. Стадии получают записанные входы, а не выходы
+предыдущих стадий, поэтому промпты LLM совпадают при любом изменении STT.
+Сообщения чата воспроизводятся как отметки на шкале: их генерация
+записана отдельным вызовом LLM. Кэш ответов при воспроизведении
+очищается и не используется, а диалоговые сессии в KV-кэше начинаются
+с пустой истории, поэтому каждый прогон считает LLM одинаково и
+независимо от того, что было до него в процессе.
+
+```bash
+curl -X POST localhost:8765/record -H "X-Elaine-Token: <токен>" -H "Content-Type: application/json" \
+     -d '{"action": "start"}'
+python -m services.session_recorder info sessions/session-20250101-200000.elrec
+python -m services.session_recorder replay sessions/session-20250101-200000.elrec --speed 4 --save new.json
+python -m services.session_recorder replay sessions/session-20250101-200000.elrec --baseline new.json
+```
+"""
+
+from __future__ import annotations
+
+import argparse
+import atexit
+import functools
+import importlib
+import inspect
+import io
+import json
+import os
+import queue
+import random
+import struct
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, Optional
+
+import numpy as np  # type: ignore
+
+try:
+    from .runtime_config import register_handler, section  # type: ignore
+except ImportError:
+    from runtime_config import register_handler, section  # type: ignore
+
+# Настройки (секция "recorder" в elaine_config.json). enabled — начинать
+# запись при запуске main.py.
+RECORDER_SETTINGS = section("recorder", {
+    "enabled": False,
+    "directory": "sessions",
+})
+
+FILE_MAGIC = b"ELREC\x00\x01\x00"
+SESSION_SUFFIX = ".elrec"
+# Заголовок блока: вид, время от начала сеанса, длины meta и blob
+CHUNK_HEADER = struct.Struct("<4sdII")
+PCM_CODEC = "pcm16-delta-zlib"
+PNG_CODEC = "png"
+ZLIB_LEVEL = 6
+
+REPLAY_SEED = 1234
+# Рост медианы стадии, после которого она помечается как регрессия
+REGRESSION_THRESHOLD = 0.15
+
+# Стадия -> (модуль, функция) для воспроизведения
+STAGE_FUNCTIONS: dict[str, tuple[str, str]] = {
+    "stt": ("stt_vad", "transcribe_vad"),
+    "screen": ("screen_capture", "describe_screen"),
+    "llm": ("llm", "generate_response"),
+    "llm_structured": ("llm", "generate_structured_response"),
+}
+LLM_STAGES = ("llm", "llm_structured")
+
+
+# ----------------------------------------------------------------------
+# Кодирование данных
+def encode_pcm(audio: np.ndarray) -> bytes:
+    """
+    Сжимает int16‑аудио без потерь: разности соседних отсчётов малы, а
+    после разделения младших и старших байтов старшие почти все нулевые,
+    и zlib сжимает их в разы лучше, чем сырой PCM.
+    """
+    samples = np.ascontiguousarray(audio, dtype="<i2").ravel()
+    delta = np.empty_like(samples)
+    if len(samples):
+        delta[0] = samples[0]
+        np.subtract(samples[1:], samples[:-1], out=delta[1:])  # переполнение int16 обратимо
+    planes = delta.view(np.uint8).reshape(-1, 2).T.tobytes()
+    return zlib.compress(planes, ZLIB_LEVEL)
+
+
+def decode_pcm(blob: bytes) -> np.ndarray:
+    planes = np.frombuffer(zlib.decompress(blob), dtype=np.uint8).reshape(2, -1)
+    delta = np.ascontiguousarray(planes.T).view("<i2").ravel()
+    return np.cumsum(delta, dtype=np.int16)
+
+
+def _to_int16(audio: np.ndarray) -> np.ndarray:
+    if audio.dtype == np.int16:
+        return audio
+    if np.issubdtype(audio.dtype, np.floating):
+        return (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
+    return audio.astype(np.int16)
+
+
+def _encode_arguments(arguments: dict[str, Any]) -> tuple[dict[str, Any], dict[str, Any] | None, bytes]:
+    """Раскладывает аргументы вызова на JSON и один двоичный блок (аудио или изображение)."""
+    args: dict[str, Any] = {}
+    blob_info: dict[str, Any] | None = None
+    blob = b""
+    for name, value in arguments.items():
+        if isinstance(value, np.ndarray) and blob_info is None:
+            blob_info = {"arg": name, "codec": PCM_CODEC, "dtype": str(value.dtype), "samples": int(value.size)}
+            blob = encode_pcm(_to_int16(value))
+        elif hasattr(value, "save") and hasattr(value, "size") and blob_info is None:
+            buffer = io.BytesIO()
+            value.save(buffer, format="PNG", compress_level=3)
+            blob_info = {"arg": name, "codec": PNG_CODEC, "size": list(value.size)}
+            blob = buffer.getvalue()
+        else:
+            args[name] = value
+    return args, blob_info, blob
+
+
+def _decode_blob(info: dict[str, Any], blob: bytes) -> Any:
+    if info["codec"] == PCM_CODEC:
+        audio = decode_pcm(blob)
+        if info.get("dtype", "int16") != "int16":
+            return audio.astype(np.float32) / 32767.0
+        return audio
+    if info["codec"] == PNG_CODEC:
+        from PIL import Image  # type: ignore
+        image = Image.open(io.BytesIO(blob))
+        image.load()
+        return image
+    raise ValueError(f"неизвестный кодек: {info['codec']}")
+
+
+# ----------------------------------------------------------------------
+# Запись
+class SessionRecorder:
+    """Пишет входы стадий в файл сеанса фоновым потоком."""
+
+    def __init__(self, settings: dict[str, Any]) -> None:
+        self.settings = settings
+        self.active = False
+        self.path: Optional[str] = None
+        self.chunks = 0
+        self.bytes_written = 0
+        self._started = 0.0
+        self._file: Optional[io.BufferedWriter] = None
+        self._queue: "queue.Queue[Optional[tuple[str, float, dict[str, Any], Any]]]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self._started
+
+    def start(self, path: Optional[str] = None) -> str:
+        """Начинает новый сеанс записи (если запись уже идёт — возвращает её файл)."""
+        with self._lock:
+            if self.active and self.path is not None:
+                return self.path
+            directory = self.settings["directory"]
+            os.makedirs(directory, exist_ok=True)
+            self.path = path or os.path.join(directory, "session-" + time.strftime("%Y%m%d-%H%M%S") + SESSION_SUFFIX)
+            self._file = open(self.path, "wb")
+            self._file.write(FILE_MAGIC)
+            self.chunks, self.bytes_written = 0, len(FILE_MAGIC)
+            self._started = time.monotonic()
+            self._writer = threading.Thread(target=self._writer_loop, name="session-recorder", daemon=True)
+            self._writer.start()
+            self.active = True
+        self.record_event("sess", {"started": time.time(), "version": 1})
+        print(f"⏺ Запись сеанса: {self.path}")
+        return self.path
+
+    def stop(self) -> Optional[str]:
+        """Останавливает запись, дописав очередь на диск. Возвращает путь к файлу."""
+        with self._lock:
+            if not self.active:
+                return None
+            self.active = False
+            self._queue.put(None)
+            writer = self._writer
+        if writer is not None:
+            writer.join(timeout=10.0)
+        print(f"⏹ Сеанс записан: {self.path} ({self.chunks} блоков, {self.bytes_written / 2**20:.1f} МБ)")
+        return self.path
+
+    def record_event(self, kind: str, meta: dict[str, Any]) -> None:
+        """Записывает событие без двоичных данных (например, сообщение чата)."""
+        if self.active:
+            self._queue.put((kind, self.elapsed(), meta, None))
+
+    def capture(self, stage: str, t: float, arguments: dict[str, Any], output: Any, duration: float) -> None:
+        """Записывает вызов стадии; кодирование идёт в фоновом потоке."""
+        if not self.active:
+            return
+        # Списки (история) копируются сразу: вызывающий код продолжит их менять
+        arguments = {k: list(v) if isinstance(v, list) else v for k, v in arguments.items()}
+        meta = {"stage": stage, "output": output, "duration": duration, "thread": threading.current_thread().name}
+        self._queue.put(("call", t, meta, arguments))
+
+    def _writer_loop(self) -> None:
+        assert self._file is not None
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                print(f"⚠️ Не удалось записать блок сеанса: {e}")
+            if self._queue.empty():
+                self._file.flush()
+        self._file.close()
+
+    def _write(self, kind: str, t: float, meta: dict[str, Any], arguments: Any) -> None:
+        blob = b""
+        if arguments is not None:
+            meta["args"], meta["blob"], blob = _encode_arguments(arguments)
+        data = json.dumps(meta, ensure_ascii=False, default=str).encode("utf-8")
+        header = CHUNK_HEADER.pack(kind.encode("ascii")[:4].ljust(4), t, len(data), len(blob))
+        assert self._file is not None
+        self._file.write(header + data + blob)
+        self.chunks += 1
+        self.bytes_written += len(header) + len(data) + len(blob)
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "active": self.active,
+            "path": self.path,
+            "chunks": self.chunks,
+            "bytes": self.bytes_written,
+            "queued": self._queue.qsize(),
+            "elapsed": round(self.elapsed(), 1) if self.active else None,
+        }
+
+
+recorder = SessionRecorder(RECORDER_SETTINGS)
+
+
+def recorded(stage: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """
+    Декоратор стадии: пока идёт запись, сохраняет явно переданные
+    аргументы, результат и длительность каждого вызова.
+    """
+
+    def wrap(fn: Callable[..., Any]) -> Callable[..., Any]:
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def inner(*args: Any, **kwargs: Any) -> Any:
+            if not recorder.active:
+                return fn(*args, **kwargs)
+            t = recorder.elapsed()
+            started = time.perf_counter()
+            result = fn(*args, **kwargs)
+            duration = time.perf_counter() - started
+            recorder.capture(stage, t, dict(signature.bind(*args, **kwargs).arguments), result, duration)
+            return result
+
+        return inner
+
+    return wrap
+
+
+def start_recorder() -> Optional[str]:
+    """Начинает запись сеанса, если она включена в настройках (секция "recorder")."""
+    if RECORDER_SETTINGS["enabled"]:
+        return recorder.start()
+    return None
+
+
+def _record_handler(body: dict[str, Any]) -> dict[str, Any]:
+    if body.get("action", "start") == "stop":
+        recorder.stop()
+    else:
+        recorder.start()
+    return recorder.status()
+
+
+register_handler("POST", "/record", _record_handler)
+register_handler("GET", "/record", lambda body: recorder.status())
+
+
+# ----------------------------------------------------------------------
+# Чтение
+@dataclass
+class SessionEvent:
+    """Событие сеанса: вид блока, время от начала и метаданные (аргументы уже декодированы)."""
+
+    kind: str
+    t: float
+    meta: dict[str, Any]
+
+    @property
+    def stage(self) -> Optional[str]:
+        return self.meta.get("stage")
+
+
+def read_session(path: str, decode: bool = True) -> Iterator[SessionEvent]:
+    """Читает блоки сеанса по порядку; оборванный последний блок пропускается."""
+    with open(path, "rb") as f:
+        if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            raise ValueError(f"{path}: не файл сеанса")
+        while True:
+            header = f.read(CHUNK_HEADER.size)
+            if len(header) < CHUNK_HEADER.size:
+                return
+            kind, t, meta_len, blob_len = CHUNK_HEADER.unpack(header)
+            data = f.read(meta_len)
+            blob = f.read(blob_len)
+            if len(data) < meta_len or len(blob) < blob_len:
+                return
+            meta = json.loads(data.decode("utf-8"))
+            if decode and meta.get("blob"):
+                meta.setdefault("args", {})[meta["blob"]["arg"]] = _decode_blob(meta["blob"], blob)
+            yield SessionEvent(kind.decode("ascii").strip(), t, meta)
+
+
+# ----------------------------------------------------------------------
+# Воспроизведение
+def seed_everything(seed: int) -> None:
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        import torch  # type: ignore
+        torch.manual_seed(seed)
+    except ImportError:
+        pass
+
+
+def _module(name: str) -> Any:
+    if __package__:
+        return importlib.import_module(f".{name}", __package__)
+    return importlib.import_module(name)
+
+
+def _stage_function(stage: str) -> Callable[..., Any]:
+    module_name, name = STAGE_FUNCTIONS[stage]
+    return getattr(_module(module_name), name)
+
+
+def _warm_up(stages: set[str]) -> None:
+    """Загружает модели заранее, чтобы загрузка не попала во время первой стадии."""
+    if "stt" in stages:
+        _module("stt_vad").get_whisper_model()
+    if "screen" in stages:
+        try:
+            _module("screen_capture").caption_slot.get()
+        except Exception as e:
+            print(f"⚠️ Модель подписи не загружена: {e}")
+    if stages & set(LLM_STAGES):
+        llm = _module("llm")  # модель загружается при импорте
+        # Попадания в кэш и история прошлых прогонов исказили бы время LLM
+        llm.response_cache.clear()
+        llm.reset_sessions()
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def timing_report(durations: dict[str, list[float]]) -> dict[str, dict[str, float]]:
+    return {
+        stage: {
+            "count": len(values),
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 0.5),
+            "p95": percentile(values, 0.95),
+        }
+        for stage, values in sorted(durations.items())
+        if values
+    }
+
+
+def replay(path: str, speed: float = 1.0, seed: int = REPLAY_SEED) -> dict[str, Any]:
+    """
+    Прогоняет записанные входы через стадии конвейера. speed — ускорение
+    темпа (0 — без пауз между событиями). Возвращает отчёт: время стадий
+    при записи (baseline) и при воспроизведении, ответы записи и прогона.
+    """
+    events = sorted(read_session(path), key=lambda e: e.t)
+    calls = [e for e in events if e.kind == "call" and e.stage in STAGE_FUNCTIONS]
+    _warm_up({e.stage for e in calls})
+    seed_everything(seed)
+
+    recorded_times: dict[str, list[float]] = {}
+    replay_times: dict[str, list[float]] = {}
+    recorded_outputs: dict[str, list[Any]] = {}
+    outputs: dict[str, list[Any]] = {}
+    llm_index = 0
+    started = time.monotonic()
+    for event in events:
+        if speed > 0:
+            delay = started + event.t / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        if event.kind == "chat":
+            print(f"💬 [{event.t:7.1f}] {event.meta.get('author')}: {event.meta.get('content')}")
+            continue
+        if event.kind != "call" or event.stage not in STAGE_FUNCTIONS:
+            continue
+        stage = event.stage
+        args = dict(event.meta.get("args", {}))
+        if stage in LLM_STAGES:
+            # Без cache_key кэш ответов не читается и не пополняется
+            args.pop("cache_key", None)
+            args.pop("cache_scope", None)
+            args.pop("cache_author", None)
+            # Свой сид на каждый вызов: результат не зависит от числа предыдущих выборок
+            args["seed"] = seed + llm_index
+            llm_index += 1
+        fn = _stage_function(stage)
+        call_started = time.perf_counter()
+        try:
+            output = fn(**args)
+        except Exception as e:
+            print(f"⚠️ [{event.t:7.1f}] {stage}: {e}")
+            continue
+        elapsed = time.perf_counter() - call_started
+        recorded_times.setdefault(stage, []).append(float(event.meta.get("duration", 0.0)))
+        replay_times.setdefault(stage, []).append(elapsed)
+        recorded_outputs.setdefault(stage, []).append(event.meta.get("output"))
+        outputs.setdefault(stage, []).append(output)
+        print(f"▶️ [{event.t:7.1f}] {stage}: {elapsed:.2f} с (было {event.meta.get('duration', 0.0):.2f} с)")
+    return {
+        "session": path,
+        "seed": seed,
+        "speed": speed,
+        "baseline": timing_report(recorded_times),
+        "replay": timing_report(replay_times),
+        "recorded_outputs": recorded_outputs,
+        "outputs": outputs,
+    }
+
+
+def compare(report: dict[str, Any], baseline: Optional[dict[str, Any]] = None) -> bool:
+    """
+    Печатает таблицу времени стадий против базовой линии (по умолчанию —
+    записанной при живом прогоне). Ответы сравниваются с той же линией:
+    вживую сид llama случайный, поэтому полное совпадение ожидается только
+    между двумя воспроизведениями с одним сидом. Возвращает False, если
+    медиана какой‑то стадии выросла больше чем на REGRESSION_THRESHOLD.
+    """
+    base = (baseline or {}).get("replay") or report["baseline"]
+    base_outputs = (baseline or {}).get("outputs") or report["recorded_outputs"]
+    current = report["replay"]
+    ok = True
+    print(f"\n{'стадия':<16}{'n':>4}{'p50 база':>10}{'p50':>8}{'p95 база':>10}{'p95':>8}{'Δ p50':>8}  ответы")
+    for stage, stats in current.items():
+        ref = base.get(stage)
+        produced = report["outputs"].get(stage, [])
+        matched = sum(a == b for a, b in zip(produced, base_outputs.get(stage, [])))
+        total = len(produced)
+        if ref is None:
+            print(f"{stage:<16}{stats['count']:>4}{'—':>10}{stats['p50']:>8.2f}{'—':>10}{stats['p95']:>8.2f}{'—':>8}  {matched}/{total}")
+            continue
+        change = (stats["p50"] - ref["p50"]) / max(ref["p50"], 1e-6)
+        mark = ""
+        if change > REGRESSION_THRESHOLD:
+            mark, ok = " ⚠️", False
+        print(
+            f"{stage:<16}{stats['count']:>4}{ref['p50']:>10.2f}{stats['p50']:>8.2f}"
+            f"{ref['p95']:>10.2f}{stats['p95']:>8.2f}{change * 100:>7.0f}%  {matched}/{total}{mark}"
+        )
+    print("✅ Регрессий нет." if ok else f"❌ Медиана выросла больше чем на {REGRESSION_THRESHOLD:.0%}.")
+    return ok
+
+
+def describe(path: str) -> None:
+    """Печатает состав сеанса: события по видам и стадиям, длительность, размер."""
+    counts: dict[str, int] = {}
+    last = 0.0
+    for event in read_session(path, decode=False):
+        key = event.stage or event.kind
+        counts[key] = counts.get(key, 0) + 1
+        last = max(last, event.t)
+    print(f"{path}: {last / 60:.1f} мин, {os.path.getsize(path) / 2**20:.1f} МБ")
+    for key, count in sorted(counts.items()):
+        print(f"  {key:<16}{count:>6}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Запись и воспроизведение сеансов Элейн")
+    sub = parser.add_subparsers(dest="command", required=True)
+    info = sub.add_parser("info", help="состав записанного сеанса")
+    info.add_argument("session")
+    run = sub.add_parser("replay", help="воспроизвести сеанс и сравнить время стадий")
+    run.add_argument("session")
+    run.add_argument("--speed", type=float, default=1.0, help="ускорение темпа, 0 — без пауз")
+    run.add_argument("--seed", type=int, default=REPLAY_SEED)
+    run.add_argument("--baseline", help="отчёт прошлого воспроизведения (JSON)")
+    run.add_argument("--save", help="куда сохранить отчёт (JSON)")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        describe(args.session)
+        return
+    report = replay(args.session, speed=args.speed, seed=args.seed)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    ok = compare(report, baseline)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
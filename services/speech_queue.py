@@ -0,0 +1,173 @@
+"""
+Очередь озвучки с контролем допуска по длине отставания.
+
+Каждая озвученная реплика стоит секунд синтеза и воспроизведения, а чату
+достаточно текста. Очередь оценивает отставание озвучки в секундах
+аудио (оставшееся время текущей реплики плюс всё ожидающее) и по нему
+решает, как обслуживать ответы чата:
+
+* "full" — отставания почти нет: обычный ответ и озвучка;
+* "short" — отставание растёт: ответ короче (меньше max_tokens);
+* "text_only" — бюджет превышен: ответ только текстом в чат.
+
+Если к моменту постановки в очередь бюджет уже превышен, ожидающие
+ответы чата сворачиваются в одну реплику из их первых предложений.
+Голосовые ответы пользователю всегда озвучиваются и идут раньше чата.
+"""
+
+from __future__ import annotations
+
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+_SENTENCE_RE = re.compile(r"^.+?[.!?…](?=\s|$)", re.S)
+
+
+@dataclass
+class SpeechItem:
+    text: str
+    source: str
+    seconds: float
+    summary: bool = False
+
+
+def first_sentence(text: str) -> str:
+    """Первое предложение текста (или весь текст, если границы нет)."""
+    text = text.strip()
+    match = _SENTENCE_RE.match(text)
+    return match.group(0) if match else text
+
+
+class SpeechQueue:
+    """
+    Последовательная озвучка с оценкой отставания.
+
+    speak_fn(text, source) – функция озвучки (блокирует до конца
+    воспроизведения); по source можно выбрать движок TTS.
+    chars_per_second – начальная оценка скорости речи; уточняется по
+    фактической длительности озвученных реплик. short_budget и budget –
+    пороги отставания (секунды) для режимов "short" и "text_only".
+    summary_chars – максимальная длина сводной реплики.
+    """
+
+    def __init__(
+        self,
+        speak_fn: Callable[[str, str], object],
+        chars_per_second: float = 14.0,
+        short_budget: float = 6.0,
+        budget: float = 12.0,
+        summary_chars: int = 160,
+    ) -> None:
+        self.speak_fn = speak_fn
+        self.seconds_per_char = 1.0 / chars_per_second
+        self.short_budget = short_budget
+        self.budget = budget
+        self.summary_chars = summary_chars
+        self._items: deque[SpeechItem] = deque()
+        self._cond = threading.Condition()
+        self._current: Optional[SpeechItem] = None
+        self._current_started = 0.0
+        self._worker = threading.Thread(target=self._worker_loop, name="speech-queue", daemon=True)
+        self._worker.start()
+
+    # ------------------------------------------------------------------
+    def estimate(self, text: str) -> float:
+        """Оценка длительности озвучки текста в секундах."""
+        return len(text) * self.seconds_per_char
+
+    def backlog_seconds(self) -> float:
+        """Сколько секунд аудио ещё предстоит синтезировать и проиграть."""
+        with self._cond:
+            return self._backlog_locked()
+
+    def chat_mode(self) -> str:
+        """Режим обслуживания чата: "full", "short" или "text_only"."""
+        backlog = self.backlog_seconds()
+        if backlog < self.short_budget:
+            return "full"
+        if backlog < self.budget:
+            return "short"
+        return "text_only"
+
+    def chat_max_tokens(self, default: int = 60) -> int:
+        """max_tokens для ответа в чат с учётом текущего отставания."""
+        return default if self.chat_mode() == "full" else max(16, default // 2)
+
+    def submit(self, text: str, source: str = "chat") -> bool:
+        """
+        Ставит реплику в очередь. Голос (source="voice") озвучивается всегда
+        и обгоняет ответы чата. Для чата при превышении бюджета ожидающие
+        реплики сворачиваются в одну; если и она не помещается, реплика
+        не озвучивается. Возвращает True, если текст будет озвучен.
+        """
+        text = text.strip()
+        if not text:
+            return False
+        with self._cond:
+            if source == "voice":
+                # Голосовые ответы — впереди всех ожидающих реплик чата
+                pos = sum(1 for item in self._items if item.source == "voice")
+                self._items.insert(pos, SpeechItem(text, source, self.estimate(text)))
+                self._cond.notify()
+                return True
+
+            item = SpeechItem(text, source, self.estimate(text))
+            if self._backlog_locked() + item.seconds <= self.budget:
+                self._items.append(item)
+                self._cond.notify()
+                return True
+
+            pending = [i for i in self._items if i.source == "chat"]
+            if not pending:
+                return False
+            summary = self._summarize(pending + [item])
+            summary_item = SpeechItem(summary, "chat", self.estimate(summary), summary=True)
+            saved = sum(i.seconds for i in pending)
+            if self._backlog_locked() - saved + summary_item.seconds > self.budget:
+                return False
+            self._items = deque(i for i in self._items if i.source != "chat")
+            self._items.append(summary_item)
+            self._cond.notify()
+            return True
+
+    # ------------------------------------------------------------------
+    def _backlog_locked(self) -> float:
+        backlog = sum(item.seconds for item in self._items)
+        if self._current is not None:
+            backlog += max(0.0, self._current.seconds - (time.monotonic() - self._current_started))
+        return backlog
+
+    def _summarize(self, items: list[SpeechItem]) -> str:
+        parts: list[str] = []
+        length = 0
+        for item in items:
+            # Уже свёрнутую реплику берём целиком
+            sentence = item.text if item.summary else first_sentence(item.text)
+            if length + len(sentence) > self.summary_chars and parts:
+                break
+            parts.append(sentence)
+            length += len(sentence) + 1
+        return " ".join(parts)
+
+    def _worker_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._items:
+                    self._cond.wait()
+                self._current = self._items.popleft()
+                self._current_started = time.monotonic()
+            item = self._current
+            try:
+                self.speak_fn(item.text, item.source)
+            except Exception as e:
+                print(f"⚠️ Ошибка озвучки: {e}")
+            elapsed = time.monotonic() - self._current_started
+            with self._cond:
+                self._current = None
+                # Уточняем скорость речи (синтез + воспроизведение) по факту
+                if elapsed > 0.5 and item.text:
+                    self.seconds_per_char = 0.8 * self.seconds_per_char + 0.2 * (elapsed / len(item.text))
@@ -0,0 +1,202 @@
+"""
+Фильтры до и после Whisper.
+
+Whisper тратит секунды на любой фрагмент, который прошёл порог
+громкости, а на тишине и шуме ещё и «галлюцинирует» («Субтитры сделал
+DimaTorzok», «Продолжение следует…»). Поэтому:
+
+* до распознавания — дешёвая акустическая проверка: доля кадров с
+  речеподобным спектром (низкая спектральная плоскость, энергия в полосе
+  голоса) и, если установлен пакет `silero-vad`, модель вероятности речи.
+  Неречевые фрагменты до Whisper не доходят, а речевые обрезаются по
+  границам речи;
+* после распознавания — отбрасываются сегменты, в которых сам Whisper не
+  уверен (no_speech_prob, avg_logprob, compression_ratio), а известные
+  фразы‑галлюцинации вырезаются одним скомпилированным выражением‑деревом.
+  Вырезаются только целые строки‑галлюцинации (от начала предложения),
+  поэтому «включи субтитры, пожалуйста» остаётся нетронутым.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Any, Iterable, Optional
+
+import numpy as np
+
+try:
+    from silero_vad import get_speech_timestamps, load_silero_vad  # type: ignore
+except ImportError:
+    get_speech_timestamps = None
+    load_silero_vad = None
+
+SAMPLE_RATE = 16000
+FRAME_SECONDS = 0.03
+SPEECH_BAND = (250.0, 4000.0)    # Гц — основная энергия голоса
+
+# Пороги акустической проверки
+MAX_FLATNESS = 0.45              # шум ~0.6–1.0, гласные ~0.01–0.2
+MIN_BAND_RATIO = 0.5             # доля энергии кадра в полосе голоса
+MIN_VOICED_SECONDS = 0.25
+MIN_VOICED_RATIO = 0.12
+ENERGY_FLOOR_DB = -45.0          # относительно полной шкалы
+
+# Пороги уверенности Whisper (значения по умолчанию из самого Whisper)
+NO_SPEECH_THRESHOLD = 0.6
+LOGPROB_THRESHOLD = -1.0
+COMPRESSION_RATIO_THRESHOLD = 2.4
+
+VAD_PADDING = 0.2                # секунды вокруг найденной речи
+
+# Начала титров: с начала предложения вырезаются вместе с его остатком
+# («Редактор субтитров А.Синецкая Корректор А.Егорова»)
+CREDIT_PREFIXES = [
+    "редактор субтитров", "субтитры сделал", "субтитры создавал", "субтитры подогнал",
+    "субтитры делал", "корректор субтитров",
+]
+# Строки-галлюцинации: вырезаются, только если составляют предложение целиком
+HALLUCINATION_LINES = [
+    "продолжение следует", "спасибо за просмотр", "спасибо за внимание",
+    "подписывайтесь на канал", "ставьте лайки", "до новых встреч",
+]
+# Пометки о звуках: вырезается только само слово
+NOISE_TAGS = ["музыка", "applause", "noise", "заставка", "смех", "кашель", "речь", "переход", "звуки"]
+
+
+# ----------------------------------------------------------------------
+# Предварительный фильтр
+def _frames(audio: np.ndarray, frame: int) -> np.ndarray:
+    count = len(audio) // frame
+    return audio[: count * frame].reshape(count, frame)
+
+
+def acoustic_speech_seconds(audio: np.ndarray, sr: int = SAMPLE_RATE) -> tuple[float, float]:
+    """
+    Оценивает, сколько секунд во фрагменте похожи на речь. Возвращает
+    (секунды речеподобных кадров, их доля среди всех кадров).
+    """
+    frame = int(sr * FRAME_SECONDS)
+    frames = _frames(audio, frame)
+    if not len(frames):
+        return 0.0, 0.0
+    power = np.abs(np.fft.rfft(frames * np.hanning(frame), axis=1)) ** 2 + 1e-12
+    freqs = np.fft.rfftfreq(frame, 1.0 / sr)
+    band = (freqs >= SPEECH_BAND[0]) & (freqs <= SPEECH_BAND[1])
+
+    energy_db = 10.0 * np.log10(np.mean(frames ** 2, axis=1) + 1e-12)
+    flatness = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+    band_ratio = power[:, band].sum(axis=1) / power.sum(axis=1)
+
+    voiced = (energy_db > ENERGY_FLOOR_DB) & (flatness < MAX_FLATNESS) & (band_ratio > MIN_BAND_RATIO)
+    return float(voiced.sum() * FRAME_SECONDS), float(voiced.mean())
+
+
+_vad_model: Any = None
+
+
+def _get_vad_model() -> Any:
+    global _vad_model
+    if _vad_model is None and load_silero_vad is not None:
+        try:
+            _vad_model = load_silero_vad()
+        except Exception as e:
+            print(f"⚠️ Silero VAD не загружен: {e}")
+            return None
+    return _vad_model
+
+
+def _vad_trim(audio: np.ndarray, sr: int) -> Optional[np.ndarray]:
+    """Обрезает аудио по найденной Silero речи; None — речи нет."""
+    model = _get_vad_model()
+    if model is None:
+        return audio
+    import torch  # type: ignore
+
+    stamps = get_speech_timestamps(torch.from_numpy(audio), model, sampling_rate=sr)
+    if not stamps:
+        return None
+    pad = int(sr * VAD_PADDING)
+    start = max(0, stamps[0]["start"] - pad)
+    end = min(len(audio), stamps[-1]["end"] + pad)
+    return audio[start:end]
+
+
+def prefilter(audio: np.ndarray, sr: int = SAMPLE_RATE, use_vad: bool = True) -> Optional[np.ndarray]:
+    """
+    Проверяет float32‑аудио перед Whisper. Возвращает аудио, которое стоит
+    распознавать (возможно, обрезанное по границам речи), или None.
+    """
+    seconds, ratio = acoustic_speech_seconds(audio, sr)
+    if seconds < MIN_VOICED_SECONDS or ratio < MIN_VOICED_RATIO:
+        return None
+    if use_vad:
+        return _vad_trim(audio, sr)
+    return audio
+
+
+# ----------------------------------------------------------------------
+# Фильтр после Whisper
+def segment_is_reliable(segment: dict[str, Any]) -> bool:
+    """Правила Whisper: тишина с низкой уверенностью и зацикленный текст отбрасываются."""
+    no_speech = segment.get("no_speech_prob", 0.0)
+    logprob = segment.get("avg_logprob", 0.0)
+    if no_speech > NO_SPEECH_THRESHOLD and logprob < LOGPROB_THRESHOLD:
+        return False
+    if logprob < LOGPROB_THRESHOLD - 0.5:
+        return False
+    return segment.get("compression_ratio", 0.0) <= COMPRESSION_RATIO_THRESHOLD
+
+
+def text_from_segments(segments: Iterable[dict[str, Any]]) -> str:
+    """Склеивает текст надёжных сегментов результата Whisper."""
+    return " ".join(s["text"].strip() for s in segments if segment_is_reliable(s)).strip()
+
+
+def _trie_pattern(words: Iterable[str]) -> str:
+    """
+    Собирает из фраз регулярное выражение в виде префиксного дерева:
+    «суб(?:титры(?: с(?:делал|оздавал)|...)?)». Движок проверяет каждый
+    символ текста один раз на ветку, а не перебирает все фразы подряд.
+    """
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        end = "" in node
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if end else body
+
+    return build(trie)
+
+
+# Начало предложения: начало текста или позиция после знака его конца
+_SENTENCE_START = r"(?:^|(?<=[.!?…]))\s*"
+_HALLUCINATION_RE = re.compile(
+    r"\[[^\]]*\]|\([^)]*\)|♪+"
+    r"|" + _SENTENCE_START + _trie_pattern(CREDIT_PREFIXES) + r"(?!\w)(?:[^.!?…]|\.(?=\S))*[.!?…]*"
+    r"|" + _SENTENCE_START + _trie_pattern(HALLUCINATION_LINES) + r"(?!\w)[\s,]*(?:[.!?…]+|$)"
+    r"|(?<!\w)" + _trie_pattern(NOISE_TAGS) + r"(?!\w)",
+    re.IGNORECASE,
+)
+
+
+def strip_hallucinations(text: str) -> str:
+    """Удаляет пометки в скобках, ноты и известные фразы‑галлюцинации."""
+    text = _HALLUCINATION_RE.sub("", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    # Остались одни знаки препинания — значит, и говорить было нечего
+    return text if re.search(r"\w", text) else ""
+
+
+def is_garbage_text(text: str) -> bool:
+    """Латинская «каша» без кириллицы — типичная галлюцинация на шуме."""
+    latin_words = re.findall(r"[a-zA-Z]{3,}", text)
+    has_cyrillic = bool(re.search(r"[а-яА-ЯёЁ]", text))
+    return len(latin_words) >= 3 and not has_cyrillic
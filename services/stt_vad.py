@@ -1,15 +1,39 @@
 import whisper
 import numpy as np
 import sounddevice as sd
-import torch
+
+try:
+    from .resource_arbiter import arbiter  # type: ignore
+    from .runtime_config import EngineSlot, section  # type: ignore
+    from .session_recorder import recorded  # type: ignore
+    from .stt_filter import prefilter, strip_hallucinations, text_from_segments  # type: ignore
+except ImportError:
+    from resource_arbiter import arbiter  # type: ignore
+    from runtime_config import EngineSlot, section  # type: ignore
+    from session_recorder import recorded  # type: ignore
+    from stt_filter import prefilter, strip_hallucinations, text_from_segments  # type: ignore
 
 THRESHOLD = 500
 SAMPLE_RATE = 16000
 MAX_RECORD_SECONDS = 3.5
 MIN_DURATION = 0.5
 
-# Загружаем модель один раз (medium на русском)
-whisper_model = whisper.load_model("medium").to("cuda" if torch.cuda.is_available() else "cpu")
+# Настройки Whisper (секция "stt" в elaine_config.json). prefilter —
+# акустическая проверка перед Whisper, vad — дополнительно Silero VAD
+# (если установлен пакет silero-vad)
+STT_SETTINGS = section("stt", {"whisper_size": "medium", "prefilter": True, "vad": True})
+
+def _build_whisper(settings: dict):
+    # На CUDA — только если после загрузки останется запас VRAM
+    return whisper.load_model(settings["whisper_size"], device=arbiter.place("stt"))
+
+# Модель загружается один раз при первом распознавании (medium на русском),
+# чтобы запись с микрофона можно было использовать без загрузки Whisper.
+# Размер модели можно сменить на лету: whisper_slot.reload({"whisper_size": "small"})
+whisper_slot = EngineSlot("stt", _build_whisper, STT_SETTINGS, closer=lambda model: arbiter.release("stt"))
+
+def get_whisper_model():
+    return whisper_slot.get()
 
 def wait_for_voice(threshold=THRESHOLD, timeout=10):
     print("🎙 Жду начала речи...")
@@ -34,6 +58,7 @@ def record_vad(seconds=MAX_RECORD_SECONDS) -> np.ndarray:
         return np.array([], dtype=np.int16)
     return audio.flatten()
 
+@recorded("stt")
 def transcribe_vad(audio: np.ndarray) -> str:
     print("🧠 Распознаём голос через Whisper (CUDA)…")
     if len(audio) < int(SAMPLE_RATE * MIN_DURATION):
@@ -41,14 +66,22 @@ def transcribe_vad(audio: np.ndarray) -> str:
         return ""
     
     audio = audio.astype(np.float32) / 32768.0  # int16 → float32
-    result = whisper_model.transcribe(audio, language="ru", fp16=torch.cuda.is_available())
-    return clean_transcript(result["text"])
+    if STT_SETTINGS["prefilter"]:
+        audio = prefilter(audio, SAMPLE_RATE, use_vad=STT_SETTINGS["vad"])
+        if audio is None:
+            print("🔇 Не похоже на речь — Whisper не запускаю.")
+            return ""
+    with whisper_slot.use() as whisper_model, arbiter.active("stt"):
+        # Без подстановки предыдущего текста Whisper реже зацикливается на шуме
+        result = whisper_model.transcribe(
+            audio,
+            language="ru",
+            fp16=whisper_model.device.type == "cuda",
+            condition_on_previous_text=False,
+        )
+    segments = result.get("segments")
+    text = text_from_segments(segments) if segments is not None else result["text"]
+    return clean_transcript(text)
 
 def clean_transcript(text: str) -> str:
-    trash_phrases = [
-        "редактор субтитров", "музыка", "[", "]", "♪", "applause", "noise",
-        "заставка", "смех", "кашель", "речь", "переход", "звуки"
-    ]
-    for phrase in trash_phrases:
-        text = text.replace(phrase, "")
-    return text.strip()
\ No newline at end of file
+    return strip_hallucinations(text)
\ No newline at end of file
@@ -0,0 +1,260 @@
+"""
+Подготовка текста к озвучке XTTS.
+
+XTTS плохо читает цифры, латиницу и символы: «2024» превращается в
+невнятный набор звуков, ник «xX_Gamer_Xx» — в тишину или повтор
+генерации. Здесь текст приводится к «произносимому» русскому:
+
+* эмодзи, ссылки и разметка удаляются;
+* числа (в том числе дробные, отрицательные и проценты) — словами;
+* латинские слова и ники транслитерируются;
+* длинный ответ режется на фрагменты не длиннее MAX_CHUNK_CHARS по
+  границам предложений, чтобы стоимость синтеза росла линейно с длиной
+  ответа, а не квадратично (внимание XTTS считается по всей фразе).
+"""
+
+from __future__ import annotations
+
+import re
+
+MAX_CHUNK_CHARS = 180     # предел XTTS для русского — 182 символа
+MIN_CHUNK_CHARS = 24      # совсем короткие фрагменты склеиваются с соседями
+
+# ----------------------------------------------------------------------
+# Числа
+_UNITS_M = ["", "один", "два", "три", "четыре", "пять", "шесть", "семь", "восемь", "девять"]
+_UNITS_F = ["", "одна", "две", "три", "четыре", "пять", "шесть", "семь", "восемь", "девять"]
+_TEENS = ["десять", "одиннадцать", "двенадцать", "тринадцать", "четырнадцать", "пятнадцать",
+          "шестнадцать", "семнадцать", "восемнадцать", "девятнадцать"]
+_TENS = ["", "", "двадцать", "тридцать", "сорок", "пятьдесят", "шестьдесят", "семьдесят",
+         "восемьдесят", "девяносто"]
+_HUNDREDS = ["", "сто", "двести", "триста", "четыреста", "пятьсот", "шестьсот", "семьсот",
+             "восемьсот", "девятьсот"]
+# (формы для 1, 2–4, 5+; женский род)
+_SCALES = [
+    (("тысяча", "тысячи", "тысяч"), True),
+    (("миллион", "миллиона", "миллионов"), False),
+    (("миллиард", "миллиарда", "миллиардов"), False),
+    (("триллион", "триллиона", "триллионов"), False),
+]
+_FRACTIONS = [("десятая", "десятых"), ("сотая", "сотых"), ("тысячная", "тысячных")]
+
+
+def plural(n: int, forms: tuple[str, str, str]) -> str:
+    """Форма слова для числа n: ("процент", "процента", "процентов")."""
+    n = abs(n) % 100
+    if 10 < n < 20:
+        return forms[2]
+    n %= 10
+    if n == 1:
+        return forms[0]
+    if 2 <= n <= 4:
+        return forms[1]
+    return forms[2]
+
+
+def _triad(n: int, feminine: bool) -> list[str]:
+    words = [_HUNDREDS[n // 100]]
+    rest = n % 100
+    if 10 <= rest < 20:
+        words.append(_TEENS[rest - 10])
+    else:
+        words.append(_TENS[rest // 10])
+        words.append((_UNITS_F if feminine else _UNITS_M)[rest % 10])
+    return [w for w in words if w]
+
+
+def number_to_words(n: int, feminine: bool = False) -> str:
+    """Целое число прописью: 2024 -> «две тысячи двадцать четыре»."""
+    if n == 0:
+        return "ноль"
+    if n < 0:
+        return "минус " + number_to_words(-n, feminine)
+    words = _triad(n % 1000, feminine)
+    n //= 1000
+    for forms, scale_feminine in _SCALES:
+        if not n:
+            break
+        triad = n % 1000
+        if triad:
+            words = _triad(triad, scale_feminine) + [plural(triad, forms)] + words
+        n //= 1000
+    if n:
+        # Больше триллионов — читаем по цифрам, так хотя бы понятно
+        return " ".join(number_to_words(int(d)) for d in str(n)) + " " + " ".join(words)
+    return " ".join(words)
+
+
+def decimal_to_words(integer: str, fraction: str) -> str:
+    """«3», «14» -> «три целых четырнадцать сотых»."""
+    fraction = fraction[:3]
+    whole = int(integer)
+    part = int(fraction)
+    words = f"{number_to_words(whole, feminine=True)} {'целая' if whole % 10 == 1 and whole % 100 != 11 else 'целых'}"
+    if part:
+        one, many = _FRACTIONS[len(fraction) - 1]
+        words += f" {number_to_words(part, feminine=True)} {one if part % 10 == 1 and part % 100 != 11 else many}"
+    return words
+
+
+# Разряды разделяются обычным пробелом, неразрывным или узким неразрывным
+_NUMBER_RE = re.compile(r"(?<![\w.])(-)?(\d{1,3}(?:[ \u00a0\u202f]\d{3})+(?!\d)|\d+)(?:[.,](\d+))?(\s*%)?")
+
+
+def _number_repl(match: re.Match) -> str:
+    sign, integer, fraction, percent = match.groups()
+    integer = re.sub(r"\s", "", integer)
+    if fraction:
+        words = decimal_to_words(integer, fraction)
+        if percent:
+            words += " процента"
+    else:
+        value = int(integer)
+        words = number_to_words(value)
+        if percent:
+            words += " " + plural(value, ("процент", "процента", "процентов"))
+    return ("минус " if sign else "") + words
+
+
+# ----------------------------------------------------------------------
+# Латиница
+# Частые слова из чата, которые правилами транслитерации читаются плохо
+_LATIN_WORDS = {
+    "ok": "окей", "okay": "окей", "lol": "лол", "gg": "гэ гэ", "wp": "вэ пэ", "xd": "икс дэ",
+    "omg": "о май гад", "wtf": "вэ тэ эф", "twitch": "твич", "stream": "стрим", "chat": "чат",
+    "hi": "хай", "hello": "хэллоу", "bye": "бай", "pog": "пог", "kek": "кек", "vtuber": "втубер",
+    "elaine": "элейн", "neuro": "нейро", "youtube": "ютуб", "discord": "дискорд",
+}
+_DIGRAPHS = [
+    ("shch", "щ"), ("sch", "ш"), ("sh", "ш"), ("ch", "ч"), ("zh", "ж"), ("kh", "х"), ("ts", "ц"),
+    ("ya", "я"), ("yu", "ю"), ("yo", "йо"), ("ye", "е"), ("ee", "и"), ("oo", "у"), ("th", "т"),
+    ("ph", "ф"), ("ck", "к"), ("qu", "кв"), ("ou", "ау"), ("ea", "и"), ("ai", "эй"), ("ay", "эй"),
+]
+_LETTERS = {
+    "a": "а", "b": "б", "c": "к", "d": "д", "e": "е", "f": "ф", "g": "г", "h": "х", "i": "и",
+    "j": "дж", "k": "к", "l": "л", "m": "м", "n": "н", "o": "о", "p": "п", "q": "к", "r": "р",
+    "s": "с", "t": "т", "u": "у", "v": "в", "w": "в", "x": "кс", "y": "и", "z": "з",
+}
+_VOWELS = set("aeiouy")
+
+
+def transliterate(word: str) -> str:
+    """Латинское слово кириллицей по упрощённым правилам английского чтения."""
+    lower = word.lower()
+    if lower in _LATIN_WORDS:
+        return _LATIN_WORDS[lower]
+    out: list[str] = []
+    i = 0
+    while i < len(lower):
+        for latin, cyr in _DIGRAPHS:
+            if lower.startswith(latin, i):
+                out.append(cyr)
+                i += len(latin)
+                break
+        else:
+            ch = lower[i]
+            nxt = lower[i + 1] if i + 1 < len(lower) else ""
+            if ch == "c" and nxt in ("e", "i", "y"):
+                out.append("с")
+            elif ch == "y" and (i == 0 and nxt in _VOWELS):
+                out.append("й")
+            elif ch == "e" and i == 0:
+                out.append("э")
+            elif ch == "e" and not nxt and i > 1:
+                pass  # немая «e» на конце: game -> «гам», а не «гаме»
+            else:
+                out.append(_LETTERS.get(ch, ch))
+            i += 1
+    return "".join(out)
+
+
+def _split_nickname(word: str) -> str:
+    # xX_Gamer_Xx, DarkLord2000, cool-guy -> отдельные слова
+    word = re.sub(r"[_\-]+", " ", word)
+    word = re.sub(r"(?<=[a-z])(?=[A-Z])", " ", word)
+    word = re.sub(r"(?<=[A-Za-z])(?=\d)|(?<=\d)(?=[A-Za-z])", " ", word)
+    return word
+
+
+_LATIN_RE = re.compile(r"[A-Za-z]+")
+_NICK_RE = re.compile(r"@?\b(?=\w*[A-Za-z])\w+(?:[-_]\w+)*\b")
+
+# ----------------------------------------------------------------------
+# Очистка
+_EMOJI_RE = re.compile(
+    "[\U0001F000-\U0001FAFF\U00002600-\U000027BF\U0001F1E6-\U0001F1FF"
+    "\U00002300-\U000023FF\U00002B00-\U00002BFF\U0000FE0F\U0000200D]+"
+)
+_URL_RE = re.compile(r"https?://\S+|www\.\S+")
+_MARKUP_RE = re.compile(r"[*_~`#>|\[\]{}<>^\\]+")
+_SYMBOLS = {"&": " и ", "+": " плюс ", "=": " равно ", "№": " номер ", "$": " долларов ", "€": " евро ", "/": " ", "@": ""}
+
+
+def strip_markup(text: str) -> str:
+    """Убирает эмодзи, ссылки, markdown и заменяет символы словами."""
+    text = _URL_RE.sub(" ", text)
+    text = _EMOJI_RE.sub(" ", text)
+    text = re.sub(r"\*[^*\n]{1,40}\*", " ", text)   # *смеётся* — ремарки не озвучиваем
+    text = _MARKUP_RE.sub(" ", text)
+    text = re.sub(r"(?<=[A-Za-z])['’](?=[A-Za-z])", "", text)   # let's -> lets
+    for symbol, word in _SYMBOLS.items():
+        text = text.replace(symbol, word)
+    text = re.sub(r"([!?.…])\1+", r"\1", text)      # «!!!» -> «!»
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def normalize_text(text: str) -> str:
+    """Полная нормализация: очистка, ники, числа, латиница."""
+    text = strip_markup(text)
+    text = _NICK_RE.sub(lambda m: _split_nickname(m.group(0).lstrip("@")), text)
+    text = _NUMBER_RE.sub(_number_repl, text)
+    text = _LATIN_RE.sub(lambda m: transliterate(m.group(0)), text)
+    text = re.sub(r"\s+", " ", text)
+    return re.sub(r" (?=[.,!?…:;])", "", text).strip()   # «5$.» -> «пять долларов.»
+
+
+# ----------------------------------------------------------------------
+# Разбиение на фрагменты
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?…])\s+")
+_CLAUSE_SPLIT_RE = re.compile(r"(?<=[,;:—])\s+")
+
+
+def _split_long(sentence: str, max_chars: int) -> list[str]:
+    """Режет длинное предложение по запятым, а если не хватает — по словам."""
+    parts: list[str] = []
+    current = ""
+    for piece in _CLAUSE_SPLIT_RE.split(sentence):
+        for word in ([piece] if len(piece) <= max_chars else piece.split()):
+            candidate = f"{current} {word}".strip()
+            if len(candidate) <= max_chars:
+                current = candidate
+            else:
+                if current:
+                    parts.append(current)
+                current = word[:max_chars]
+    if current:
+        parts.append(current)
+    return parts
+
+
+def split_for_tts(text: str, max_chars: int = MAX_CHUNK_CHARS, min_chars: int = MIN_CHUNK_CHARS) -> list[str]:
+    """
+    Делит текст на фрагменты не длиннее max_chars по границам предложений.
+    Короткие предложения склеиваются, пока фрагмент короче min_chars,
+    чтобы не получить рваную интонацию на «Да. Нет. Ага.».
+    """
+    chunks: list[str] = []
+    for sentence in _SENTENCE_SPLIT_RE.split(text.strip()):
+        if not sentence:
+            continue
+        for part in ([sentence] if len(sentence) <= max_chars else _split_long(sentence, max_chars)):
+            if chunks and len(chunks[-1]) < min_chars and len(chunks[-1]) + 1 + len(part) <= max_chars:
+                chunks[-1] = f"{chunks[-1]} {part}"
+            else:
+                chunks.append(part)
+    return chunks
+
+
+def prepare_for_tts(text: str, max_chars: int = MAX_CHUNK_CHARS) -> list[str]:
+    """Нормализует текст и режет его на фрагменты для синтеза."""
+    return split_for_tts(normalize_text(text), max_chars)
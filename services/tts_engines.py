@@ -0,0 +1,392 @@
+"""
+Сменные движки синтеза речи и выбор движка по бюджету задержки.
+
+XTTS звучит лучше всех, но и медленнее всех; для потока сообщений из чата
+важнее быстро ответить, чем красиво. Все движки реализуют `TTSEngine`:
+
+* текст нормализуется и режется на фрагменты одинаково (text_normalizer);
+* воспроизведение и мимика общие — `audio_output.play_audio`;
+* `speak()` работает конвейером: пока звучит фрагмент, синтезируется
+  следующий.
+
+Здесь лежат лёгкие движки — Silero (локальный пакет `silero/v4_ru.pt`,
+иначе кэш torch.hub) и Piper (ONNX: пакет `piper-tts` или
+`piper/piper.exe` из репозитория). Движок XTTS и маршрутизатор
+подключаются в `tts_silero.py`.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import queue
+import subprocess
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, Optional
+
+import numpy as np  # type: ignore
+
+try:
+    import torch  # type: ignore
+except ImportError:
+    torch = None
+
+try:
+    from piper import PiperVoice  # type: ignore
+except ImportError:
+    PiperVoice = None
+
+try:
+    from .audio_output import play_audio, playback_lease  # type: ignore
+    from .resource_arbiter import arbiter  # type: ignore
+    from .runtime_config import EngineSlot, section  # type: ignore
+    from .text_normalizer import prepare_for_tts  # type: ignore
+except ImportError:
+    from audio_output import play_audio, playback_lease  # type: ignore
+    from resource_arbiter import arbiter  # type: ignore
+    from runtime_config import EngineSlot, section  # type: ignore
+    from text_normalizer import prepare_for_tts  # type: ignore
+
+CHUNK_PAUSE = 0.12            # пауза между фрагментами при склейке, секунд
+SPOKEN_CHARS_PER_SECOND = 14  # грубая оценка длительности речи по тексту
+
+SILERO_SETTINGS = section("silero", {
+    "language": "ru",
+    "model_id": "v4_ru",
+    "speaker": "xenia",
+    "sample_rate": 24000,
+    # Пакет модели (https://models.silero.ai/models/tts/ru/v4_ru.pt); без него
+    # модель берётся из кэша torch.hub, а при первом запуске — из сети
+    "local_path": os.path.join("silero", "v4_ru.pt"),
+})
+
+# Модель Piper (.onnx) кладётся рядом с её .onnx.json в piper/voices/ru/
+PIPER_SETTINGS = section("piper", {
+    "model_path": os.path.join("piper", "voices", "ru", "ru_irinax_medium.onnx"),
+    "exe_path": os.path.join("piper", "piper.exe"),
+    "length_scale": 1.0,
+})
+
+
+class TTSEngine(ABC):
+    """
+    Базовый движок. Наследник реализует synthesize_chunk(); остальное —
+    фрагментация, склейка, конвейерная озвучка и учёт RTF — общее.
+
+    quality — порядок предпочтения при достаточном бюджете (больше — лучше),
+    startup_seconds — накладные расходы на запрос, default_rtf — оценка
+    real-time factor до первых измерений. slot — слот модели: если она
+    выгружена, к задержке добавляется время загрузки (default_load_seconds
+    до первого замера).
+    """
+
+    name = "base"
+    quality = 0
+    sample_rate = 24000
+    startup_seconds = 0.0
+    default_rtf = 1.0
+    default_load_seconds = 5.0
+    slot: Optional[EngineSlot] = None
+
+    def __init__(self) -> None:
+        self.rtf = self.default_rtf
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    def available(self) -> bool:
+        return True
+
+    @abstractmethod
+    def synthesize_chunk(self, chunk: str) -> Optional[np.ndarray]:
+        """Синтезирует один фрагмент текста (float32, sample_rate) или None."""
+
+    def preload(self) -> None:
+        """Начинает загрузку модели в фоне, чтобы первая реплика её не ждала."""
+        if self.slot is not None and self.available():
+            self.slot.prefetch()
+
+    def load_seconds(self) -> float:
+        """Сколько ждать загрузки модели (0, если она загружена)."""
+        if self.slot is None or self.slot.loaded:
+            return 0.0
+        return self.slot.load_seconds or self.default_load_seconds
+
+    def estimate_latency(self, text: str) -> float:
+        """Ожидаемое время до начала звучания (загрузка модели и синтез первого фрагмента)."""
+        chunks = prepare_for_tts(text)
+        first = chunks[0] if chunks else text
+        return self.load_seconds() + self.startup_seconds + self.rtf * len(first) / SPOKEN_CHARS_PER_SECOND
+
+    # ------------------------------------------------------------------
+    def iter_render(
+        self,
+        text: str,
+        background: bool = False,
+        cancel: Optional[Callable[[], bool]] = None,
+    ) -> Iterator[np.ndarray]:
+        """Выдаёт аудио фрагментов текста по мере синтеза."""
+        for chunk in prepare_for_tts(text):
+            if cancel is not None and cancel():
+                return
+            started = time.perf_counter()
+            try:
+                with self._lock, arbiter.active("tts"):
+                    audio = self.synthesize_chunk(chunk)
+            except Exception as e:
+                print(f"⚠️ {self.name}: ошибка синтеза: {e}")
+                audio = None
+            if audio is None or not len(audio):
+                if background:
+                    return
+                continue
+            self._record_rtf(time.perf_counter() - started, len(audio) / self.sample_rate)
+            yield audio
+
+    def render(
+        self,
+        text: str,
+        background: bool = False,
+        cancel: Optional[Callable[[], bool]] = None,
+    ) -> Optional[np.ndarray]:
+        """Синтезирует весь текст в один массив (фрагменты через короткие паузы)."""
+        pieces = list(self.iter_render(text, background, cancel))
+        if not pieces:
+            return None
+        return join_chunks(pieces, self.sample_rate)
+
+    def speak(self, text: str) -> str:
+        """
+        Озвучивает текст конвейером через общий путь воспроизведения и
+        мимики. Возвращает путь к последнему WAV ("" — нечего было играть).
+        """
+        ready: queue.Queue = queue.Queue()
+
+        def produce() -> None:
+            try:
+                for audio in self.iter_render(text):
+                    ready.put(audio)
+            finally:
+                ready.put(None)
+
+        threading.Thread(target=produce, name=f"tts-render-{self.name}", daemon=True).start()
+        path = ""
+        with playback_lease():
+            while True:
+                audio = ready.get()
+                if audio is None:
+                    break
+                path = play_audio(audio, samplerate=self.sample_rate)
+        return path
+
+    def _record_rtf(self, elapsed: float, duration: float) -> None:
+        if duration > 0:
+            self.rtf = 0.8 * self.rtf + 0.2 * (elapsed / duration)
+
+
+def join_chunks(pieces: list[np.ndarray], sample_rate: int) -> np.ndarray:
+    """Склеивает фрагменты через паузу CHUNK_PAUSE."""
+    pause = np.zeros(int(sample_rate * CHUNK_PAUSE), dtype=np.float32)
+    joined: list[np.ndarray] = []
+    for piece in pieces:
+        if joined:
+            joined.append(pause)
+        joined.append(piece)
+    return np.concatenate(joined)
+
+
+# ----------------------------------------------------------------------
+# Silero
+def _build_silero(settings: dict) -> Any:
+    local_path = settings.get("local_path")
+    if local_path and os.path.exists(local_path):
+        model = torch.package.PackageImporter(local_path).load_pickle("tts_models", "model")
+    else:
+        print(f"⚠️ Нет {local_path} — Silero загружается через torch.hub.")
+        # skip_validation: закэшированный репозиторий не сверяется с GitHub
+        model, _ = torch.hub.load(
+            repo_or_dir="snakers4/silero-models",
+            model="silero_tts",
+            language=settings["language"],
+            speaker=settings["model_id"],
+            trust_repo=True,
+            skip_validation=True,
+        )
+    model.to("cpu")
+    return model
+
+
+silero_slot = EngineSlot("silero", _build_silero, SILERO_SETTINGS)
+
+
+class SileroEngine(TTSEngine):
+    """Silero TTS на CPU: быстрый, без клонирования голоса."""
+
+    name = "silero"
+    quality = 1
+    startup_seconds = 0.05
+    default_rtf = 0.15
+    slot = silero_slot
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.sample_rate = SILERO_SETTINGS["sample_rate"]
+        self._broken = False
+
+    def available(self) -> bool:
+        return torch is not None and not self._broken
+
+    def preload(self) -> None:
+        if self.available():
+            silero_slot.prefetch(on_error=self._mark_broken)
+
+    def _mark_broken(self, error: Exception) -> None:
+        self._broken = True
+
+    def synthesize_chunk(self, chunk: str) -> Optional[np.ndarray]:
+        try:
+            with silero_slot.use() as model:
+                self.sample_rate = SILERO_SETTINGS["sample_rate"]
+                with torch.inference_mode():
+                    audio = model.apply_tts(
+                        text=chunk,
+                        speaker=SILERO_SETTINGS["speaker"],
+                        sample_rate=self.sample_rate,
+                    )
+        except Exception as e:
+            if not silero_slot.loaded:
+                # Модель не загрузилась (нет сети для torch.hub и т.п.) — больше не выбираем
+                self._broken = True
+            raise e
+        return audio.detach().cpu().numpy().astype(np.float32)
+
+
+# ----------------------------------------------------------------------
+# Piper
+@dataclass
+class PiperBackend:
+    """Загруженный голос Piper: функция синтеза текста в float32 и частота."""
+
+    synthesize: Callable[[str], np.ndarray]
+    sample_rate: int
+
+
+def _piper_sample_rate(model_path: str) -> int:
+    try:
+        with open(model_path + ".json", "r", encoding="utf-8") as f:
+            return int(json.load(f)["audio"]["sample_rate"])
+    except (OSError, KeyError, ValueError):
+        return 22050
+
+
+def _build_piper(settings: dict) -> PiperBackend:
+    model_path = settings["model_path"]
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"нет модели Piper: {model_path}")
+    sample_rate = _piper_sample_rate(model_path)
+    length_scale = settings["length_scale"]
+
+    if PiperVoice is not None:
+        voice = PiperVoice.load(model_path)
+
+        def synthesize(text: str) -> np.ndarray:
+            if hasattr(voice, "synthesize_stream_raw"):
+                raw = b"".join(voice.synthesize_stream_raw(text, length_scale=length_scale))
+            else:
+                raw = b"".join(chunk.audio_int16_bytes for chunk in voice.synthesize(text))
+            return np.frombuffer(raw, dtype=np.int16).astype(np.float32) / 32768.0
+
+        return PiperBackend(synthesize, sample_rate)
+
+    exe_path = settings["exe_path"]
+    if not os.path.exists(exe_path):
+        raise FileNotFoundError(f"нет ни пакета piper-tts, ни {exe_path}")
+
+    def synthesize_exe(text: str) -> np.ndarray:
+        result = subprocess.run(
+            [exe_path, "--model", model_path, "--output_raw", "--length_scale", str(length_scale)],
+            input=text.encode("utf-8"),
+            capture_output=True,
+            cwd=os.path.dirname(os.path.abspath(exe_path)),
+            timeout=30,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.decode("utf-8", "ignore").strip()[-200:])
+        return np.frombuffer(result.stdout, dtype=np.int16).astype(np.float32) / 32768.0
+
+    return PiperBackend(synthesize_exe, sample_rate)
+
+
+piper_slot = EngineSlot("piper", _build_piper, PIPER_SETTINGS)
+
+
+class PiperEngine(TTSEngine):
+    """Piper (VITS в ONNX): самый быстрый, для потока реплик из чата."""
+
+    name = "piper"
+    quality = 0
+    startup_seconds = 0.1
+    default_rtf = 0.08
+    default_load_seconds = 1.0
+    slot = piper_slot
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.sample_rate = _piper_sample_rate(PIPER_SETTINGS["model_path"])
+
+    def available(self) -> bool:
+        model_path = PIPER_SETTINGS["model_path"]
+        return os.path.exists(model_path) and (PiperVoice is not None or os.path.exists(PIPER_SETTINGS["exe_path"]))
+
+    def synthesize_chunk(self, chunk: str) -> Optional[np.ndarray]:
+        with piper_slot.use() as backend:
+            self.sample_rate = backend.sample_rate
+            return backend.synthesize(chunk)
+
+
+# ----------------------------------------------------------------------
+class TTSRouter:
+    """
+    Выбирает движок на каждый запрос: самый качественный из тех, что
+    успеют начать говорить за latency_budget секунд. Без бюджета — самый
+    качественный из доступных; если в бюджет не укладывается никто —
+    самый быстрый. Если лучший движок не успевает только из-за того, что
+    его модель выгружена, она загружается в фоне к следующим репликам.
+    """
+
+    def __init__(self, engines: list[TTSEngine]) -> None:
+        self.engines = sorted(engines, key=lambda e: e.quality, reverse=True)
+
+    def pick(self, text: str, latency_budget: Optional[float] = None) -> TTSEngine:
+        candidates = [e for e in self.engines if e.available()]
+        if not candidates:
+            raise RuntimeError("нет доступных движков TTS")
+        if latency_budget is None:
+            return candidates[0]
+        for engine in candidates:
+            latency = engine.estimate_latency(text)
+            if latency <= latency_budget:
+                return engine
+            if engine.slot is not None and latency - engine.load_seconds() <= latency_budget:
+                engine.slot.prefetch()
+        return min(candidates, key=lambda e: e.estimate_latency(text))
+
+    def speak(self, text: str, latency_budget: Optional[float] = None) -> str:
+        engine = self.pick(text, latency_budget)
+        print(f"🎣️ Генерация речи через {engine.name}…")
+        # Реплика и её повтор запасным движком звучат без вклинивания чужих
+        with playback_lease():
+            path = engine.speak(text)
+            # Лёгкий движок не справился (например, не загрузилась модель) — пробуем лучший
+            if not path and engine is not self.engines[0] and self.engines[0].available():
+                print(f"⚠️ {engine.name} не озвучил реплику, переключаюсь на {self.engines[0].name}.")
+                path = self.engines[0].speak(text)
+        return path
+
+    def status(self) -> dict[str, Any]:
+        return {
+            e.name: {"available": e.available(), "loaded": e.load_seconds() == 0, "rtf": round(e.rtf, 3)}
+            for e in self.engines
+        }
@@ -0,0 +1,154 @@
+"""
+Проверка качества и скорости режимов производительности XTTS.
+
+Синтезирует набор тестовых фраз эталонной моделью (fp32) и моделью в
+проверяемом режиме с одинаковыми сидами, сравнивает лог‑мел‑спектрограммы
+(с выравниванием по DTW, потому что длительности слегка отличаются) и
+печатает real-time factor обоих режимов.
+
+```bash
+python -m services.tts_quality --precision int8 --threads 8
+python -m services.tts_quality --precision auto --compile
+```
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+from typing import Any, Optional
+
+import numpy as np  # type: ignore
+import torch  # type: ignore
+
+try:
+    from .tts_silero import SAMPLE_RATE, TTS_SETTINGS, _build_xtts, synthesize, tts_slot  # type: ignore
+except ImportError:
+    from tts_silero import SAMPLE_RATE, TTS_SETTINGS, _build_xtts, synthesize, tts_slot  # type: ignore
+
+TEST_PHRASES = [
+    "Привет, Ваня! Ты опять заставил меня ждать.",
+    "Ну и что ты там делаешь? Покажи мне немедленно.",
+    "Я, между прочим, самая умная в этом чате.",
+    "Сегодня было двадцать три зрителя, и все они меня обожают.",
+]
+TEST_SEED = 1234
+# Низкая температура делает выборку токенов почти детерминированной,
+# иначе сравнение спектров меряет случайность, а не точность режима
+TEST_TEMPERATURE = 0.2
+
+N_FFT = 1024
+HOP = 256
+N_MELS = 80
+# Среднее расхождение выровненных лог‑мел‑спектров (дБ), выше — режим брак
+MAX_MEL_DISTANCE_DB = 4.0
+
+
+def _mel_filterbank(sr: int, n_fft: int, n_mels: int) -> np.ndarray:
+    def hz_to_mel(f):
+        return 2595.0 * np.log10(1.0 + f / 700.0)
+
+    def mel_to_hz(m):
+        return 700.0 * (10.0 ** (m / 2595.0) - 1.0)
+
+    mels = np.linspace(hz_to_mel(0.0), hz_to_mel(sr / 2), n_mels + 2)
+    bins = np.floor((n_fft + 1) * mel_to_hz(mels) / sr).astype(int)
+    fb = np.zeros((n_mels, n_fft // 2 + 1), dtype=np.float32)
+    for i in range(1, n_mels + 1):
+        left, center, right = bins[i - 1], bins[i], bins[i + 1]
+        for k in range(left, center):
+            fb[i - 1, k] = (k - left) / max(1, center - left)
+        for k in range(center, right):
+            fb[i - 1, k] = (right - k) / max(1, right - center)
+    return fb
+
+
+_filterbank: Optional[np.ndarray] = None
+
+
+def log_mel(audio: np.ndarray, sr: int = SAMPLE_RATE) -> np.ndarray:
+    """Лог‑мел‑спектрограмма (кадры × N_MELS) в децибелах."""
+    global _filterbank
+    if _filterbank is None:
+        _filterbank = _mel_filterbank(sr, N_FFT, N_MELS)
+    audio = np.asarray(audio, dtype=np.float32)
+    if len(audio) < N_FFT:
+        audio = np.pad(audio, (0, N_FFT - len(audio)))
+    frames = 1 + (len(audio) - N_FFT) // HOP
+    idx = np.arange(N_FFT)[None, :] + HOP * np.arange(frames)[:, None]
+    spectrum = np.abs(np.fft.rfft(audio[idx] * np.hanning(N_FFT), axis=1)) ** 2
+    return 10.0 * np.log10(spectrum @ _filterbank.T + 1e-10)
+
+
+def dtw_distance(ref: np.ndarray, test: np.ndarray) -> float:
+    """Средняя L1-разница кадров (дБ на мел‑полосу) вдоль оптимального DTW-пути."""
+    cost = np.abs(ref[:, None, :] - test[None, :, :]).mean(axis=2)
+    n, m = cost.shape
+    acc = np.full((n + 1, m + 1), np.inf)
+    steps = np.zeros((n + 1, m + 1))
+    acc[0, 0] = 0.0
+    for i in range(1, n + 1):
+        for j in range(1, m + 1):
+            prev = min((acc[i - 1, j - 1], i - 1, j - 1), (acc[i - 1, j], i - 1, j), (acc[i, j - 1], i, j - 1))
+            acc[i, j] = cost[i - 1, j - 1] + prev[0]
+            steps[i, j] = steps[prev[1], prev[2]] + 1
+    return float(acc[n, m] / steps[n, m])
+
+
+def _run(voice: Any, settings: dict) -> list[tuple[np.ndarray, float]]:
+    results = []
+    for text in TEST_PHRASES:
+        torch.manual_seed(TEST_SEED)
+        started = time.perf_counter()
+        audio = synthesize(voice, text, settings=settings)
+        elapsed = time.perf_counter() - started
+        if audio is None:
+            audio = np.zeros(0, dtype=np.float32)
+        results.append((audio, elapsed / max(1e-6, len(audio) / SAMPLE_RATE)))
+    return results
+
+
+def compare(candidate: dict[str, Any]) -> bool:
+    """
+    Сравнивает режим candidate (переопределения TTS_SETTINGS) с fp32.
+    Печатает таблицу и возвращает True, если качество в пределах нормы.
+    """
+    base = {**TTS_SETTINGS, "temperature": TEST_TEMPERATURE}
+    # Модель, загруженная при импорте tts_silero, здесь не нужна
+    tts_slot.unload()
+
+    print("🎛 Эталон: fp32")
+    reference_voice = _build_xtts({**base, "precision": "fp32", "compile": False})
+    reference = _run(reference_voice, base)
+    del reference_voice
+
+    print(f"🎛 Проверяемый режим: {candidate}")
+    candidate_voice = _build_xtts({**base, **candidate})
+    tested = _run(candidate_voice, base)
+
+    ok = True
+    print(f"\n{'фраза':<6}{'RTF fp32':>10}{'RTF режим':>11}{'длит.':>8}{'мел, дБ':>9}")
+    for n, ((ref_audio, ref_rtf), (test_audio, test_rtf)) in enumerate(zip(reference, tested), 1):
+        if not len(ref_audio) or not len(test_audio):
+            print(f"{n:<6}{'нет аудио':>38}")
+            ok = False
+            continue
+        distance = dtw_distance(log_mel(ref_audio), log_mel(test_audio))
+        ratio = len(test_audio) / len(ref_audio)
+        ok = ok and distance <= MAX_MEL_DISTANCE_DB
+        print(f"{n:<6}{ref_rtf:>10.2f}{test_rtf:>11.2f}{ratio:>8.2f}{distance:>9.2f}")
+    print("✅ Качество в норме." if ok else f"❌ Расхождение выше {MAX_MEL_DISTANCE_DB} дБ — режим не рекомендуется.")
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Сравнение режима XTTS с fp32")
+    parser.add_argument("--precision", default="auto", choices=["auto", "fp32", "fp16", "int8"])
+    parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--threads", type=int, default=0)
+    args = parser.parse_args()
+    compare({"precision": args.precision, "compile": args.compile, "num_threads": args.threads})
+
+
+if __name__ == "__main__":
+    main()
@@ -3,25 +3,43 @@
 Теперь используется потоковая генерация с минимальной задержкой,
 человеко-подобной мимикой и гарантированным закрытием рта.
 Мимика включается только при старте воспроизведения.
+
+Синтез (`render_speech`) и воспроизведение (`play_speech`) разделены,
+чтобы реплику можно было подготовить заранее; `speak_text` выполняет
+оба шага конвейером по фрагментам. Текст перед синтезом нормализуется
+и делится на предложения (см. text_normalizer).
 """
 
 from __future__ import annotations
 
 import os
-import time
 import threading
+import time
 import warnings
-from typing import Any
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator
 
 import numpy as np  # type: ignore
-import sounddevice as sd  # type: ignore
-import soundfile as sf  # type: ignore
 import torch  # type: ignore
 
 from TTS.tts.models.xtts import Xtts  # type: ignore
 from TTS.tts.configs.xtts_config import XttsConfig  # type: ignore
 
-from vtube_controller import VTubeStudioClient
+try:
+    from .audio_output import play_audio, vts_client  # type: ignore
+    from .priority import PriorityGate  # type: ignore
+    from .resource_arbiter import arbiter  # type: ignore
+    from .runtime_config import EngineSlot, register_handler, section  # type: ignore
+    from .text_normalizer import prepare_for_tts  # type: ignore
+    from .tts_engines import PiperEngine, SileroEngine, TTSEngine, TTSRouter, join_chunks  # type: ignore
+except ImportError:
+    from audio_output import play_audio, vts_client  # type: ignore
+    from priority import PriorityGate  # type: ignore
+    from resource_arbiter import arbiter  # type: ignore
+    from runtime_config import EngineSlot, register_handler, section  # type: ignore
+    from text_normalizer import prepare_for_tts  # type: ignore
+    from tts_engines import PiperEngine, SileroEngine, TTSEngine, TTSRouter, join_chunks  # type: ignore
 
 warnings.filterwarnings("ignore", category=UserWarning, module="whisper")
 warnings.filterwarnings("ignore", category=UserWarning, module="TTS")
@@ -30,127 +48,402 @@ MODEL_PATH = "E:/ElaineRus/models/XTTS-v2"
 CONFIG_PATH = os.path.join(MODEL_PATH, "config.json")
 SPEAKER_WAV = os.path.join(MODEL_PATH, "samples", "elaine_voice.wav")
 
-config = XttsConfig()
-config.load_json(CONFIG_PATH)
-model = Xtts.init_from_config(config)
-model.config.use_multi_speaker = False  # отключаем поддержку мультирежима для ускорения
-model.load_checkpoint(
-    config,
-    checkpoint_path=os.path.join(MODEL_PATH, "model.pth"),
-    checkpoint_dir=MODEL_PATH,
-    use_deepspeed=False,
-)
-
-GPT_COND_LATENT = None
-SPEAKER_EMBEDDING = None
-try:
-    gpt_cond_latent, speaker_embedding = model.get_conditioning_latents(audio_path=[SPEAKER_WAV])
-    if torch.cuda.is_available():
-        gpt_cond_latent = gpt_cond_latent.cpu().float().cuda()
-        speaker_embedding = speaker_embedding.cpu().float().cuda()
-        model = model.float().cuda()
-    else:
-        gpt_cond_latent = gpt_cond_latent.float()
-        speaker_embedding = speaker_embedding.float()
-        model = model.float().cpu()
-    model.eval()
-    GPT_COND_LATENT = gpt_cond_latent
-    SPEAKER_EMBEDDING = speaker_embedding
-except Exception as e:
-    print(f"⚠️ Не удалось вычислить латенты голоса: {e}")
-
-vts_client = VTubeStudioClient()
-
-def speak_text(text: str) -> str:
-    print("🎣️ Генерация речи через XTTS…")
+# Настройки XTTS (секция "tts" в elaine_config.json). model_path,
+# speaker_wav и параметры режима производительности (precision, compile,
+# num_threads) применяются через tts_slot.reload(...), параметры синтеза
+# (speed, temperature, top_k) — сразу со следующей реплики.
+#
+# precision: "fp32" (по умолчанию); "auto" — int8 на CPU и fp32 на GPU;
+# "fp16" (только GPU, через autocast); "int8" (только CPU, динамическая
+# квантизация Linear-слоёв GPT и декодера). Ускоренные режимы меняют голос,
+# поэтому включаются вручную, после того как `python -m services.tts_quality`
+# с этим режимом прошёл проверку на вашей машине.
+TTS_SETTINGS = section("tts", {
+    "model_path": MODEL_PATH,
+    "speaker_wav": SPEAKER_WAV,
+    "speed": 0.97,
+    "temperature": 1.0,
+    "top_k": 50,
+    "precision": "fp32",
+    "compile": False,
+    "num_threads": 0,         # 0 — оставить значение torch по умолчанию
+})
+
+SAMPLE_RATE = 24000
+WARMUP_TEXT = "Привет."
+CHUNK_CACHE_SIZE = 96       # сколько синтезированных фрагментов держать в памяти
+
+
+@dataclass
+class XttsVoice:
+    """Загруженная модель XTTS вместе с латентами голоса."""
+
+    model: Any
+    config: Any
+    gpt_cond_latent: Any = None
+    speaker_embedding: Any = None
+    device: str = "cpu"
+    precision: str = "fp32"
 
-    if GPT_COND_LATENT is None or SPEAKER_EMBEDDING is None:
-        print("⚠️ Латенты голоса не готовы.")
-        return ""
 
+def _resolve_precision(requested: str, cuda: bool) -> str:
+    precision = str(requested or "auto").lower()
+    if precision == "auto":
+        return "fp32" if cuda else "int8"
+    if precision == "int8" and cuda:
+        print("⚠️ int8 поддерживается только на CPU, используется fp16.")
+        return "fp16"
+    if precision == "fp16" and not cuda:
+        print("⚠️ fp16 не ускоряет синтез на CPU, используется int8.")
+        return "int8"
+    if precision not in ("fp32", "fp16", "int8"):
+        print(f"⚠️ Неизвестный режим точности {precision!r}, используется fp32.")
+        return "fp32"
+    return precision
+
+
+def _conv1d_to_linear(module: torch.nn.Module) -> torch.nn.Module:
+    """
+    GPT‑2 внутри XTTS построен на Conv1D из transformers — это Linear с
+    транспонированным весом, но quantize_dynamic его не видит. Заменяем
+    такие слои на эквивалентные nn.Linear на месте (ссылки на модули,
+    которые держит gpt_inference, остаются действительными).
+    """
+    try:
+        from transformers.pytorch_utils import Conv1D  # type: ignore
+    except ImportError:
+        return module
+    for name, child in list(module.named_children()):
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = torch.nn.Linear(in_features, out_features, bias=child.bias is not None)
+            linear.weight.data = child.weight.data.t().contiguous()
+            if child.bias is not None:
+                linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            _conv1d_to_linear(child)
+    return module
+
+
+def _quantize_int8(model: Any) -> None:
+    """Динамическая int8-квантизация Linear-слоёв GPT и декодера (CPU)."""
+    for attr in ("gpt", "hifigan_decoder"):
+        submodule = getattr(model, attr, None)
+        if submodule is None:
+            continue
+        _conv1d_to_linear(submodule)
+        torch.ao.quantization.quantize_dynamic(submodule, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def _compile_model(model: Any) -> list[tuple[Any, Any]]:
+    """
+    Оборачивает forward трансформера GPT и декодера в torch.compile.
+    Возвращает исходные forward, чтобы откатиться, если компиляция
+    не удалась при прогреве.
+    """
+    originals = []
+    targets = [getattr(getattr(model, "gpt", None), "gpt", None), getattr(model, "hifigan_decoder", None)]
+    for module in targets:
+        if module is None:
+            continue
+        originals.append((module, module.forward))
+        module.forward = torch.compile(module.forward, dynamic=True)
+    return originals
+
+
+def _build_xtts(settings: dict) -> XttsVoice:
+    model_path = settings["model_path"]
+    config = XttsConfig()
+    config.load_json(os.path.join(model_path, "config.json"))
+    model = Xtts.init_from_config(config)
+    model.config.use_multi_speaker = False  # отключаем поддержку мультирежима для ускорения
+    model.load_checkpoint(
+        config,
+        checkpoint_path=os.path.join(model_path, "model.pth"),
+        checkpoint_dir=model_path,
+        use_deepspeed=False,
+    )
+    cuda = arbiter.place("tts") == "cuda"
+    if settings.get("num_threads"):
+        torch.set_num_threads(int(settings["num_threads"]))
+    voice = XttsVoice(model=model, config=config, device="cuda" if cuda else "cpu")
     try:
-        stream = model.inference_stream(
+        # Латенты считаются в fp32 до квантизации — так голос не «плывёт»
+        gpt_cond_latent, speaker_embedding = model.get_conditioning_latents(audio_path=[settings["speaker_wav"]])
+        if cuda:
+            gpt_cond_latent = gpt_cond_latent.cpu().float().cuda()
+            speaker_embedding = speaker_embedding.cpu().float().cuda()
+            model = model.float().cuda()
+        else:
+            gpt_cond_latent = gpt_cond_latent.float()
+            speaker_embedding = speaker_embedding.float()
+            model = model.float().cpu()
+        model.eval()
+        voice.model = model
+        voice.gpt_cond_latent = gpt_cond_latent
+        voice.speaker_embedding = speaker_embedding
+    except Exception as e:
+        print(f"⚠️ Не удалось вычислить латенты голоса: {e}")
+        return voice
+
+    voice.precision = _resolve_precision(settings.get("precision", "fp32"), cuda)
+    if voice.precision == "int8":
+        try:
+            _quantize_int8(voice.model)
+        except Exception as e:
+            print(f"⚠️ int8-квантизация не удалась, остаётся fp32: {e}")
+            voice.precision = "fp32"
+
+    if settings.get("compile") and hasattr(torch, "compile"):
+        originals = _compile_model(voice.model)
+        # Компиляция происходит при первом вызове — прогреваем сразу,
+        # чтобы первая реплика не ждала и ошибка не всплыла посреди эфира
+        try:
+            synthesize(voice, WARMUP_TEXT, settings=settings)
+        except Exception as e:
+            print(f"⚠️ torch.compile не сработал, используется eager-режим: {e}")
+            for module, forward in originals:
+                module.forward = forward
+    print(f"🗣 XTTS: {voice.device}, {voice.precision}, потоков torch: {torch.get_num_threads()}")
+    return voice
+
+
+def synthesize(
+    voice: XttsVoice,
+    text: str,
+    should_stop: Callable[[], bool] | None = None,
+    settings: dict | None = None,
+) -> np.ndarray | None:
+    """
+    Синтезирует текст загруженным голосом и возвращает аудио (24 кГц).
+    Возвращает None, если синтез прерван (should_stop() вернул True)
+    или не дал аудио. Ошибки модели пробрасываются.
+    """
+    settings = settings or TTS_SETTINGS
+    audio_accum = []
+    started = time.perf_counter()
+    with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16, enabled=voice.precision == "fp16"):
+        stream = voice.model.inference_stream(
             text=text,
             language="ru",
-            gpt_cond_latent=GPT_COND_LATENT,
-            speaker_embedding=SPEAKER_EMBEDDING,
-            speed=0.97,
-            temperature=1,
-            top_k=50,
+            gpt_cond_latent=voice.gpt_cond_latent,
+            speaker_embedding=voice.speaker_embedding,
+            speed=settings["speed"],
+            temperature=settings["temperature"],
+            top_k=settings["top_k"],
             top_p=1,
             enable_text_splitting=False,
         )
-    except Exception as e:
-        print(f"❌ Ошибка stream-генерации: {e}")
-        return ""
+        for chunk in stream:
+            if should_stop is not None and should_stop():
+                return None
+            chunk_np = chunk.detach().float().cpu().numpy() if isinstance(chunk, torch.Tensor) else np.array(chunk, dtype=np.float32)
+            if chunk_np.size == 0:
+                continue
+            audio_accum.append(chunk_np.astype(np.float32, copy=False))
+    if not audio_accum:
+        return None
+    audio = np.concatenate(audio_accum)
+    _record_rtf(time.perf_counter() - started, len(audio) / SAMPLE_RATE)
+    return audio
 
-    sd.default.samplerate = 24000
-    sd.default.channels = 1
-    out_path = "output/xtts_streamed.wav"
-    os.makedirs("output", exist_ok=True)
-    audio_accum = []
-    stream_finished_flag = threading.Event()
-    current_chunk = np.zeros(1, dtype=np.float32)
-
-    def mimics_loop():
-        last_volume = 0.0
-        smoothing = 0.7
-        smoothed_volume = 0.0
-        while not stream_finished_flag.is_set():
-            rms = np.sqrt(np.mean(np.square(current_chunk)))
-            raw_volume = float(np.clip(rms * 4.2, 0.0, 1.0))
-            smoothed_volume = smoothing * smoothed_volume + (1 - smoothing) * raw_volume
-            if abs(smoothed_volume - last_volume) > 0.01:
-                try:
-                    vts_client.set_mouth_open(smoothed_volume)
-                    last_volume = smoothed_volume
-                except Exception:
-                    pass
-            time.sleep(1 / 60.0)
+
+# Real-time factor синтеза: время синтеза / длительность аудио (< 1 — быстрее реального времени)
+tts_stats = {"last_rtf": 0.0, "avg_rtf": 0.0, "utterances": 0}
+
+
+def _record_rtf(elapsed: float, duration: float) -> None:
+    if duration <= 0:
+        return
+    rtf = elapsed / duration
+    n = tts_stats["utterances"]
+    tts_stats["last_rtf"] = rtf
+    tts_stats["avg_rtf"] = rtf if n == 0 else 0.9 * tts_stats["avg_rtf"] + 0.1 * rtf
+    tts_stats["utterances"] = n + 1
+    print(f"⏱ XTTS: {duration:.1f} с аудио за {elapsed:.1f} с (RTF {rtf:.2f})")
+
+
+tts_slot = EngineSlot("tts", _build_xtts, TTS_SETTINGS, closer=lambda voice: arbiter.release("tts"))
+arbiter.register("tts", pinned=lambda: int(TTS_SETTINGS["num_threads"] or 0))
+tts_slot.get()
+
+# Синтез сериализован: основные реплики имеют приоритет над фоновыми
+tts_gate = PriorityGate()
+
+
+# Кэш синтезированных фрагментов: короткие фразы («Привет!», «Ну и ладно.»)
+# повторяются часто, а синтез каждой стоит сотни миллисекунд
+_chunk_cache: OrderedDict[tuple, np.ndarray] = OrderedDict()
+_chunk_cache_lock = threading.Lock()
+
+
+def _chunk_key(chunk: str) -> tuple:
+    # После перезагрузки движка (другой голос/режим) старые записи не подходят
+    return (chunk, tts_slot.loaded_at, TTS_SETTINGS["speed"], TTS_SETTINGS["temperature"], TTS_SETTINGS["top_k"])
+
+
+def _cached_chunk(key: tuple) -> np.ndarray | None:
+    with _chunk_cache_lock:
+        audio = _chunk_cache.get(key)
+        if audio is not None:
+            _chunk_cache.move_to_end(key)
+        return audio
+
+
+def _store_chunk(key: tuple, audio: np.ndarray) -> None:
+    with _chunk_cache_lock:
+        _chunk_cache[key] = audio
+        _chunk_cache.move_to_end(key)
+        while len(_chunk_cache) > CHUNK_CACHE_SIZE:
+            _chunk_cache.popitem(last=False)
+
+
+def _render_chunk(
+    chunk: str,
+    background: bool,
+    cancel: Callable[[], bool] | None,
+) -> np.ndarray | None:
+    key = _chunk_key(chunk)
+    audio = _cached_chunk(key)
+    if audio is not None:
+        return audio
+    # Блокировка берётся на фрагмент, а не на всю реплику: основной запрос
+    # может вклиниться между фрагментами фоновой
+    with tts_gate.acquire(background), tts_slot.use() as voice, arbiter.active("tts"):
+        if voice.gpt_cond_latent is None or voice.speaker_embedding is None:
+            print("⚠️ Латенты голоса не готовы.")
+            return None
+        should_stop = None
+        if background:
+            should_stop = lambda: tts_gate.foreground_waiting() or (cancel is not None and cancel())  # noqa: E731
         try:
-            vts_client.set_mouth_open(0.0)
-        except Exception:
-            pass
+            audio = synthesize(voice, chunk, should_stop)
+        except Exception as e:
+            print(f"⚠️ Ошибка во время генерации: {e}")
+            return None
+    if audio is not None:
+        _store_chunk(key, audio)
+    return audio
 
-    try:
-        vts_client.authenticate()
-    except Exception:
-        pass
 
-    try:
-        for chunk in stream:
-            chunk_np = chunk.detach().cpu().numpy().astype(np.float32) if isinstance(chunk, torch.Tensor) else np.array(chunk, dtype=np.float32)
-            if chunk_np.size == 0:
-                continue
-            audio_accum.append(chunk_np)
-    except Exception as e:
-        print(f"⚠️ Ошибка во время генерации: {e}")
+def iter_speech(
+    text: str,
+    background: bool = False,
+    cancel: Callable[[], bool] | None = None,
+) -> Iterator[np.ndarray]:
+    """
+    Нормализует текст, делит его на фрагменты (см. text_normalizer) и
+    выдаёт аудио каждого фрагмента по мере синтеза. Фоновый рендер
+    останавливается, как только фрагмент прерван; основной пропускает
+    фрагменты, которые не удалось синтезировать.
+    """
+    return _iter_chunks(prepare_for_tts(text), background, cancel)
 
-    if not audio_accum:
+
+def _iter_chunks(
+    chunks: list[str],
+    background: bool,
+    cancel: Callable[[], bool] | None,
+) -> Iterator[np.ndarray]:
+    for chunk in chunks:
+        if background and cancel is not None and cancel():
+            return
+        audio = _render_chunk(chunk, background, cancel)
+        if audio is None:
+            if background:
+                return
+            continue
+        yield audio
+
+
+def render_speech(
+    text: str,
+    background: bool = False,
+    cancel: Callable[[], bool] | None = None,
+) -> np.ndarray | None:
+    """
+    Синтезирует речь без воспроизведения и возвращает аудио (24 кГц).
+
+    background=True — фоновый рендер (например, заранее подготовленная
+    мысль AutoThinker): он уступает основным запросам и прекращается,
+    если `cancel()` вернул True или ждёт основной запрос.
+    Возвращает None, если синтез не удался или был прерван.
+    """
+    print("🎣️ Генерация речи через XTTS…")
+
+    chunks = prepare_for_tts(text)
+    pieces = list(_iter_chunks(chunks, background, cancel))
+    # Фоновый рендер останавливается на прерванном фрагменте — неполную
+    # реплику не отдаём
+    if background and len(pieces) < len(chunks):
+        return None
+    if not pieces:
         print("⚠️ Нет сгенерированных аудиоданных.")
-        return ""
+        return None
+    return join_chunks(pieces, SAMPLE_RATE)
 
-    full_audio = np.concatenate(audio_accum)
-    sf.write(out_path, full_audio, 24000)
 
-    mimics_thread = threading.Thread(target=mimics_loop, daemon=True)
-    mimics_thread.start()
-    try:
-        current_chunk[:] = 0.0
-        sd.play(full_audio, samplerate=24000)
-        for i in range(0, len(full_audio), 512):
-            current_chunk = full_audio[i:i+512]
-            time.sleep(512 / 24000)
-        sd.wait()
-    except Exception as e:
-        print(f"⚠️ Ошибка воспроизведения: {e}")
-    finally:
-        stream_finished_flag.set()
-        current_chunk = np.zeros(1, dtype=np.float32)
-        try:
-            vts_client.set_mouth_open(0.0)
-        except Exception:
-            pass
-        mimics_thread.join(timeout=1.0)
+def play_speech(audio: np.ndarray) -> str:
+    """Проигрывает заранее синтезированную речь с мимикой. Возвращает путь к WAV."""
+    return play_audio(audio, samplerate=SAMPLE_RATE)
+
+
+class XttsEngine(TTSEngine):
+    """XTTS с клонированным голосом Элейн: лучшее качество, самая большая задержка."""
+
+    name = "xtts"
+    quality = 2
+    sample_rate = SAMPLE_RATE
+    startup_seconds = 0.2
+    default_load_seconds = 20.0
+    slot = tts_slot
 
-    return out_path
+    def synthesize_chunk(self, chunk: str) -> np.ndarray | None:
+        return _render_chunk(chunk, False, None)
+
+    def iter_render(
+        self,
+        text: str,
+        background: bool = False,
+        cancel: Callable[[], bool] | None = None,
+    ) -> Iterator[np.ndarray]:
+        for audio in iter_speech(text, background, cancel):
+            self.rtf = tts_stats["avg_rtf"] or self.rtf
+            yield audio
+
+    def render(
+        self,
+        text: str,
+        background: bool = False,
+        cancel: Callable[[], bool] | None = None,
+    ) -> np.ndarray | None:
+        return render_speech(text, background, cancel)
+
+
+# Движок выбирается на каждую реплику по бюджету задержки: голосовые
+# ответы — XTTS, поток сообщений чата — Piper или Silero
+tts_router = TTSRouter([XttsEngine(), SileroEngine(), PiperEngine()])
+register_handler("GET", "/tts", lambda body: {"engines": tts_router.status(), "xtts": tts_stats})
+
+
+def preload_fallback_voices() -> None:
+    """
+    Загружает запасные голоса (Silero, Piper) в фоне при старте, чтобы
+    первый всплеск чата не ждал загрузку модели, а тем более сеть.
+    """
+    for engine in tts_router.engines[1:]:
+        engine.preload()
+
+
+def speak_text(text: str, latency_budget: float | None = None) -> str:
+    """
+    Озвучивает текст конвейером: пока играет фрагмент, синтезируется
+    следующий. latency_budget — сколько секунд можно ждать начала речи;
+    по нему выбирается движок (None — лучший по качеству, то есть XTTS).
+    Возвращает путь к последнему WAV.
+    """
+    path = tts_router.speak(text, latency_budget)
+    if not path:
+        print("⚠️ Нет сгенерированных аудиоданных.")
+    return path
@@ -0,0 +1,75 @@
+"""Планировщик запросов каналов: очередность по кругу, переполнение, ошибки."""
+
+import asyncio
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services"))
+
+from chat_sessions import ChannelQueueFull, ChannelSession, FairScheduler  # noqa: E402
+
+
+def _blocked_scheduler(**kwargs):
+    """Планировщик, чей единственный рабочий поток занят до release.set()."""
+    scheduler = FairScheduler(workers=1, **kwargs)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    return scheduler, block, started, release
+
+
+def test_round_robin_between_channels():
+    async def scenario():
+        scheduler, block, started, release = _blocked_scheduler()
+        order = []
+        first = scheduler.submit("busy", block)
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+        futures = [scheduler.submit("busy", order.append, f"busy-{i}") for i in range(3)]
+        futures.append(scheduler.submit("quiet", order.append, "quiet-0"))
+        release.set()
+        await asyncio.gather(first, *futures)
+        return order
+
+    order = asyncio.run(scenario())
+    # Тихий канал не ждёт, пока разойдётся вся очередь шумного
+    assert order.index("quiet-0") <= 1
+
+
+def test_overflow_fails_oldest_with_channel_queue_full():
+    async def scenario():
+        scheduler, block, started, release = _blocked_scheduler(max_pending=2)
+        first = scheduler.submit("chan", block)
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+        futures = [scheduler.submit("chan", lambda i=i: i) for i in range(3)]
+        release.set()
+        await first
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    dropped, *kept = asyncio.run(scenario())
+    assert isinstance(dropped, ChannelQueueFull)
+    assert dropped.channel == "chan"
+    assert kept == [1, 2]
+
+
+def test_worker_exception_reaches_caller():
+    def fail():
+        raise ValueError("boom")
+
+    async def scenario():
+        scheduler = FairScheduler(workers=1)
+        await scheduler.submit("chan", fail)
+
+    with pytest.raises(ValueError, match="boom"):
+        asyncio.run(scenario())
+
+
+def test_channel_session_rate_limit():
+    session = ChannelSession("chan", rate_per_minute=0.0, burst=2)
+    assert [session.allow() for _ in range(3)] == [True, True, False]
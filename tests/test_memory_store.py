@@ -0,0 +1,51 @@
+"""Журнал памяти: компактизация при открытии и по расписанию в потоке записи."""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services"))
+
+from memory_store import MemoryStore  # noqa: E402
+
+DAY = 86400.0
+
+
+def _days(directory) -> list[str]:
+    return sorted(name[:-4] for name in os.listdir(directory) if name.endswith(".idx"))
+
+
+def test_open_drops_segments_past_retention(tmp_path):
+    store = MemoryStore(str(tmp_path), flush_interval=0.01, retention_days=7)
+    now = time.time()
+    store.append("давно", now - 30 * DAY)
+    store.append("недавно", now - 2 * DAY)
+    store.append("сегодня", now)
+    store.flush()
+    assert len(_days(tmp_path)) == 3
+
+    reopened = MemoryStore(str(tmp_path), flush_interval=0.01, retention_days=7)
+    assert len(_days(tmp_path)) == 2
+    assert [entry for _, entry in reopened.query()] == ["недавно", "сегодня"]
+
+
+def test_open_removes_repeats_in_closed_segments(tmp_path):
+    store = MemoryStore(str(tmp_path), flush_interval=0.01, retention_days=0)
+    yesterday = time.time() - DAY
+    for i, entry in enumerate(["экран", "экран", "экран", "чат", "экран"]):
+        store.append(entry, yesterday + i)
+    store.flush()
+
+    reopened = MemoryStore(str(tmp_path), flush_interval=0.01, retention_days=0)
+    assert reopened.tail(10) == ["экран", "чат", "экран"]
+
+
+def test_writer_thread_compacts_periodically(tmp_path):
+    store = MemoryStore(str(tmp_path), flush_interval=0.01, retention_days=7, compact_interval=0.05)
+    store.append("давно", time.time() - 30 * DAY)
+    store.append("сегодня")
+    store.flush()
+    deadline = time.monotonic() + 5.0
+    while len(_days(tmp_path)) > 1 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert store.tail(10) == ["сегодня"]
@@ -0,0 +1,181 @@
+"""
+ElaineTwitchBot против локального IRC-сервера, изображающего чат Twitch:
+сообщения двух каналов приходят по IRC, ответы бота уходят обратно на
+сервер. Проверяются очередность каналов, лимит ответов и сброс
+переполненной очереди. LLM заменена быстрой заглушкой.
+"""
+
+import asyncio
+import os
+import re
+import sys
+import threading
+
+import pytest
+
+# main подтягивает весь конвейер (Whisper, llama.cpp, torch, twitchio)
+for _module in ("twitchio", "torch", "numpy", "whisper", "llama_cpp", "sounddevice", "websockets"):
+    pytest.importorskip(_module)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import main  # noqa: E402
+
+_PRIVMSG_RE = re.compile(r"^(?:@(?P<tags>\S+) )?:(?P<nick>[^!\s]+)\S* PRIVMSG #(?P<channel>\S+) :(?P<text>.*)$")
+
+
+class IRCStandIn:
+    """Минимальный IRC-сервер: JOIN, PRIVMSG в обе стороны, журнал ответов бота."""
+
+    def __init__(self) -> None:
+        self.replies: list[tuple[str, str]] = []
+        self.joined: set[str] = set()
+        self._writers: list[asyncio.StreamWriter] = []
+        self._server = None
+
+    async def __aenter__(self) -> "IRCStandIn":
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        for writer in self._writers:
+            writer.close()
+        self._server.close()
+        await self._server.wait_closed()
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def say(self, channel: str, nick: str, text: str) -> None:
+        line = f"@display-name={nick} :{nick}!{nick}@{nick}.tmi.twitch.tv PRIVMSG #{channel} :{text}\r\n"
+        for writer in self._writers:
+            writer.write(line.encode("utf-8"))
+            await writer.drain()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._writers.append(writer)
+        while line := (await reader.readline()).decode("utf-8").rstrip("\r\n"):
+            command, _, rest = line.partition(" ")
+            if command == "NICK":
+                writer.write(f":tmi.twitch.tv 001 {rest} :Welcome, GLHF!\r\n".encode("utf-8"))
+            elif command == "JOIN":
+                self.joined.add(rest.lstrip("#"))
+                writer.write(f":bot!bot@bot.tmi.twitch.tv JOIN {rest}\r\n".encode("utf-8"))
+            elif command == "PRIVMSG":
+                channel, _, text = rest.partition(" :")
+                self.replies.append((channel.lstrip("#"), text))
+            await writer.drain()
+
+
+class _Channel:
+    def __init__(self, name: str, writer: asyncio.StreamWriter) -> None:
+        self.name = name
+        self._writer = writer
+
+    async def send(self, text: str) -> None:
+        self._writer.write(f"PRIVMSG #{self.name} :{text}\r\n".encode("utf-8"))
+        await self._writer.drain()
+
+
+class _Author:
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+
+class _Message:
+    echo = False
+
+    def __init__(self, channel: _Channel, author: str, content: str) -> None:
+        self.channel = channel
+        self.author = _Author(author)
+        self.content = content
+
+
+async def _run_bot(bot: "main.ElaineTwitchBot", port: int, channels: list[str], expected: int, tasks: list) -> None:
+    """IRC-подключение бота: логин, JOIN и передача PRIVMSG в event_message."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"PASS oauth:test\r\nNICK bot\r\n")
+    for channel in channels:
+        writer.write(f"JOIN #{channel}\r\n".encode("utf-8"))
+    await writer.drain()
+    received = 0
+    while received < expected:
+        line = (await reader.readline()).decode("utf-8").rstrip("\r\n")
+        match = _PRIVMSG_RE.match(line)
+        if match is None:
+            continue
+        received += 1
+        message = _Message(_Channel(match["channel"], writer), match["nick"], match["text"])
+        tasks.append(asyncio.ensure_future(bot.event_message(message)))
+        # Запрос встаёт в очередь планировщика до следующего сообщения
+        await asyncio.sleep(0)
+
+
+class _FakeLLM:
+    """Заглушка generate_response: ждёт release, отвечает текстом сообщения."""
+
+    def __init__(self) -> None:
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, prompt: str, **kwargs) -> str:
+        self.started.set()
+        self.release.wait(5)
+        return "ответ: " + re.search(r"написал: (\S+)\.", prompt).group(1)
+
+
+def _drive(monkeypatch, script: list[tuple[str, str]], channels=("alpha", "beta"), rate=600.0, burst=10, max_pending=5):
+    llm = _FakeLLM()
+    monkeypatch.setattr(main, "generate_response", llm)
+    # Оба канала не основные: только текст, без озвучки
+    monkeypatch.setattr(main, "PRIMARY_CHANNEL", "nobody")
+
+    bot = main.ElaineTwitchBot.__new__(main.ElaineTwitchBot)
+    bot._init_chat(list(channels), max_pending=max_pending)
+    for session in bot.sessions.values():
+        session.rate_per_minute = rate
+        session.burst = burst
+
+    async def scenario():
+        async with IRCStandIn() as server:
+            tasks: list = []
+            bot_task = asyncio.ensure_future(_run_bot(bot, server.port, list(channels), len(script), tasks))
+            while server.joined != set(channels):
+                await asyncio.sleep(0.01)
+            (first_channel, first_text), *rest = script
+            await server.say(first_channel, "viewer", first_text)
+            # Первый запрос занимает рабочий поток, остальные копятся в очереди
+            await asyncio.get_running_loop().run_in_executor(None, llm.started.wait, 5)
+            for channel, text in rest:
+                await server.say(channel, "viewer", text)
+            await bot_task
+            llm.release.set()
+            await asyncio.wait_for(asyncio.gather(*tasks), 5)
+            await asyncio.sleep(0.05)
+            return server.replies
+
+    return asyncio.run(scenario())
+
+
+def test_quiet_channel_is_not_starved(monkeypatch):
+    script = [("alpha", f"a{i}") for i in range(4)] + [("beta", "b0")]
+    replies = _drive(monkeypatch, script)
+    order = [text.split(": ")[1] for _, text in replies]
+    assert sorted(order) == ["a0", "a1", "a2", "a3", "b0"]
+    # Первый запрос alpha уже в работе, дальше каналы чередуются
+    assert order.index("b0") <= 2
+    assert ("beta", "ответ: b0") in replies
+
+
+def test_rate_limit_skips_excess_messages(monkeypatch):
+    script = [("alpha", f"a{i}") for i in range(5)]
+    replies = _drive(monkeypatch, script, rate=0.0, burst=3)
+    assert [text for _, text in replies] == ["ответ: a0", "ответ: a1", "ответ: a2"]
+
+
+def test_overflow_drops_oldest_pending(monkeypatch):
+    script = [("alpha", f"a{i}") for i in range(5)]
+    replies = _drive(monkeypatch, script, max_pending=2)
+    # a0 уже генерируется, из очереди a1..a4 остаются два последних
+    assert [text for _, text in replies] == ["ответ: a0", "ответ: a3", "ответ: a4"]
@@ -0,0 +1,206 @@
+"""
+Клиент VTube Studio против локального поддельного WebSocket-сервера:
+аутентификация, переподключение, экспоненциальная пауза и отказ в доступе.
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+
+import pytest
+
+websockets = pytest.importorskip("websockets")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import vtube_controller  # noqa: E402
+from vtube_controller import CONNECTED, VTubeStudioClient  # noqa: E402
+
+
+class FakeVTS:
+    """
+    Минимальный сервер VTube Studio Public API. authenticated — ответ на
+    AuthenticationRequest; drop_after_auth — закрывать соединение сразу
+    после успешной аутентификации (имитация перезапуска VTube Studio).
+    """
+
+    def __init__(self, authenticated: bool = True, drop_after_auth: bool = False, deny_token: bool = False) -> None:
+        self.authenticated = authenticated
+        self.drop_after_auth = drop_after_auth
+        self.deny_token = deny_token
+        self.requests: list[dict] = []
+        self.connections = 0
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        port = self._server.sockets[0].getsockname()[1]
+        return f"ws://127.0.0.1:{port}"
+
+    async def __aenter__(self) -> "FakeVTS":
+        self._server = await websockets.serve(self._handle, "127.0.0.1", 0)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    def of_type(self, message_type: str) -> list[dict]:
+        return [r for r in self.requests if r["messageType"] == message_type]
+
+    async def _handle(self, ws, *args) -> None:
+        self.connections += 1
+        async for raw in ws:
+            request = json.loads(raw)
+            self.requests.append(request)
+            kind = request["messageType"]
+            reply = {"apiName": "VTubeStudioPublicAPI", "requestID": request["requestID"], "messageType": kind.replace("Request", "Response"), "data": {}}
+            if kind == "AuthenticationTokenRequest" and self.deny_token:
+                reply["messageType"] = "APIError"
+                reply["data"] = {"errorID": 50, "message": "User has denied API access for your plugin."}
+            elif kind == "AuthenticationTokenRequest":
+                reply["data"] = {"authenticationToken": "fake-token"}
+            elif kind == "AuthenticationRequest":
+                reply["data"] = {"authenticated": self.authenticated, "reason": "" if self.authenticated else "token revoked"}
+            await ws.send(json.dumps(reply))
+            if kind == "AuthenticationRequest" and self.authenticated and self.drop_after_auth:
+                await ws.close()
+                return
+
+
+async def _until(predicate, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("условие не выполнилось вовремя")
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def fast_backoff(monkeypatch):
+    # Паузы 1 → 2 → 4 → 8 «секунд» проходят за миллисекунды
+    monkeypatch.setattr(vtube_controller, "BACKOFF_INITIAL", 1.0)
+    monkeypatch.setattr(vtube_controller, "BACKOFF_MAX", 8.0)
+    # Обрыв соединения замечается на ближайшем keep-alive
+    monkeypatch.setattr(vtube_controller, "KEEP_ALIVE_INTERVAL", 0.05)
+    monkeypatch.setattr(vtube_controller.random, "uniform", lambda a, b: 0.001)
+
+
+def test_connects_with_new_token_and_sends_mouth(tmp_path, fast_backoff):
+    async def scenario():
+        async with FakeVTS() as server:
+            client = VTubeStudioClient(host=server.url, token_file=str(tmp_path / "token.txt"))
+            client.start()
+            await _until(lambda: client.state == CONNECTED)
+            client.set_mouth_open(0.7)
+            await _until(lambda: server.of_type("InjectParameterDataRequest")
+                         and server.of_type("InjectParameterDataRequest")[-1]["data"]["parameterValues"][0]["value"] == 0.7)
+            client.close()
+            return server
+
+    server = asyncio.run(scenario())
+    assert len(server.of_type("AuthenticationTokenRequest")) == 1
+    assert (tmp_path / "token.txt").read_text(encoding="utf-8") == "fake-token"
+
+
+def test_reconnects_after_server_drops(tmp_path, fast_backoff):
+    (tmp_path / "token.txt").write_text("fake-token", encoding="utf-8")
+
+    async def scenario():
+        async with FakeVTS(drop_after_auth=True) as server:
+            client = VTubeStudioClient(host=server.url, token_file=str(tmp_path / "token.txt"))
+            client.start()
+            await _until(lambda: server.connections >= 3)
+            client.close()
+            return server, client
+
+    server, client = asyncio.run(scenario())
+    assert client.reconnects >= 2
+    # Сохранённый токен переиспользуется, новый не запрашивается
+    assert not server.of_type("AuthenticationTokenRequest")
+    assert len(server.of_type("AuthenticationRequest")) >= 3
+    # Успешное подключение сбрасывает паузу к начальной
+    assert client.backoff == vtube_controller.BACKOFF_INITIAL
+
+
+def test_backoff_doubles_up_to_max_without_server(tmp_path, fast_backoff):
+    seen: list[float] = []
+
+    async def scenario():
+        async with FakeVTS() as server:
+            url = server.url
+        # Сервер остановлен — каждая попытка подключения падает
+        client = VTubeStudioClient(host=url, token_file=str(tmp_path / "token.txt"))
+        client.on_health(lambda state, error: seen.append(client.backoff) if state == "connecting" else None)
+        client.start()
+        await _until(lambda: client.reconnects >= 6)
+        client.close()
+        return client
+
+    client = asyncio.run(scenario())
+    assert client.last_error
+    assert seen[1:6] == [1.0, 2.0, 4.0, 8.0, 8.0]
+
+
+def test_revoked_token_is_cleared_and_backs_off_to_max(tmp_path, fast_backoff):
+    token_file = tmp_path / "token.txt"
+    token_file.write_text("stale-token", encoding="utf-8")
+
+    async def scenario():
+        async with FakeVTS(authenticated=False) as server:
+            client = VTubeStudioClient(host=server.url, token_file=str(token_file))
+            client.start()
+            await _until(lambda: client.reconnects >= 1)
+            client.close()
+            return client
+
+    client = asyncio.run(scenario())
+    assert "аутентификация не прошла" in (client.last_error or "")
+    assert client.backoff == vtube_controller.BACKOFF_MAX
+    assert token_file.read_text(encoding="utf-8") == ""
+
+
+def test_denied_access_is_auth_error(tmp_path, fast_backoff):
+    async def scenario():
+        async with FakeVTS(deny_token=True) as server:
+            client = VTubeStudioClient(host=server.url, token_file=str(tmp_path / "token.txt"))
+            client.start()
+            await _until(lambda: client.reconnects >= 1)
+            client.close()
+            return client
+
+    client = asyncio.run(scenario())
+    assert "denied" in (client.last_error or "")
+    assert client.backoff == vtube_controller.BACKOFF_MAX
+
+
+def test_emotions_switch_expressions_without_toggling(tmp_path, fast_backoff):
+    (tmp_path / "token.txt").write_text("fake-token", encoding="utf-8")
+
+    def activations(server):
+        return [(r["data"]["expressionFile"], r["data"]["active"]) for r in server.of_type("ExpressionActivationRequest")]
+
+    async def scenario():
+        async with FakeVTS() as server:
+            client = VTubeStudioClient(host=server.url, token_file=str(tmp_path / "token.txt"))
+            client.start()
+            await _until(lambda: client.state == CONNECTED)
+            client.set_emotion("happy")
+            await _until(lambda: len(activations(server)) == 1)
+            # Повтор той же эмоции не выключает выражение
+            client.set_emotion("happy")
+            client.set_emotion("sad")
+            await _until(lambda: len(activations(server)) == 3)
+            client.set_emotion("neutral")
+            await _until(lambda: len(activations(server)) == 4)
+            client.close()
+            return activations(server)
+
+    assert asyncio.run(scenario()) == [
+        ("Happy.exp3.json", True),
+        ("Happy.exp3.json", False),
+        ("Sad.exp3.json", True),
+        ("Sad.exp3.json", False),
+    ]
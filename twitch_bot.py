@@ -27,7 +27,7 @@ class ElaineTwitchBot(commands.Bot):
 
         # Генерируем ответ модели
         prompt = f"{USER_NAME}, в чате Twitch {author} написал: {content}. Ответь коротко и дружелюбно."
-        response = generate_response(prompt, [])
+        response = generate_response(prompt, [], cache_key=content, cache_scope=message.channel.name.lower(), cache_author=author)
 
         # Отвечаем в чате
         await message.channel.send(response)
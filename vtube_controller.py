@@ -1,32 +1,46 @@
 """
-Модуль для взаимодействия с VTube Studio Public API.
+Модуль для взаимодействия с VTube Studio Public API.
 
-Новая реализация обеспечивает:
-* Постоянное WebSocket‑соединение и фоновую задачу «keep‑alive»,
-  чтобы API не отключало плагин между вызовами.
-* Обёртки `authenticate()` и `set_mouth_open()` доступны как
-  синхронные методы. Они ставят задания в фоновую asyncio‑петлю,
-  поэтому могут вызываться из любого потока без ожидания loop.run().
-* Аутентификация срабатывает только при первом успешном подключении.
+Соединением управляет конечный автомат в фоновом asyncio‑цикле:
+
+```text
+DISCONNECTED → CONNECTING → AUTHENTICATING [→ WAITING_APPROVAL] → CONNECTED
+      ↑                                                              │
+      └────────────── BACKOFF (1 → 2 → 4 … 30 с) ◄── ошибка ─────────┘
+```
+
+* Подключение и аутентификация идут только в фоновом потоке — вызывающий
+  код никогда не ждёт сеть и не блокируется на `input()`: токен
+  подтверждается кнопкой ‘Allow’ в самой VTube Studio.
+* Пока VTube Studio не подключена, `set_mouth_open()` просто отбрасывает
+  кадр (одна проверка флага), без попыток подключиться на каждом кадре.
+  Поэтому закрытая VTube Studio ничего не стоит аудиопотоку.
+* Выражения (`set_emotion`) включаются `ExpressionActivationRequest`
+  с явным active: true/false — предыдущее выключается, повтор той же
+  эмоции ничего не меняет. Без соединения запоминается последнее
+  выражение, оно включается после переподключения.
+* Переходы состояний сообщаются через callback здоровья соединения.
 
 Использование:
 
 ```python
-vts_client = VTubeStudioClient()
-vts_client.authenticate()  # однажды, затем соединение поддерживается
+vts_client = VTubeStudioClient(health_callback=lambda state, error: print(state, error))
+vts_client.start()           # не блокирует
 vts_client.set_mouth_open(0.5)
 ```
 
-Периодический keep‑alive автоматически отправляет запрос
-`APIAvailableRequest` каждые 10 секунд, чтобы удерживать соединение.
+Адрес и файл токена задаются в конструкторе, поэтому клиент можно
+проверять против локального тестового WebSocket‑сервера.
 """
 
 from __future__ import annotations
 
 import asyncio
 import json
+import random
 import threading
-from typing import Any, Dict
+import time
+from typing import Any, Callable, Dict, Optional
 
 import websockets  # type: ignore
 
@@ -35,160 +49,311 @@ HOST = "ws://localhost:8001"
 PLUGIN_NAME = "Elaine1"
 PLUGIN_DEV = "nvm1"
 
+CONNECT_TIMEOUT = 3.0
+REQUEST_TIMEOUT = 3.0
+APPROVAL_TIMEOUT = 120.0       # сколько ждать нажатия ‘Allow’ в VTube Studio
+KEEP_ALIVE_INTERVAL = 10.0
+BACKOFF_INITIAL = 1.0
+BACKOFF_MAX = 30.0
+
+# Состояния соединения
+DISCONNECTED = "disconnected"
+CONNECTING = "connecting"
+AUTHENTICATING = "authenticating"
+WAITING_APPROVAL = "waiting_approval"
+CONNECTED = "connected"
+BACKOFF = "backoff"
+CLOSED = "closed"
+
+# Соответствие эмоций из структурированного ответа LLM файлам выражений
+# модели в VTube Studio (*.exp3.json в папке модели). neutral — ни одного
+# выражения: предыдущее просто выключается
+EMOTION_EXPRESSIONS: Dict[str, Optional[str]] = {
+    "neutral": None,
+    "happy": "Happy.exp3.json",
+    "smug": "Smug.exp3.json",
+    "angry": "Angry.exp3.json",
+    "sad": "Sad.exp3.json",
+    "surprised": "Surprised.exp3.json",
+    "shy": "Shy.exp3.json",
+}
+
+HealthCallback = Callable[[str, Optional[str]], None]
+
+
+class VTSAuthError(RuntimeError):
+    """VTube Studio отклонила токен или запрос доступа."""
+
 
 class VTubeStudioClient:
-    """Клиент для работы с VTube Studio Public API с постоянным соединением."""
-
-    def __init__(self) -> None:
-        # Переменные состояния
-        self.token: str | None = None
-        self.ws: websockets.WebSocketClientProtocol | None = None
-        self.authenticated: bool = False
-        self._printed_auth_success: bool = False
-        # Фоновый asyncio‑цикл, работающий в отдельном потоке
+    """Клиент VTube Studio Public API с автоматическим переподключением."""
+
+    def __init__(
+        self,
+        host: str = HOST,
+        token_file: str = TOKEN_FILE,
+        health_callback: Optional[HealthCallback] = None,
+    ) -> None:
+        self.host = host
+        self.token_file = token_file
+        self.state = DISCONNECTED
+        self.last_error: Optional[str] = None
+        self.reconnects = 0
+        self.dropped_frames = 0
+        self.backoff = 0.0             # текущая пауза перед переподключением
+        self._health_callbacks: list[HealthCallback] = [health_callback] if health_callback else []
+        self._printed_auth_success = False
+        self._request_id = 0
+
+        # Последнее значение MouthOpen: отправляется только свежее
+        self._mouth_value = 0.0
+        self._mouth_dirty = False
+        # Выражение, которое должно быть включено, и включённое в VTube Studio
+        self._expression: Optional[str] = None
+        self._expression_dirty = False
+        self._active_expression: Optional[str] = None
+        self._lock = threading.Lock()
+
+        # Фоновый asyncio‑цикл, работающий в отдельном потоке (запускается в start())
         self._loop = asyncio.new_event_loop()
-        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
-        self._loop_thread.start()
-        # Задача keep‑alive
-        self._keep_alive_task: asyncio.Future | None = None
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, name="vts-loop", daemon=True)
+        self._wake: Optional[asyncio.Event] = None
+        self._wake_pending = False
+        self._supervisor: Optional[asyncio.Future] = None
 
     # ------------------------------------------------------------------
-    # Вспомогательные асинхронные методы (исполняются в фоновом цикле)
-    async def _connect(self) -> None:
-        """Создаёт WebSocket‑подключение, если его нет или оно закрыто."""
-        if self.ws is not None and not self.ws.closed:
+    # Публичные методы, вызываемые из любого потока (не блокируют)
+    @property
+    def connected(self) -> bool:
+        return self.state == CONNECTED
+
+    def start(self) -> None:
+        """Запускает фоновое подключение (повторные вызовы ничего не делают)."""
+        if self._supervisor is None:
+            with self._lock:
+                if self._supervisor is None:
+                    self._loop_thread.start()
+                    self._supervisor = asyncio.run_coroutine_threadsafe(self._run(), self._loop)
+
+    def authenticate(self) -> None:
+        """Совместимость со старым API: запускает подключение и сразу возвращается."""
+        self.start()
+
+    def on_health(self, callback: HealthCallback) -> None:
+        """Подписывает callback(state, error) на смену состояния соединения."""
+        self._health_callbacks.append(callback)
+
+    def health(self) -> dict[str, Any]:
+        return {
+            "state": self.state,
+            "last_error": self.last_error,
+            "reconnects": self.reconnects,
+            "backoff_seconds": self.backoff,
+            "dropped_frames": self.dropped_frames,
+            "expression": self._expression,
+            "active_expression": self._active_expression,
+        }
+
+    def wait_connected(self, timeout: float) -> bool:
+        """Ждёт подключения до timeout секунд (для скриптов и проверок)."""
+        self.start()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.connected:
+                return True
+            time.sleep(0.05)
+        return self.connected
+
+    def set_mouth_open(self, value: float) -> None:
+        """
+        Устанавливает параметр MouthOpen. Пока соединения нет, кадр
+        отбрасывается; отправляется только последнее значение.
+        """
+        if self.state != CONNECTED:
+            self.dropped_frames += 1
+            if self._supervisor is None:
+                self.start()
             return
-        self.ws = await websockets.connect(HOST)
-
-    async def _send(self, payload: Dict[str, Any]) -> Dict[str, Any]:
-        """Отправляет payload по WebSocket и получает ответ."""
-        if self.ws is None or self.ws.closed:
-            await self._connect()
-        assert self.ws is not None
-        await self.ws.send(json.dumps(payload))
-        resp = await self.ws.recv()
-        return json.loads(resp)
-
-    async def _authenticate(self) -> None:
-        """Асинхронная часть аутентификации."""
-        # Убедимся, что есть соединение
-        await self._connect()
-        # Уже аутентифицированы
-        if self.authenticated and self.ws is not None and not self.ws.closed:
+        self._mouth_value = max(0.0, min(1.0, float(value)))
+        self._mouth_dirty = True
+        self._notify()
+
+    def set_emotion(self, emotion: str) -> None:
+        """
+        Включает выражение, соответствующее эмоции из EMOTION_EXPRESSIONS,
+        выключив предыдущее. Без соединения включится после переподключения.
+        """
+        if emotion not in EMOTION_EXPRESSIONS:
             return
-        # Загружаем или получаем токен
-        token: str | None = None
-        try:
-            with open(TOKEN_FILE, "r", encoding="utf-8") as f:
-                token = f.read().strip()
-        except FileNotFoundError:
-            token = None
-        if not token:
-            req = {
-                "apiName": "VTubeStudioPublicAPI",
-                "apiVersion": "1.0",
-                "requestID": "requestToken",
-                "messageType": "AuthenticationTokenRequest",
-                "data": {
-                    "pluginName": PLUGIN_NAME,
-                    "pluginDeveloper": PLUGIN_DEV,
-                },
-            }
-            res = await self._send(req)
-            token = res["data"]["authenticationToken"]
-            # Сохраняем токен
+        with self._lock:
+            self._expression = EMOTION_EXPRESSIONS[emotion]
+            self._expression_dirty = True
+        self.start()
+        self._notify()
+
+    def close(self) -> None:
+        """Останавливает фоновое соединение."""
+        if self._supervisor is None:
+            self._set_state(CLOSED)
+            return
+        self._supervisor.cancel()
+        self._loop.call_soon_threadsafe(self._set_state, CLOSED, None)
+
+    # ------------------------------------------------------------------
+    # Фоновый цикл
+    def _notify(self) -> None:
+        # Не больше одного пробуждения в очереди цикла
+        if self._wake is None or self._wake_pending:
+            return
+        self._wake_pending = True
+        self._loop.call_soon_threadsafe(self._wake_sender)
+
+    def _wake_sender(self) -> None:
+        self._wake_pending = False
+        if self._wake is not None:
+            self._wake.set()
+
+    def _set_state(self, state: str, error: Optional[str] = None) -> None:
+        if state == self.state and error == self.last_error:
+            return
+        self.state = state
+        if error is not None:
+            self.last_error = error
+        for callback in self._health_callbacks:
             try:
-                with open(TOKEN_FILE, "w", encoding="utf-8") as f:
-                    f.write(token)
-            except OSError:
+                callback(state, error)
+            except Exception:
                 pass
-            # Пользователь должен подтвердить доступ в VTube Studio
-            print("🔐 Теперь в VTube Studio нажмите ‘Allow’, потом нажмите Enter…")
+
+    async def _run(self) -> None:
+        self._wake = asyncio.Event()
+        backoff = BACKOFF_INITIAL
+        while True:
+            ws = None
             try:
-                input()
-            except EOFError:
-                pass
-        self.token = token
-        # Отправляем запрос аутентификации
-        auth_req = {
+                self._set_state(CONNECTING)
+                ws = await asyncio.wait_for(websockets.connect(self.host), CONNECT_TIMEOUT)
+                self._set_state(AUTHENTICATING)
+                await self._authenticate(ws)
+                self._set_state(CONNECTED)
+                backoff = BACKOFF_INITIAL
+                await self._session(ws)
+            except asyncio.CancelledError:
+                raise
+            except VTSAuthError as e:
+                print(f"❌ VTube Studio: {e}")
+                self._set_state(BACKOFF, str(e))
+                backoff = BACKOFF_MAX
+            except Exception as e:
+                self._set_state(BACKOFF, f"{type(e).__name__}: {e}")
+            finally:
+                if ws is not None:
+                    try:
+                        await ws.close()
+                    except Exception:
+                        pass
+            self.backoff = backoff
+            self.reconnects += 1
+            # Небольшой разброс, чтобы не долбить VTube Studio в такт
+            await asyncio.sleep(backoff * random.uniform(0.9, 1.1))
+            backoff = min(BACKOFF_MAX, backoff * 2)
+
+    async def _request(self, ws: Any, message_type: str, data: Optional[dict] = None, timeout: float = REQUEST_TIMEOUT) -> Dict[str, Any]:
+        """Отправляет запрос и ждёт ответ; APIError с отказом в доступе поднимает VTSAuthError."""
+        self._request_id += 1
+        payload: Dict[str, Any] = {
             "apiName": "VTubeStudioPublicAPI",
             "apiVersion": "1.0",
-            "requestID": "auth",
-            "messageType": "AuthenticationRequest",
-            "data": {
-                "pluginName": PLUGIN_NAME,
-                "pluginDeveloper": PLUGIN_DEV,
-                "authenticationToken": self.token,
-            },
+            "requestID": f"elaine-{self._request_id}",
+            "messageType": message_type,
         }
-        auth_res = await self._send(auth_req)
-        if not auth_res.get("data", {}).get("authenticated"):
-            self.authenticated = False
-            raise RuntimeError(
-                "❌ Auth failed: " + auth_res.get("data", {}).get("reason", "")
-            )
-        self.authenticated = True
+        if data is not None:
+            payload["data"] = data
+        await ws.send(json.dumps(payload))
+        res = json.loads(await asyncio.wait_for(ws.recv(), timeout))
+        if res.get("messageType") == "APIError":
+            error = res.get("data", {})
+            # 8 — запрос требует аутентификации, 50 — пользователь отказал в доступе
+            if error.get("errorID") in (8, 50):
+                raise VTSAuthError(error.get("message", "доступ запрещён"))
+            print(f"⚠️ VTube Studio: {error.get('message', res)}")
+        return res
+
+    def _load_token(self) -> Optional[str]:
+        try:
+            with open(self.token_file, "r", encoding="utf-8") as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def _save_token(self, token: Optional[str]) -> None:
+        try:
+            with open(self.token_file, "w", encoding="utf-8") as f:
+                f.write(token or "")
+        except OSError:
+            pass
+
+    async def _authenticate(self, ws: Any) -> None:
+        token = self._load_token()
+        plugin = {"pluginName": PLUGIN_NAME, "pluginDeveloper": PLUGIN_DEV}
+        if not token:
+            # VTube Studio отвечает на запрос токена только после нажатия
+            # ‘Allow’/‘Deny’ — ждём в фоне, вызывающий код не блокируется
+            self._set_state(WAITING_APPROVAL)
+            print("🔐 Подтвердите доступ плагина в VTube Studio (кнопка ‘Allow’)…")
+            res = await self._request(ws, "AuthenticationTokenRequest", plugin, timeout=APPROVAL_TIMEOUT)
+            token = res.get("data", {}).get("authenticationToken")
+            if not token:
+                raise VTSAuthError("доступ не выдан")
+            self._save_token(token)
+            self._set_state(AUTHENTICATING)
+
+        res = await self._request(ws, "AuthenticationRequest", {**plugin, "authenticationToken": token})
+        if not res.get("data", {}).get("authenticated"):
+            # Токен отозван в VTube Studio — при следующей попытке запросим новый
+            self._save_token(None)
+            raise VTSAuthError("аутентификация не прошла: " + res.get("data", {}).get("reason", ""))
         if not self._printed_auth_success:
             print("✅ Аутентификация прошла успешно.")
             self._printed_auth_success = True
-        # Запускаем keep‑alive, если он ещё не запущен
-        if self._keep_alive_task is None:
-            self._keep_alive_task = asyncio.ensure_future(self._keep_alive(), loop=self._loop)
 
-    async def _keep_alive(self) -> None:
-        """Периодически отправляет запрос APIAvailableRequest для поддержания соединения."""
+    async def _apply_expression(self, ws: Any, wanted: Optional[str]) -> None:
+        # Запросы с явным active идемпотентны, в отличие от горячих клавиш-переключателей
+        previous = self._active_expression
+        if previous is not None and previous != wanted:
+            await self._request(ws, "ExpressionActivationRequest", {"expressionFile": previous, "active": False})
+        if wanted is not None:
+            await self._request(ws, "ExpressionActivationRequest", {"expressionFile": wanted, "active": True})
+        self._active_expression = wanted
+
+    async def _session(self, ws: Any) -> None:
+        """Отправляет выражение, кадры рта и keep-alive, пока соединение живо."""
+        assert self._wake is not None
+        # После переподключения рот должен быть закрыт, а выражение — совпадать
+        # с нужным (VTube Studio могла перезапуститься и сбросить его)
+        self._mouth_value, self._mouth_dirty = 0.0, True
+        resync = True
+        next_ping = time.monotonic() + KEEP_ALIVE_INTERVAL
         while True:
+            self._wake.clear()
+            with self._lock:
+                wanted, dirty = self._expression, self._expression_dirty
+                self._expression_dirty = False
+            if resync or (dirty and wanted != self._active_expression):
+                await self._apply_expression(ws, wanted)
+                resync = False
+            if self._mouth_dirty:
+                self._mouth_dirty = False
+                await self._request(
+                    ws,
+                    "InjectParameterDataRequest",
+                    {"parameterValues": [{"id": "MouthOpen", "value": self._mouth_value}]},
+                )
+            now = time.monotonic()
+            if now >= next_ping:
+                await self._request(ws, "APIAvailableRequest")
+                next_ping = now + KEEP_ALIVE_INTERVAL
             try:
-                # Каждые 10 секунд
-                await asyncio.sleep(10)
-                await self._connect()
-                if not self.authenticated:
-                    await self._authenticate()
-                ping = {
-                    "apiName": "VTubeStudioPublicAPI",
-                    "apiVersion": "1.0",
-                    "requestID": "keepAlive",
-                    "messageType": "APIAvailableRequest",
-                }
-                await self._send(ping)
-            except Exception:
-                # В случае ошибки сбрасываем флаг и пробуем снова на следующей итерации
-                self.authenticated = False
-                continue
-
-    async def _set_mouth_open_async(self, value: float) -> None:
-        """Асинхронно отправляет параметр MouthOpen."""
-        await self._connect()
-        if not self.authenticated:
-            await self._authenticate()
-        value = max(0.0, min(1.0, float(value)))
-        payload = {
-            "apiName": "VTubeStudioPublicAPI",
-            "apiVersion": "1.0",
-            "requestID": "mouthMove",
-            "messageType": "InjectParameterDataRequest",
-            "data": {
-                "parameterValues": [
-                    {"id": "MouthOpen", "value": value}
-                ]
-            },
-        }
-        try:
-            await self._send(payload)
-        except Exception:
-            self.authenticated = False
-            raise
-
-    # ------------------------------------------------------------------
-    # Публичные методы (синхронные), вызываемые из любого потока
-    def authenticate(self) -> None:
-        """Гарантирует аутентификацию. Возвращает после завершения."""
-        fut = asyncio.run_coroutine_threadsafe(self._authenticate(), self._loop)
-        return fut.result()
-
-    def set_mouth_open(self, value: float) -> None:
-        """Синхронно устанавливает параметр MouthOpen."""
-        fut = asyncio.run_coroutine_threadsafe(
-            self._set_mouth_open_async(value), self._loop
-        )
-        return fut.result()
\ No newline at end of file
+                await asyncio.wait_for(self._wake.wait(), max(0.0, next_ping - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass